@@ -67,3 +67,35 @@ class AboutHelper(object):
         msg += "\t/etc/minstore/servers.list /var/lib/minstore/storage 8001\n\n"
 
         return msg
+
+    @classmethod
+    def tools_help_info(cls, default_samples):
+        """
+        Returns the help information about the maintenance tools
+        """
+        msg = "minstore {!s}. Maintenance tools.\n\n".format(cls.version())
+
+        msg += "Usage: python tools.py COMMAND [ARGS]\n\n"
+        msg += "\trehash BASE_PATH LEVELS [WIDTH]: moves the records of a flat\n"
+        msg += "\t\t\tBASE_PATH to LEVELS nested subdirectories of WIDTH\n"
+        msg += "\t\t\thexadecimal characters, 2 by default. The records are\n"
+        msg += "\t\t\tavailable while moving.\n"
+        msg += "\tretrain BASE_PATH [SAMPLES]: trains a new compression\n"
+        msg += "\t\t\tdictionary with SAMPLES random records, {:d} by\n"\
+            .format(default_samples)
+        msg += "\t\t\tdefault. The server takes it within a minute.\n"
+        msg += "\trecompress BASE_PATH [PAUSE]: rewrites all the records with\n"
+        msg += "\t\t\tthe configured format and the current dictionary, at\n"
+        msg += "\t\t\tlow priority, sleeping PAUSE seconds between records.\n"
+        msg += "\t\t\tRun it in the background of a serving node.\n"
+        msg += "\trecount BASE_PATH: counts again the references to the\n"
+        msg += "\t\t\tdeduplicated values and removes the values without\n"
+        msg += "\t\t\treferences. Run it with the server stopped.\n\n"
+
+        msg += "Example: \n"
+        msg += "\t/usr/bin/python /opt/minstore/tools.py \\\n"
+        msg += "\trehash /var/lib/minstore/storage 2\n"
+        msg += "\t/usr/bin/python /opt/minstore/tools.py \\\n"
+        msg += "\trecompress /var/lib/minstore/storage 0.01 &\n\n"
+
+        return msg
@@ -4,57 +4,554 @@
 from wsgiservice import *
 from wsgiref.simple_server import make_server
 
+import signal
 import sys
-from minstore.cache import MemoryCache
+from minstore.cache import MemoryCache, NegativeCache, ShardedMemoryCache
+from minstore.cache import CacheEntry, ChecksumMap, STALE, STALE_IF_ERROR
+from minstore.cache import CacheSnapshot
 from minstore.strategies import Spread
 
 sys.path.append('..')
 
 from minstore.constants import *
 from minstore.about import AboutHelper
+from minstore.blobs import BlobStore
+from minstore.chunks import ChunkStore
+from minstore.compression import Compressor
+from minstore.eviction import POLICIES
+from minstore.exceptions import BlobMissing, RecordChanged
+from minstore.expiry import ExpirySchedule, ExpirySweeper
 from minstore.exceptions import RecordExists
 from minstore.exceptions import RecordMissing
+from minstore.indexes import HashIndex, IndexSet, SortedIndex
 from minstore.models import TextModel
-from minstore.storage import FileStorage
+from minstore.storage import ChunkedStorage, DedupStorage, FileStorage
+from minstore.storage import LogStorage, WriteBehindStorage
+from minstore.storage import SqliteStorage
 from minstore.processes import DetectLangProcess, MarkProcess
+from minstore.search import SearchIndex
+from minstore.serializers import BinarySerializer, JsonSerializer
 from minstore.helpers import Helpers, RecordHelper
 
+# Name of the snapshot of the cache of the texts of the dependant servers. The
+# cache of the local texts is not saved, its texts may change before a restart.
+CACHE_SNAPSHOT = 'cache'
+
 # Globals
 
 storage = None
+indexes = None
+search_index = None
+expiry = None
+sweeper = None
+record_cache = None
+snapshots = []
+check_sums = None
 model = None
 strategy = None
 base_path = None
 servers_list_path = None
 
 
-@mount('/text/{uid}')
-class TextApi(Resource):
+def get_storage():
+    """Gets the storage, it creates the storage if not exists"""
+    global storage, base_path
+
+    if not storage:
+        if STORAGE_ENGINE == LOG_ENGINE:
+            storage = LogStorage(
+                base_path=base_path,
+                durability=FILE_DURABILITY,
+                group_commit_window=FILE_GROUP_COMMIT_WINDOW)
+
+        elif STORAGE_ENGINE == SQLITE_ENGINE:
+            storage = SqliteStorage(base_path=base_path)
+
+        else:
+            if COMPRESSION:
+                compressor = Compressor(
+                    base_path=base_path,
+                    threshold=COMPRESSION_THRESHOLD,
+                    level=COMPRESSION_LEVEL,
+                    dictionary=COMPRESSION_DICTIONARY)
+                serializer = BinarySerializer(compressor=compressor)
+
+            elif RECORD_FORMAT == BINARY_FORMAT:
+                serializer = BinarySerializer()
+
+            else:
+                serializer = JsonSerializer()
+
+            storage = FileStorage(
+                base_path=base_path,
+                shard_levels=FILE_SHARD_LEVELS,
+                shard_width=FILE_SHARD_WIDTH,
+                durability=FILE_DURABILITY,
+                group_commit_window=FILE_GROUP_COMMIT_WINDOW,
+                serializer=serializer)
+
+        if DEDUP:
+            storage = DedupStorage(storage=storage,
+                                   blobs=BlobStore(base_path=base_path))
+
+        if CHUNKED:
+            storage = ChunkedStorage(
+                storage=storage,
+                chunks=ChunkStore(base_path=base_path,
+                                  chunk_size=CHUNK_SIZE),
+                threshold=CHUNK_THRESHOLD)
+
+        if WRITE_BEHIND:
+            storage = WriteBehindStorage(
+                storage=storage,
+                max_records=WRITE_BEHIND_MAX_RECORDS,
+                flush_records=WRITE_BEHIND_FLUSH_RECORDS,
+                max_age=WRITE_BEHIND_MAX_AGE)
+
+    return storage
+
+
+def get_indexes():
+    """Gets the indexes, it loads or builds them if not exist"""
+    global indexes, base_path
+
+    if not indexes:
+        indexes = IndexSet(
+            base_path=base_path,
+            indexes=[HashIndex(field=field) for field in HASH_INDEXES] +
+                    [SortedIndex(field=field) for field in SORTED_INDEXES],
+            snapshot_interval=INDEX_SNAPSHOT_INTERVAL)
+
+        if indexes.created or indexes.outdated:
+            indexes.rebuild(records=get_storage().scan())
+
+    return indexes
+
+
+def get_search():
+    """Gets the search index, it loads or builds it if not exists. None
+    if the search is disabled."""
+    global search_index, base_path
+
+    if not search_index and SEARCH_INDEX:
+        search_index = SearchIndex(base_path=base_path,
+                                   delta_limit=SEARCH_DELTA_LIMIT,
+                                   max_segments=SEARCH_MAX_SEGMENTS)
+
+        if search_index.created:
+            search_index.rebuild(records=get_storage().scan())
+
+    return search_index
+
+
+def get_expiry():
+    """Gets the expiry schedule, it loads or builds it if not exists"""
+    global expiry, base_path
+
+    if not expiry:
+        expiry = ExpirySchedule(
+            base_path=base_path,
+            resolution=EXPIRY_RESOLUTION,
+            slots=EXPIRY_WHEEL_SLOTS,
+            levels=EXPIRY_WHEEL_LEVELS,
+            snapshot_interval=EXPIRY_SNAPSHOT_INTERVAL)
+
+        if expiry.created:
+            expiry.rebuild(records=get_storage().scan())
+
+    return expiry
+
+
+def get_record_cache():
+    """Gets the cache of the local texts read and written, it creates the
+    cache if not exists. None if the cache is disabled."""
+    global record_cache
+
+    if not record_cache and RECORD_CACHE_SIZE:
+        record_cache = create_cache(size_limit=RECORD_CACHE_SIZE)
+
+    return record_cache
+
+
+def get_check_sums():
+    """Gets the map of the check sums of the local texts, it creates the
+    map if not exists. None if the map is disabled."""
+    global check_sums
+
+    if not check_sums and CHECKSUM_MAP_SIZE:
+        check_sums = ChecksumMap(size_limit=CHECKSUM_MAP_SIZE)
+
+    return check_sums
+
+
+def get_model():
+    """Gets the text model, it creates the model and starts the sweeper
+    of the expired texts if not exists"""
+    global model, storage, sweeper
+    processes = [DetectLangProcess, MarkProcess]
+
+    if not model:
+        model = TextModel(storage=get_storage(),
+                          processes=processes,
+                          indexes=get_indexes(),
+                          search=get_search(),
+                          expiry=get_expiry(),
+                          cache=get_record_cache(),
+                          check_sums=get_check_sums())
+
+        sweeper = ExpirySweeper(schedule=get_expiry(),
+                                expire=expire_texts,
+                                interval=EXPIRY_SWEEP_INTERVAL,
+                                batch=EXPIRY_SWEEP_BATCH)
+
+    return model
+
+
+def get_strategy(cache_mode=False):
+    """Gets the persistence strategy, creates it if not exists.
+    :param cache_mode: bool creates the cache of the texts of the dependant
+    servers along with the strategy
+    :return: Spread
+    """
+    global strategy, servers_list_path
+
+    if not strategy:
+        strategy = Spread(config_path=servers_list_path, route='text')
+
+        if NEGATIVE_CACHE_SIZE:
+            strategy.missing = NegativeCache(size_limit=NEGATIVE_CACHE_SIZE,
+                                             ttl=NEGATIVE_CACHE_TTL)
+
+    # the strategy may have been created by the sweeper, without cache
+
+    if cache_mode and strategy.cache is None:
+        strategy.cache = restore_cache(
+            cache=create_cache(
+                size_limit=MAX_CACHE_SIZE_LEN,
+                ttl=CACHE_TTL,
+                stale_while_revalidate=CACHE_STALE_WHILE_REVALIDATE,
+                stale_if_error=CACHE_STALE_IF_ERROR),
+            name=CACHE_SNAPSHOT)
+
+    return strategy
+
+
+def create_cache(size_limit, **params):
+    """
+    Creates a memory cache with the configured eviction policy, sharded
+    if configured
+    :param size_limit: int bytes
+    :param params: dict ttl and stale windows of the records
+    :return: Cache
+    """
+    if CACHE_SHARDS > 1:
+        return ShardedMemoryCache(size_limit=size_limit,
+                                  shards=CACHE_SHARDS,
+                                  policy_class=POLICIES[CACHE_POLICY],
+                                  **params)
+
+    return MemoryCache(size_limit=size_limit,
+                       policy=POLICIES[CACHE_POLICY](),
+                       **params)
+
+
+def restore_cache(cache, name):
+    """
+    Loads the snapshot of a new cache and saves it periodically, if the
+    snapshots are enabled
+    :param cache: Cache
+    :param name: str name of the snapshot
+    :return: Cache
+    """
+    global snapshots, base_path
+
+    if CACHE_SNAPSHOT_INTERVAL and base_path:
+        snapshot = CacheSnapshot(cache=cache,
+                                 base_path=base_path,
+                                 name=name,
+                                 interval=CACHE_SNAPSHOT_INTERVAL)
+        snapshot.load()
+        snapshots.append(snapshot)
+
+    return cache
+
+
+class TextResource(Resource):
+    """Base of the text resources, sharing the storage, model and strategy"""
 
     NOT_FOUND = (KeyError,)
+
+    @property
+    def _is_cache(self):
+        """
+        Checks if request is for mode cache storing only.
+        :return: bool
+        """
+        return CACHE_MODE in self.request.GET
+
+    @property
+    def _is_mirror(self):
+        """
+        Checks if request is for mode mirror.
+        :return: bool
+        """
+        return MIRROR_MODE in self.request.GET
+
+    @property
+    def _is_bridge(self):
+        """
+        Checks if request is for mode bridge.
+        :return: bool
+        """
+        return BRIDGE_MODE in self.request.GET
+
+    @property
+    def _is_raw(self):
+        """
+        Checks if request is for the raw value of the text.
+        :return: bool
+        """
+        return RAW_MODE in self.request.GET
+
+    @property
+    def _storage(self):
+        """Gets the storage"""
+        return get_storage()
+
+    @property
+    def _indexes(self):
+        """Gets the indexes"""
+        return get_indexes()
+
+    @property
+    def _search(self):
+        """Gets the search index, None if the search is disabled"""
+        return get_search()
+
+    @property
+    def _expiry(self):
+        """Gets the expiry schedule"""
+        return get_expiry()
+
+    @property
+    def _record_cache(self):
+        """Gets the cache of the local texts, None if the cache is disabled"""
+        return get_record_cache()
+
+    @property
+    def _check_sums(self):
+        """Gets the map of the check sums of the local texts, None if the map is disabled"""
+        return get_check_sums()
+
+    @property
+    def _model(self):
+        """Gets the text model"""
+        return get_model()
+
+    @classmethod
+    def _parse_ttl(cls, ttl):
+        """
+        Returns the seconds to live of a ttl parameter, None without it
+        :param ttl: str|None
+        :return: float|None
+        :raise ValueError
+        """
+        if ttl is None:
+            return None
+
+        ttl = float(ttl)
+
+        if not ttl > 0:
+            raise ValueError('TTL must be positive')
+
+        return ttl
+
+    @property
+    def _strategy(self):
+        """Gets the persistence strategy, in cache mode if the request creating
+        it is"""
+        return get_strategy(cache_mode=self._is_cache)
+
+
+@mount('/text/')
+class TextListApi(TextResource):
+
+    def GET(self, after=None, limit=None, prefix=None):
+        """Returns a page of texts in uid order and the cursor of the next
+        page, None on the last one.
+
+        :param after: str cursor of the previous page
+        :param limit: int texts per page
+        :param prefix: str only the uids starting with it
+        :return dict
+        """
+        try:
+            start_after = None
+
+            if after:
+                start_after = Helpers.decode_cursor(cursor=after)
+
+            limit = min(int(limit or LIST_LIMIT), MAX_LIST_LIMIT)
+
+            if limit < 1:
+                raise ValueError('Limit must be positive')
+
+        except ValueError, exc:
+            raise_400(self, exc.message)
+
+        try:
+            records = list(self._storage.scan(prefix=prefix,
+                                              start_after=start_after,
+                                              limit=limit))
+
+            cursor = None
+
+            if len(records) == limit:
+                cursor = Helpers.encode_cursor(uid=records[-1]['uid'])
+
+            return {'records': records, 'next': cursor}
+
+        except Exception, exc:
+            raise_500(self, exc.message)
+
+
+@mount('/text/_index/{field}')
+class TextIndexApi(TextResource):
+
+    def GET(self, field, value=None, low=None, high=None, limit=None):
+        """Returns the uids of the texts by an indexed field, without reading
+        the texts. A hash index takes a value, a sorted index takes an
+        optional range of numbers.
+
+        :param field: str
+        :param value: str for a hash index
+        :param low: float for a sorted index
+        :param high: float for a sorted index
+        :param limit: int
+        :return dict
+        """
+        index = self._indexes.get(field=field)
+
+        if index is None:
+            raise_404(self)
+
+        try:
+            limit = min(int(limit or LIST_LIMIT), MAX_LIST_LIMIT)
+
+            if isinstance(index, SortedIndex):
+                uids = self._indexes.range(field=field,
+                                           low=float(low) if low else None,
+                                           high=float(high) if high else None,
+                                           limit=limit)
+
+            elif value is None:
+                raise ValueError('Missing value')
+
+            else:
+                uids = self._indexes.find(field=field,
+                                          value=value,
+                                          limit=limit)
+
+        except ValueError, exc:
+            raise_400(self, exc.message)
+
+        return {'uids': uids}
+
+
+@mount('/text/_search')
+class TextSearchApi(TextResource):
+
+    def GET(self, q=None, limit=None):
+        """Returns the uids and scores of the texts best matching a query,
+        best first. The words of a query are all required, and OR separates
+        alternatives: "red car OR blue bike".
+
+        :param q: str query
+        :param limit: int number of results
+        :return dict
+        """
+        if not self._search:
+            raise_404(self)
+
+        try:
+            if not q:
+                raise ValueError('Missing query')
+
+            limit = min(int(limit or SEARCH_LIMIT), MAX_LIST_LIMIT)
+
+        except ValueError, exc:
+            raise_400(self, exc.message)
+
+        try:
+            results = self._search.search(query=q, limit=limit)
+
+            return {'results': [{'uid': uid, 'score': score}
+                                for uid, score in results]}
+
+        except Exception, exc:
+            raise_500(self, exc.message)
+
+
+@mount('/text/_stats')
+class TextStatsApi(TextResource):
+
+    def GET(self):
+        """Returns the counters of the cache, of the cache of the local texts
+        and of the negative cache of the missing texts, None for a cache not
+        enabled.
+        :return dict
+        """
+        try:
+            cache = self._strategy.cache
+            missing = self._strategy.missing
+            records = self._record_cache
+
+            return {'cache': cache.stats() if cache else None,
+                    'records': records.stats() if records else None,
+                    'missing': missing.stats() if missing else None}
+
+        except Exception, exc:
+            raise_500(self, exc.message)
+
+
+@mount('/text/{uid}')
+class TextApi(TextResource):
+
     __etag = None
+    __expected = None
+    __streaming = False
+    __content_md5 = None
+    # True once the dependant servers confirmed the text missing
+    __confirmed_missing = False
 
     def GET(self, uid):
         """Returns a text by its uid.
         First checks cache if enabled. Second checks local storage and third
         looks for it into dependant servers.
 
+        With the raw parameter returns the bytes of the value only, or the
+        byte range requested by the Range header.
+
         :param uid: str
         :return dict
         """
+        if self._is_raw:
+            return self.__get_stream(uid=uid)
+
         try:
-            values = None
+            entry = self.__get_cached(uid=uid)
 
-            if self._strategy.cache:
-                values = self._strategy.cache.get(uid=uid)
+            if not entry:
+                entry = self._model.get_entry(uid=uid)
 
-            if not values:
-                values = self._model.get(uid=uid)
+            self.__set_etag(uid, entry.record['check_sum'])
 
-            self.__set_etag(uid, values['check_sum'])
-            return values
+            return self.__write_entry(entry=entry)
 
         except RecordMissing:
+            if self.__confirmed_missing:
+                raise_404(self)
+
             try:
                 values = self._strategy.bounce_get(uid=uid)
 
@@ -66,20 +563,33 @@ class TextApi(Resource):
         except Exception, exc:
             raise_500(self, exc.message)
 
-    def PUT(self, uid):
-        """Updates a record by uid.
+    def PUT(self, uid, ttl=None):
+        """Updates a record by uid. With the raw parameter the value is the
+        request body.
         :param uid: str
+        :param ttl: float seconds to live of the record, optional
         """
+        if self._is_raw:
+            return self.__write_stream(uid=uid,
+                                       write=self._model.update_stream,
+                                       ttl=ttl)
+
         try:
             value = self.request.POST['value']
+            ttl = self._parse_ttl(ttl=ttl)
 
             if self._is_cache:
-                values = self._strategy.bounce_put(uid=uid, value=value)
+                values = self._strategy.bounce_put(uid=uid,
+                                                   value=value,
+                                                   ttl=ttl)
 
             else:
 
                 if not self._is_mirror:
-                    values = self._model.update(uid=uid, values={'value': value})
+                    values = self._model.update(uid=uid,
+                                                values={'value': value,
+                                                        'ttl': ttl},
+                                                expected=self.__expected)
 
                 else:
                     values = self._copy_input(content=value)
@@ -88,6 +598,8 @@ class TextApi(Resource):
 
                     self._strategy.spread_put(record=values)
 
+            self._strategy.forget_missing(uid=uid)
+
             return values
 
         except KeyError, exc:
@@ -96,26 +608,48 @@ class TextApi(Resource):
         except TypeError, exc:
             raise_400(self, exc.message)
 
+        except ValueError, exc:
+            raise_400(self, exc.message)
+
         except RecordMissing:
             raise_404(self)
 
+        except RecordChanged:
+            raise_412(self)
+
+        except BlobMissing:
+            raise_409(self)
+
         except Exception, exc:
             raise_500(self, exc.message)
 
-    def POST(self, uid):
-        """Creates a record with uid.
+    def POST(self, uid, ttl=None):
+        """Creates a record with uid. With the raw parameter the value is the
+        request body.
         :param uid: str
+        :param ttl: float seconds to live of the record, optional
         """
+        if self._is_raw:
+            return self.__write_stream(uid=uid,
+                                       write=self._model.insert_stream,
+                                       ttl=ttl)
+
         try:
             value = self.request.POST['value']
+            ttl = self._parse_ttl(ttl=ttl)
 
             if self._is_cache:
-                values = self._strategy.bounce_post(uid=uid, value=value)
+                values = self._strategy.bounce_post(uid=uid,
+                                                    value=value,
+                                                    ttl=ttl)
 
             else:
-                values = self._model.insert(uid=uid, values={'value': value})
+                values = self._model.insert(uid=uid, values={'value': value,
+                                                             'ttl': ttl})
                 self._strategy.spread_put(record=values)
 
+            self._strategy.forget_missing(uid=uid)
+
             return values
 
         except KeyError, exc:
@@ -124,6 +658,9 @@ class TextApi(Resource):
         except TypeError, exc:
             raise_400(self, exc.message)
 
+        except ValueError, exc:
+            raise_400(self, exc.message)
+
         except RecordExists:
             raise_400(self)
 
@@ -135,7 +672,7 @@ class TextApi(Resource):
         :param uid: str
         """
         try:
-            self._model.delete(uid=uid)
+            self._model.delete(uid=uid, expected=self.__expected)
 
             if not self._is_mirror or self._is_bridge:
 
@@ -154,12 +691,52 @@ class TextApi(Resource):
             except RecordMissing:
                 raise_404(self)
 
+        except RecordChanged:
+            raise_412(self)
+
         except Exception, exc:
             raise_500(self, exc.message)
 
-    def get_etag(self):
+    def get_etag(self, uid):
+        """Returns the ETag of the local text of a uid for a conditional
+        request, checked against the If-None-Match and If-Match headers
+        before the method runs. The check sum comes from the map of the check
+        sums, so a 304 reads nothing. The check sum matched by If-Match is
+        kept, and the write is done only if the text still has it. The other
+        requests get the ETag of the text they read.
+        :param uid: str
+        :return: str|None
+        """
+        if 'If-Match' not in self.request.headers and \
+                'If-None-Match' not in self.request.headers:
+            return None
+
+        check_sum = self._model.find_check_sum(uid=uid)
+
+        if 'If-Match' in self.request.headers:
+            if check_sum is None:
+                raise_412(self, 'Text is missing')
+
+            self.__expected = check_sum
+
+        if check_sum is None:
+            return None
+
+        self.__set_etag(uid, check_sum)
+
         return self.__etag
 
+    def set_response_content_type(self):
+        if not self.__streaming:
+            super(TextApi, self).set_response_content_type()
+
+    def set_response_content_md5(self):
+        if self.__content_md5:
+            self.response.content_md5 = self.__content_md5
+
+        elif not self.__streaming:
+            super(TextApi, self).set_response_content_md5()
+
     def _copy_input(self, content):
         """
         Given a formatted json string updates the record related to.
@@ -171,75 +748,207 @@ class TextApi(Resource):
         if not record:
             return None
 
-        self._model.copy(record=record)
-
-        return record
+        return self._model.copy(record=record)
 
-    @property
-    def _is_cache(self):
-        """
-        Checks if request is for mode cache storing only.
-        :return: bool
+    def __get_stream(self, uid):
+        """Streams the value of a text by its uid, from the cache, the local
+        storage or the dependant servers.
+        :param uid: str
         """
-        return CACHE_MODE in self.request.GET
+        try:
+            entry = self.__get_cached(uid=uid)
 
-    @property
-    def _is_mirror(self):
-        """
-        Checks if request is for mode mirror.
-        :return: bool
-        """
-        return MIRROR_MODE in self.request.GET
+            if entry:
+                stream = RecordHelper.stream_record(record=entry.record)
 
-    @property
-    def _is_bridge(self):
-        """
-        Checks if request is for mode bridge.
-        :return: bool
+            else:
+                stream = self._model.get_stream(uid=uid)
+
+        except RecordMissing:
+            try:
+                stream = RecordHelper.stream_record(
+                    record=self._strategy.bounce_get(uid=uid))
+
+            except RecordMissing:
+                raise_404(self)
+
+        except Exception, exc:
+            raise_500(self, exc.message)
+
+        header, length, read = stream
+        start, end = 0, length
+
+        self.__set_etag(uid, header['check_sum'])
+        self.response.headers['Accept-Ranges'] = 'bytes'
+
+        if self.request.range:
+            span = self.request.range.range_for_length(length)
+
+            if span is None:
+                self.response.status = 416
+                self.response.headers['Content-Range'] = \
+                    'bytes */{:d}'.format(length)
+                return
+
+            start, end = span
+            self.response.status = 206
+            self.response.headers['Content-Range'] = \
+                'bytes {:d}-{:d}/{:d}'.format(start, end - 1, length)
+
+        self.__streaming = True
+        self.response.content_type = 'application/octet-stream'
+        self.response.app_iter = read(start, end)
+        self.response.content_length = end - start
+
+    def __write_stream(self, uid, write, ttl=None):
+        """Writes a text reading its value from the request body, and spreads
+        it streaming the value.
+        :param uid: str
+        :param write: callable of the model writing a new value
+        :param ttl: str|None seconds to live
+        :return: dict the text but the value
         """
-        return BRIDGE_MODE in self.request.GET
+        try:
+            length = self.request.content_length
+            ttl = self._parse_ttl(ttl=ttl)
 
-    @property
-    def _storage(self):
-        """Gets the storage, it creates the storage if not exists"""
-        global storage, base_path
+            if self._is_cache:
+                raise ValueError('Raw values are not cached')
 
-        if not storage:
-            storage = FileStorage(base_path=base_path)
+            if length is None:
+                raise ValueError('Missing Content-Length')
 
-        return storage
+            if self._is_mirror:
+                header = RecordHelper.str2record(
+                    content=self.request.headers.get(RECORD_HEADER))
 
-    @property
-    def _model(self):
-        """Gets the text model, it creates the model if not exists"""
-        global model, storage
-        processes = [DetectLangProcess, MarkProcess]
+                if not header:
+                    raise ValueError('Missing record header')
 
-        if not model:
-            model = TextModel(storage=self._storage, processes=processes)
+                values = self._model.copy_stream(header=header,
+                                                 stream=self.request.body_file,
+                                                 length=length)
 
-        return model
+            else:
+                values = write(uid=uid,
+                               stream=self.request.body_file,
+                               length=length,
+                               ttl=ttl)
 
-    @property
-    def _strategy(self):
-        """Gets the persistence strategy, creates it if not exists.
+            if not self._is_mirror or self._is_bridge:
+                self._strategy.spread_put_stream(
+                    uid=uid,
+                    source=lambda: self._model.get_stream(uid=uid))
+
+            self._strategy.forget_missing(uid=uid)
+
+            return values
+
+        except ValueError, exc:
+            raise_400(self, exc.message)
+
+        except RecordExists:
+            raise_400(self)
+
+        except RecordMissing:
+            raise_404(self)
+
+        except Exception, exc:
+            raise_500(self, exc.message)
+
+    def __get_cached(self, uid):
+        """Returns the cache entry of the text of a uid, None without cache.
+        A stale text is served while it is refreshed in the background. A
+        text past the stale window is refreshed first, and served only if
+        the dependant servers fail. A text the refresh finds missing on all
+        of them is confirmed missing, so they are not asked again.
+        :param uid: str
+        :return: CacheEntry|None
+        :raise RecordMissing
         """
-        global strategy, servers_list_path
+        if not self._strategy.cache:
+            return None
 
-        if not strategy:
-            strategy = Spread(config_path=servers_list_path, route='text')
+        entry, state = self._strategy.cache.lookup(uid=uid)
 
-            if self._is_cache:
-                strategy.cache = MemoryCache(size_limit=MAX_CACHE_SIZE_LEN)
+        if state == STALE:
+            self._strategy.revalidate(uid=uid)
 
-        return strategy
+        elif state == STALE_IF_ERROR:
+            try:
+                entry = CacheEntry(record=self._strategy.refresh(uid=uid))
+
+            except IOError:
+                pass
+
+            except RecordMissing:
+                self.__confirmed_missing = True
+                raise
+
+        return entry
+
+    def __write_entry(self, entry):
+        """Writes the encoded body of an entry as the response of a JSON
+        request, so it is not encoded again, or returns its text for the
+        other types.
+        :param entry: CacheEntry
+        :return: dict|None
+        """
+        if self.type != 'application/json':
+            return entry.record
+
+        self.response.body = entry.body
+        self.__content_md5 = entry.md5
 
     def __set_etag(self, uid, check_sum):
-        """Sets the value for the etag
+        """Sets the value for the etag and its response header
         :param uid: str
         :param check_sum: double
         """
-        self.__etag = '{uid}:{check_sum}'.format(uid=uid, check_sum=check_sum)
+        self.__etag = RecordHelper.etag(uid=uid, check_sum=check_sum)
+        self.clean_etag(self.__etag)
+
+
+def expire_texts(uids):
+    """Deletes a batch of expired texts and spreads the deletes, called by
+    the sweeper
+    :param uids: list
+    """
+    text_strategy = get_strategy()
+
+    for uid, result in get_model().expire_many(uids=uids).iteritems():
+        if result == DELETED:
+            text_strategy.spread_delete(uid=uid)
+
+
+def warm_caches():
+    """Creates the model and the caches, then reads the pinned uids into
+    them, before the server starts. A cache node, or a node with a snapshot
+    of the cache of the dependant servers, starts in cache mode: it creates
+    the cache loading the snapshot, if any, and reads the pinned uids from
+    the dependant servers.
+    """
+    global base_path
+
+    text_model = get_model()
+    text_strategy = None
+
+    # the strategy is created by the first request otherwise, in its mode
+
+    if CACHE_NODE or CACHE_SNAPSHOT_INTERVAL and \
+            CacheSnapshot.exists(base_path=base_path, name=CACHE_SNAPSHOT):
+        text_strategy = get_strategy(cache_mode=True)
+
+    for uid in CACHE_PINNED_UIDS:
+        try:
+            if text_strategy:
+                text_strategy.refresh(uid=uid)
+
+            else:
+                text_model.get_entry(uid=uid)
+
+        except (IOError, RecordMissing):
+            pass
 
 
 app = get_app(globals())
@@ -273,5 +982,22 @@ if __name__ == '__main__':
         print "See --help for more information.\n"
         exit(1)
 
+    # Exit cleanly on SIGTERM too, so the storage drains its pending writes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    warm_caches()
+
     print "Running on port {:d}".format(port)
-    make_server('', port, app).serve_forever()
+
+    try:
+        make_server('', port, app).serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for snapshot in snapshots:
+            snapshot.close()
+
+        if storage:
+            storage.close()
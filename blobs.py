@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""Content addressed store of the record values
+"""
+import errno
+import hashlib
+import json
+import os
+import tempfile
+from threading import RLock
+
+import sys
+sys.path.append('..')
+
+from minstore.exceptions import BlobMissing
+from minstore.helpers import Helpers
+
+BLOBS_DIR = '.blobs'
+REFERENCES_FILENAME = 'references.json'
+JOURNAL_FILENAME = 'journal.log'
+
+# Hexadecimal characters of the digest naming the subdirectory of a blob
+BLOB_SHARD_WIDTH = 2
+
+# Reference changes journaled before writing a new snapshot of the counts
+DEFAULT_SNAPSHOT_INTERVAL = 10000
+
+
+class BlobStore(object):
+    """
+    Values stored once by their SHA-1 digest and counted by the records
+    referencing them. A blob is removed when its last reference is
+    released.
+
+    The counts are kept into memory and persisted as a snapshot plus a
+    journal of the changes. The increments are synced to disk before the
+    record referencing the blob is written, so after a crash a count may be
+    too high, leaking a blob until the next recount, but never too low.
+    """
+
+    def __init__(self, base_path,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        """
+        Constructor
+
+        :param base_path: str directory with the blobs directory.
+        :param snapshot_interval: int journal entries between snapshots.
+        """
+        self._path = '{!s}/{!s}'.format(base_path, BLOBS_DIR)
+        self._snapshot_interval = snapshot_interval
+        self._lock = RLock()
+        # digest -> number of references
+        self._references = dict()
+        self._journal_entries = 0
+
+        if not Helpers.path_exists(self._path):
+            os.makedirs(self._path)
+
+        self._load()
+        self._journal = open(self.__format_path(JOURNAL_FILENAME), 'ab')
+
+        if self._journal_entries:
+            self.snapshot()
+
+    @classmethod
+    def digest(cls, value):
+        """
+        Returns the content address of a value
+        :param value: str|unicode
+        :return: str
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        return hashlib.sha1(value).hexdigest()
+
+    def acquire(self, value):
+        """
+        Stores a value if it is new and adds a reference to it. Returns its
+        digest.
+        :param value: str|unicode
+        :return: str
+        """
+        digest = self.digest(value=value)
+
+        self._lock.acquire()
+
+        try:
+            if digest not in self._references:
+                self.__write(digest=digest, value=value)
+
+            self.__change(digest=digest, delta=1)
+
+        finally:
+            self._lock.release()
+
+        return digest
+
+    def acquire_digest(self, digest):
+        """
+        Adds a reference to a stored value by its digest
+        :param digest: str
+        :raise BlobMissing
+        """
+        self._lock.acquire()
+
+        try:
+            if digest not in self._references:
+                raise BlobMissing(
+                    'Blob Error: Value {!s} is missing'.format(digest))
+
+            self.__change(digest=digest, delta=1)
+
+        finally:
+            self._lock.release()
+
+    def release(self, digest):
+        """
+        Removes a reference to a value, and the value with the last one
+        :param digest: str
+        """
+        self._lock.acquire()
+
+        try:
+            if digest not in self._references:
+                return
+
+            self.__change(digest=digest, delta=-1)
+
+            if not self._references[digest]:
+                del self._references[digest]
+                self.__remove(digest=digest)
+
+        finally:
+            self._lock.release()
+
+    def has(self, digest):
+        """
+        Checks if a value is stored
+        :param digest: str
+        :return: bool
+        """
+        return digest in self._references
+
+    def get(self, digest):
+        """
+        Returns a stored value
+        :param digest: str
+        :return: unicode
+        :raise BlobMissing
+        """
+        try:
+            with open(self.__format_blob_path(digest), 'rb') as blob:
+                return blob.read().decode('utf-8')
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+            raise BlobMissing(
+                'Blob Error: Value {!s} is missing'.format(digest))
+
+    def recount(self, digests):
+        """
+        Replaces the counts with the references of the given digests, one
+        per record, and removes the values without references.
+        Returns the number of removed values.
+        :param digests: iterable of str
+        :return: int
+        """
+        self._lock.acquire()
+
+        try:
+            references = dict()
+
+            for digest in digests:
+                references[digest] = references.get(digest, 0) + 1
+
+            self._references = references
+            self.snapshot()
+
+            removed = 0
+
+            for dir_path, dir_names, filenames in os.walk(self._path):
+                if dir_path == self._path:
+                    continue
+
+                for filename in filenames:
+                    if filename not in references:
+                        Helpers.delete_file(file_path='{!s}/{!s}'.format(
+                            dir_path, filename))
+                        removed += 1
+
+            return removed
+
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Writes atomically the counts and empties the journal
+        """
+        self._lock.acquire()
+
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self._path)
+
+            with os.fdopen(handle, 'wb') as target:
+                json.dump(self._references, target)
+                target.flush()
+                os.fsync(target.fileno())
+
+            os.rename(temp_path, self.__format_path(REFERENCES_FILENAME))
+
+            self._journal.truncate(0)
+            self._journal_entries = 0
+
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+
+        try:
+            self._journal.close()
+
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        """
+        Reads the snapshot of the counts and replays the journal. A partial
+        last entry of the journal, written on a crash, is dropped.
+        """
+        try:
+            with open(self.__format_path(REFERENCES_FILENAME), 'rb') as source:
+                self._references = json.load(source)
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+        try:
+            with open(self.__format_path(JOURNAL_FILENAME), 'rb') as journal:
+                for line in journal:
+                    try:
+                        digest, delta = json.loads(line)
+
+                    except ValueError:
+                        break
+
+                    self._references[digest] = \
+                        self._references.get(digest, 0) + delta
+                    self._journal_entries += 1
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+        self._references = dict((digest, count) for digest, count
+                                 in self._references.iteritems() if count > 0)
+
+    def __change(self, digest, delta):
+        """
+        Applies and journals a change of the count of a value. The
+        increments are synced to disk.
+        :param digest: str
+        :param delta: int
+        """
+        self._references[digest] = self._references.get(digest, 0) + delta
+
+        self._journal.write(json.dumps([digest, delta]) + '\n')
+        self._journal.flush()
+
+        if delta > 0:
+            os.fsync(self._journal.fileno())
+
+        self._journal_entries += 1
+
+        if self._journal_entries >= self._snapshot_interval:
+            self.snapshot()
+
+    def __write(self, digest, value):
+        """
+        Writes atomically the file of a value
+        :param digest: str
+        :param value: str|unicode
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        file_path = self.__format_blob_path(digest)
+        dir_path = os.path.dirname(file_path)
+
+        if not Helpers.path_exists(dir_path):
+            os.makedirs(dir_path)
+
+        handle, temp_path = tempfile.mkstemp(dir=self._path)
+
+        with os.fdopen(handle, 'wb') as target:
+            target.write(value)
+            target.flush()
+            os.fsync(target.fileno())
+
+        os.rename(temp_path, file_path)
+
+    def __remove(self, digest):
+        """
+        Removes the file of a value
+        :param digest: str
+        """
+        try:
+            Helpers.delete_file(file_path=self.__format_blob_path(digest))
+
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def __format_blob_path(self, digest):
+        """
+        :param digest: str
+        :return: str
+        """
+        return '{!s}/{!s}/{!s}'.format(self._path,
+                                       digest[:BLOB_SHARD_WIDTH],
+                                       digest)
+
+    def __format_path(self, filename):
+        """
+        :param filename: str
+        :return: str
+        """
+        return '{!s}/{!s}'.format(self._path, filename)
@@ -2,29 +2,129 @@
 """Classes for caching
 """
 from abc import ABCMeta, abstractmethod
-from Queue import Queue
-from threading import RLock
+from collections import OrderedDict
+from threading import Event, Lock, RLock, Thread
+import errno
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
 
+from minstore.eviction import LruPolicy
 from minstore.exceptions import RecordMissing
+from minstore.helpers import Helpers, RecordHelper
 
 UNLIMITED_MEMORY = -1
 DISABLED_MEMORY = 0
 
+# Independently locked segments of a sharded cache
+DEFAULT_CACHE_SHARDS = 16
+
+# States of a cached record: within its time to live, past it but served
+# while it is refreshed, and past it but served only if the refresh fails
+FRESH = 'fresh'
+STALE = 'stale'
+STALE_IF_ERROR = 'stale-if-error'
+
+# Missing uids remembered by a negative cache, and seconds they are remembered
+DEFAULT_NEGATIVE_SIZE = 10000
+DEFAULT_NEGATIVE_TTL = 1.0
+
+# Uids remembered by a map of check sums
+DEFAULT_CHECKSUM_MAP_SIZE = 100000
+
+CACHE_SNAPSHOT_DIR = '.cache'
+
+# Seconds between the snapshots of a cache
+DEFAULT_SNAPSHOT_INTERVAL = 60.0
+
+
+class CacheEntry(object):
+    """Record with its JSON response body, encoded once on first use, the
+    ETag and the MD5 of the body. The cache measures an entry by the bytes
+    of its body.
+    """
+
+    def __init__(self, record):
+        """Constructor
+
+        :param record: dict
+        """
+        self.record = record
+        self.etag = RecordHelper.etag(uid=record['uid'],
+                                      check_sum=record['check_sum'])
+        self._body = None
+        self._md5 = None
+
+    @property
+    def body(self):
+        """
+        :return: str
+        """
+        if self._body is None:
+            self._body = json.dumps(self.record)
+
+        return self._body
+
+    @property
+    def md5(self):
+        """
+        :return: str hexadecimal digest of the body
+        """
+        if self._md5 is None:
+            self._md5 = hashlib.md5(self.body).hexdigest()
+
+        return self._md5
+
+    @property
+    def size(self):
+        """
+        :return: int bytes of the body
+        """
+        return len(self.body)
+
 
 class Cache(object):
     __metaclass__ = ABCMeta
 
-    def __init__(self, size_limit=UNLIMITED_MEMORY):
+    def __init__(self, size_limit=UNLIMITED_MEMORY, policy=None, ttl=None,
+                 stale_while_revalidate=0, stale_if_error=0):
         """Constructor
+
+        :param size_limit: int
+        :param policy: EvictionPolicy choosing the evicted records, None for
+        a cache delegating the records to other caches.
+        :param ttl: float|None seconds a record is fresh by default. None or
+        0 keeps the records fresh.
+        :param stale_while_revalidate: float seconds a record past its time
+        to live is served while it is refreshed.
+        :param stale_if_error: float seconds a record past its time to live
+        is served if it can not be refreshed.
         """
         self._size_limit = size_limit
+        self._policy = policy
+        self._ttl = ttl
+        self._stale_while_revalidate = stale_while_revalidate
+        self._stale_if_error = stale_if_error
         self._buffer = dict()
         self._buffer_size = 0
 
-    @abstractmethod
-    def put(self, what):
+    def put(self, record, ttl=None):
         """Records the given data to the cache. Returns True if done else False.
-        :param what: dict
+        A record already cached is fresh again.
+        :param record: dict
+        :param ttl: float|None seconds the record is fresh, the default ttl
+        of the cache if None.
+        """
+        return self.put_entry(entry=CacheEntry(record=record), ttl=ttl)
+
+    @abstractmethod
+    def put_entry(self, entry, ttl=None):
+        """Records an entry to the cache, as put does
+        :param entry: CacheEntry
+        :param ttl: float|None
         """
         pass
 
@@ -34,6 +134,26 @@ class Cache(object):
         """
         pass
 
+    @abstractmethod
+    def get_entry(self, uid):
+        """Returns the entry of a cached record
+        :param uid: str
+        :return: CacheEntry
+        :raise RecordMissing
+        """
+        pass
+
+    @abstractmethod
+    def lookup(self, uid, now=None):
+        """Returns the entry of a cached record and its state: FRESH, STALE or
+        STALE_IF_ERROR. A record past all its windows or expired is missing.
+        :param uid: str
+        :param now: float|None current time.
+        :return: tuple (CacheEntry, str)
+        :raise RecordMissing
+        """
+        pass
+
     @abstractmethod
     def forget(self, **params):
         """Deletes a cache record
@@ -46,6 +166,14 @@ class Cache(object):
         """
         pass
 
+    @abstractmethod
+    def stats(self):
+        """Returns the counters of the cache: records, size, size_limit, hits,
+        misses and evictions.
+        :return: dict
+        """
+        pass
+
     def _enough_memory(self, record_size):
         """Checks if there is enough cache memory for the record size.
         :return bool
@@ -58,6 +186,27 @@ class Cache(object):
 
         return True
 
+    @abstractmethod
+    def dump(self):
+        """Returns the cached entries with the time they stop being fresh,
+        None if they do not, the next victims first.
+        :return: list of tuples (CacheEntry, float|None)
+        """
+        pass
+
+    @abstractmethod
+    def load(self, entries, now=None):
+        """Puts back dumped entries, the last ones first, while they fit into
+        the size limit. The entries which can not be served anymore and the
+        uids cached meanwhile are skipped. Returns the number of entries
+        loaded.
+        :param entries: list of tuples (CacheEntry, float|None), the next
+        victims first.
+        :param now: float|None current time.
+        :return: int
+        """
+        pass
+
     @abstractmethod
     def _exists(self, record):
         """Checks if the record already exists in buffer. If record already
@@ -82,45 +231,88 @@ class MemoryCache(Cache):
     """Class for cache management.
     """
 
-    def __init__(self, size_limit=UNLIMITED_MEMORY):
+    def __init__(self, size_limit=UNLIMITED_MEMORY, policy=None, ttl=None,
+                 stale_while_revalidate=0, stale_if_error=0):
         """Constructor
 
         :param size_limit: int maximum number of bytes of dedicated cache
         memory. If size_limit is -1, the memory is unlimited. If size_limit is 0
         the cache is disabled and does not allow get or put.
+        :param policy: EvictionPolicy choosing the evicted records, LRU by
+        default.
+        :param ttl: float|None seconds a record is fresh by default. None or
+        0 keeps the records fresh.
+        :param stale_while_revalidate: float seconds a record past its time
+        to live is served while it is refreshed.
+        :param stale_if_error: float seconds a record past its time to live
+        is served if it can not be refreshed.
         """
-        super(MemoryCache, self).__init__(size_limit=size_limit)
-        self._waiting_cache = Queue()
+        super(MemoryCache, self).__init__(
+            size_limit=size_limit,
+            policy=policy or LruPolicy(),
+            ttl=ttl,
+            stale_while_revalidate=stale_while_revalidate,
+            stale_if_error=stale_if_error)
         self._buffer_lock = RLock()
+        # uid -> time the record stops being fresh, None if it does not
+        self._fresh_until = dict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
 
     def is_enabled(self):
         return self._size_limit != DISABLED_MEMORY
 
-    def put(self, record):
+    def put_entry(self, entry, ttl=None):
         if not self.is_enabled():
             return None
 
-        if not self._enough_memory(record_size=record['size']):
+        if not self._enough_memory(record_size=entry.size):
             return False
 
-        if self._exists(record=record):
-            return False
+        uid = entry.record['uid']
+
+        self._buffer_lock.acquire()
 
-        self._waiting_cache.put(record)
+        try:
+            if self._exists(record=entry.record):
+                # a renewal of the same value, the entry takes its new fields
+                # such as expires_at, keeping its place into the policy
+                self._decrease_buffer_size(size=self._buffer[uid].size)
+                self._buffer[uid] = entry
+                self._increase_buffer_size(size=entry.size)
+                self.__set_fresh_until(uid=uid, ttl=ttl)
+                return False
 
-        while not self._waiting_cache.empty():
+            self.__append_cache(entry=entry)
+            self.__set_fresh_until(uid=uid, ttl=ttl)
 
-            record = self._waiting_cache.get()
-            self._free_memory(record_size=record['size'])
-            self.__append_cache(record=record)
+            return True
 
-        return True
+        finally:
+            self._buffer_lock.release()
 
     def get(self, **params):
         if not self.is_enabled():
             return None
 
-        return self.__get_cache(uid=params['uid'])
+        entry, state = self.__get_cache(uid=params['uid'])
+
+        return entry.record
+
+    def get_entry(self, uid):
+        if not self.is_enabled():
+            raise RecordMissing()
+
+        entry, state = self.__get_cache(uid=uid)
+
+        return entry
+
+    def lookup(self, uid, now=None):
+        if not self.is_enabled():
+            raise RecordMissing()
+
+        return self.__get_cache(uid=uid, now=now)
 
     def forget(self, **params):
         if not self.is_enabled():
@@ -128,38 +320,139 @@ class MemoryCache(Cache):
 
         return self.__forget_cache(uid=params['uid'])
 
-    def __append_cache(self, record):
-        """Appends a new record to the thread safe cache dictionary.
-        :param record: dict
+    def stats(self):
+        self._buffer_lock.acquire()
+
+        try:
+            return self._stats()
+
+        finally:
+            self._buffer_lock.release()
+
+    def dump(self):
+        self._buffer_lock.acquire()
+
+        try:
+            return [(self._buffer[uid], self._fresh_until.get(uid))
+                    for uid in self._policy.keys()]
+
+        finally:
+            self._buffer_lock.release()
+
+    def load(self, entries, now=None):
+        if not self.is_enabled():
+            return 0
+
+        now = now or time.time()
+        selected = []
+        size = 0
+
+        for entry, fresh_until in reversed(entries):
+            if self.__state(record=entry.record, fresh_until=fresh_until,
+                            now=now) is None:
+                continue
+
+            if self._size_limit != UNLIMITED_MEMORY and \
+                    size + entry.size > self._size_limit:
+                break
+
+            selected.append((entry, fresh_until))
+            size += entry.size
+
+        loaded = 0
+
+        self._buffer_lock.acquire()
+
+        try:
+            for entry, fresh_until in reversed(selected):
+                uid = entry.record['uid']
+
+                if uid in self._buffer:
+                    continue
+
+                self.__append_cache(entry=entry)
+                self._fresh_until[uid] = fresh_until
+                loaded += 1
+
+        finally:
+            self._buffer_lock.release()
+
+        return loaded
+
+    def _stats(self):
+        """Returns the counters of the cache, the caller holding the lock of
+        the buffer.
+        :return: dict
+        """
+        return {'records': len(self._buffer),
+                'size': self._buffer_size,
+                'size_limit': self._size_limit,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions}
+
+    def __append_cache(self, entry):
+        """Appends a new entry to the thread safe cache dictionary, freeing
+        the memory it needs. Replaces the previous entry of the uid.
+        :param entry: CacheEntry
         """
+        uid = entry.record['uid']
+
         self._buffer_lock.acquire()
 
         try:
-            self._buffer[record['uid']] = record
-            self._increase_buffer_size(size=record['size'])
+            previous = self._buffer.pop(uid, None)
+
+            if previous is not None:
+                self._decrease_buffer_size(size=previous.size)
+                self._policy.remove(key=uid)
+
+            self._free_memory(record_size=entry.size)
+
+            self._buffer[uid] = entry
+            self._increase_buffer_size(size=entry.size)
+            self._policy.add(key=uid)
 
         finally:
             self._buffer_lock.release()
 
         return True
 
-    def __get_cache(self, uid):
-        """Returns a record of the thread safe cache dictionary by uid.
+    def __get_cache(self, uid, now=None):
+        """Returns an entry of the thread safe cache dictionary by uid with
+        its state, and records the hit or the miss into the policy. A record
+        past all its windows is deleted.
         :param uid: str
+        :param now: float|None current time.
+        :return: tuple (CacheEntry, str)
         :raise RecordMissing
         """
         self._buffer_lock.acquire()
 
         try:
-            record = self._buffer[uid]
+            entry = self._buffer.get(uid)
+            state = None
 
-        except KeyError:
-            raise RecordMissing()
+            if entry is not None:
+                state = self.__state(record=entry.record,
+                                     fresh_until=self._fresh_until.get(uid),
+                                     now=now or time.time())
+
+                if state is None:
+                    self.__forget_cache(uid=uid)
+
+            if state is None:
+                self._policy.miss(key=uid)
+                self._misses += 1
+                raise RecordMissing()
+
+            self._policy.touch(key=uid)
+            self._hits += 1
 
         finally:
             self._buffer_lock.release()
 
-        return record
+        return entry, state
 
     def __forget_cache(self, uid):
         """Deletes a record of the thread safe cache dictionary by uid.
@@ -169,7 +462,10 @@ class MemoryCache(Cache):
         self._buffer_lock.acquire()
 
         try:
-            del self._buffer[uid]
+            entry = self._buffer.pop(uid)
+            self._decrease_buffer_size(size=entry.size)
+            self._policy.remove(key=uid)
+            self._fresh_until.pop(uid, None)
 
         except KeyError:
             raise RecordMissing()
@@ -177,27 +473,569 @@ class MemoryCache(Cache):
         finally:
             self._buffer_lock.release()
 
-    def _exists(self, record):
-        try:
-            existing = self.__get_cache(uid=record['uid'])
+    def __set_fresh_until(self, uid, ttl):
+        """Sets when a cached record stops being fresh, the caller holding
+        the lock of the buffer.
+        :param uid: str
+        :param ttl: float|None seconds, the default ttl of the cache if None.
+        """
+        if ttl is None:
+            ttl = self._ttl
 
-            if existing['check_sum'] == record['check_sum']:
-                return True
+        self._fresh_until[uid] = time.time() + ttl if ttl else None
 
-        except RecordMissing:
-            return False
+    def __state(self, record, fresh_until, now):
+        """Returns the state of a cached record, None if it can not be
+        served anymore. A record expired by its own time to live is never
+        served.
+        :param record: dict
+        :param fresh_until: float|None time the record stops being fresh.
+        :param now: float
+        :return: str|None
+        """
+        if RecordHelper.is_expired(record=record, now=now):
+            return None
+
+        if fresh_until is None or now < fresh_until:
+            return FRESH
+
+        if now < fresh_until + self._stale_while_revalidate:
+            return STALE
+
+        if now < fresh_until + self._stale_if_error:
+            return STALE_IF_ERROR
+
+        return None
+
+    def _exists(self, record):
+        existing = self._buffer.get(record['uid'])
+
+        if existing is not None and \
+                existing.record['check_sum'] == record['check_sum']:
+            return True
 
         return False
 
     def _free_memory(self, record_size):
-        """Removes items of cache until the memory of the cache is under the
-        maximum cache size.
+        """Removes the items of cache chosen by the policy until the memory
+        of the cache is under the maximum cache size.
 
         :param record_size: int
         """
-        while record_size + self._buffer_size > self._size_limit:
+        if self._size_limit == UNLIMITED_MEMORY:
+            return True
 
-            record_left = self._buffer.pop(self._buffer.keys()[0])
-            self._decrease_buffer_size(size=record_left['size'])
+        self._buffer_lock.acquire()
+
+        try:
+            while self._buffer and \
+                    record_size + self._buffer_size > self._size_limit:
+
+                uid = self._policy.victim()
+                entry_left = self._buffer.pop(uid)
+                self._fresh_until.pop(uid, None)
+                self._policy.evict(key=uid)
+                self._decrease_buffer_size(size=entry_left.size)
+                self._evictions += 1
+
+        finally:
+            self._buffer_lock.release()
 
         return True
+
+
+class ShardedMemoryCache(Cache):
+    """Memory cache partitioning the uids across segments, every one with its
+    own lock, share of the size and eviction policy, so the threads reading
+    or writing different uids seldom wait for each other.
+    """
+
+    def __init__(self, size_limit=UNLIMITED_MEMORY,
+                 shards=DEFAULT_CACHE_SHARDS, policy_class=LruPolicy,
+                 ttl=None, stale_while_revalidate=0, stale_if_error=0):
+        """Constructor
+
+        :param size_limit: int maximum number of bytes of dedicated cache
+        memory, split evenly across the segments. A record bigger than the
+        share of its segment is not cached. If size_limit is -1, the memory
+        is unlimited. If size_limit is 0 the cache is disabled.
+        :param shards: int number of segments, at most the size limit.
+        :param policy_class: EvictionPolicy class, instantiated per segment.
+        :param ttl: float|None seconds a record is fresh by default.
+        :param stale_while_revalidate: float seconds a record past its time
+        to live is served while it is refreshed.
+        :param stale_if_error: float seconds a record past its time to live
+        is served if it can not be refreshed.
+        """
+        super(ShardedMemoryCache, self).__init__(
+            size_limit=size_limit,
+            ttl=ttl,
+            stale_while_revalidate=stale_while_revalidate,
+            stale_if_error=stale_if_error)
+
+        if size_limit > 0:
+            shards = min(shards, size_limit)
+
+        self._shards = [
+            MemoryCache(size_limit=self.__shard_limit(index=index,
+                                                      shards=shards),
+                        policy=policy_class(),
+                        ttl=ttl,
+                        stale_while_revalidate=stale_while_revalidate,
+                        stale_if_error=stale_if_error)
+            for index in xrange(shards)]
+
+    def is_enabled(self):
+        return self._size_limit != DISABLED_MEMORY
+
+    def put_entry(self, entry, ttl=None):
+        return self.__shard(uid=entry.record['uid']).put_entry(entry=entry,
+                                                                ttl=ttl)
+
+    def get(self, **params):
+        return self.__shard(uid=params['uid']).get(**params)
+
+    def get_entry(self, uid):
+        return self.__shard(uid=uid).get_entry(uid=uid)
+
+    def lookup(self, uid, now=None):
+        return self.__shard(uid=uid).lookup(uid=uid, now=now)
+
+    def forget(self, **params):
+        return self.__shard(uid=params['uid']).forget(**params)
+
+    def stats(self):
+        """Returns the counters summed across the segments, holding the locks
+        of all of them so the sums match a single point in time.
+        :return: dict
+        """
+        acquired = []
+
+        try:
+            for shard in self._shards:
+                shard._buffer_lock.acquire()
+                acquired.append(shard)
+
+            totals = {'records': 0,
+                      'size': 0,
+                      'size_limit': self._size_limit,
+                      'hits': 0,
+                      'misses': 0,
+                      'evictions': 0}
+
+            for shard in self._shards:
+                for name, value in shard._stats().iteritems():
+                    if name != 'size_limit':
+                        totals[name] += value
+
+            return totals
+
+        finally:
+            for shard in reversed(acquired):
+                shard._buffer_lock.release()
+
+    def dump(self):
+        """Returns the entries of every segment in turn, the next victims of
+        a segment first.
+        :return: list of tuples (CacheEntry, float|None)
+        """
+        entries = []
+
+        for shard in self._shards:
+            entries.extend(shard.dump())
+
+        return entries
+
+    def load(self, entries, now=None):
+        shard_entries = [[] for shard in self._shards]
+
+        for entry, fresh_until in entries:
+            index = self.__shard_index(uid=entry.record['uid'])
+            shard_entries[index].append((entry, fresh_until))
+
+        return sum(shard.load(entries=shard_entries[index], now=now)
+                   for index, shard in enumerate(self._shards))
+
+    def _exists(self, record):
+        return self.__shard(uid=record['uid'])._exists(record=record)
+
+    def __shard(self, uid):
+        """
+        :param uid: str
+        :return: MemoryCache
+        """
+        return self._shards[self.__shard_index(uid=uid)]
+
+    def __shard_index(self, uid):
+        """
+        :param uid: str
+        :return: int
+        """
+        return hash(uid) % len(self._shards)
+
+    def __shard_limit(self, index, shards):
+        """Returns the size limit of a segment, the remainder of the split
+        going to the first segments.
+        :param index: int
+        :param shards: int
+        :return: int
+        """
+        if self._size_limit <= 0:
+            return self._size_limit
+
+        share, remainder = divmod(self._size_limit, shards)
+
+        return share + (1 if index < remainder else 0)
+
+
+class NegativeCache(object):
+    """Bounded cache of the uids confirmed missing, remembered for a short
+    time so the reads of absent uids do not reach all the dependant servers
+    again. The least recently added uids are dropped first.
+    """
+
+    def __init__(self, size_limit=DEFAULT_NEGATIVE_SIZE,
+                 ttl=DEFAULT_NEGATIVE_TTL):
+        """Constructor
+
+        :param size_limit: int maximum number of uids.
+        :param ttl: float seconds a uid is remembered.
+        """
+        self._size_limit = size_limit
+        self._ttl = ttl
+        # uid -> time it is forgotten, the oldest first
+        self._uids = OrderedDict()
+        self._lock = RLock()
+        self._hits = 0
+        self._misses = 0
+
+    def add(self, uid, now=None):
+        """Remembers a missing uid
+        :param uid: str
+        :param now: float|None current time.
+        """
+        self._lock.acquire()
+
+        try:
+            self._uids.pop(uid, None)
+            self._uids[uid] = (now or time.time()) + self._ttl
+
+            while len(self._uids) > self._size_limit:
+                self._uids.popitem(last=False)
+
+        finally:
+            self._lock.release()
+
+    def contains(self, uid, now=None):
+        """Checks if a uid is known missing, and counts the hit or the miss
+        :param uid: str
+        :param now: float|None current time.
+        :return: bool
+        """
+        self._lock.acquire()
+
+        try:
+            until = self._uids.get(uid)
+
+            if until is not None and until <= (now or time.time()):
+                del self._uids[uid]
+                until = None
+
+            if until is None:
+                self._misses += 1
+                return False
+
+            self._hits += 1
+            return True
+
+        finally:
+            self._lock.release()
+
+    def forget(self, uid):
+        """Forgets a uid, written since it was missing
+        :param uid: str
+        """
+        self._lock.acquire()
+
+        try:
+            self._uids.pop(uid, None)
+
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns the counters of the cache: uids, size_limit, hits and
+        misses.
+        :return: dict
+        """
+        self._lock.acquire()
+
+        try:
+            return {'uids': len(self._uids),
+                    'size_limit': self._size_limit,
+                    'hits': self._hits,
+                    'misses': self._misses}
+
+        finally:
+            self._lock.release()
+
+
+class SingleFlight(object):
+    """Coalesces the concurrent calls of the same key: the first caller runs
+    the function, and the callers arriving while it runs wait for its result
+    or its exception instead of running the function again.
+    """
+
+    def __init__(self):
+        # key -> Flight of the running call
+        self._flights = dict()
+        self._lock = Lock()
+
+    def do(self, key, function):
+        """Returns the result of the function, run once for all the
+        concurrent callers of the key. Raises the exception of the function
+        to all of them.
+        :param key: str
+        :param function: callable without arguments.
+        :return: object
+        """
+        self._lock.acquire()
+
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+
+        finally:
+            self._lock.release()
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.result = function()
+
+        except Exception:
+            flight.error = sys.exc_info()
+
+        finally:
+            self._lock.acquire()
+
+            try:
+                del self._flights[key]
+
+            finally:
+                self._lock.release()
+
+            flight.done.set()
+
+        return flight.wait()
+
+
+class Flight(object):
+    """Result of a call shared with the callers waiting for it"""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        # sys.exc_info() of the exception of the call
+        self.error = None
+
+    def wait(self):
+        """Waits for the call and returns its result or raises its exception
+        :return: object
+        """
+        self.done.wait()
+
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+        return self.result
+
+
+class ChecksumMap(object):
+    """Bounded map of the uids to the check sums of their records and the
+    time they expire, answering the conditional requests without reading
+    the records. The least recently set uids are dropped first.
+    """
+
+    def __init__(self, size_limit=DEFAULT_CHECKSUM_MAP_SIZE):
+        """Constructor
+
+        :param size_limit: int maximum number of uids.
+        """
+        self._size_limit = size_limit
+        # uid -> tuple (check sum, expires_at or None), the oldest first
+        self._versions = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, uid):
+        """Returns the check sum and the expiry time of a record
+        :param uid: str
+        :return: tuple (int, float|None)
+        :raise KeyError
+        """
+        return self._versions[uid]
+
+    def put(self, record, replace=True):
+        """Sets the check sum of a written or read record
+        :param record: dict
+        :param replace: bool. False keeps the check sum already set, so a
+        record read before a write does not replace the written one.
+        """
+        self._lock.acquire()
+
+        try:
+            if not replace and record['uid'] in self._versions:
+                return
+
+            self._versions.pop(record['uid'], None)
+            self._versions[record['uid']] = (record['check_sum'],
+                                             record.get('expires_at'))
+
+            while len(self._versions) > self._size_limit:
+                self._versions.popitem(last=False)
+
+        finally:
+            self._lock.release()
+
+    def forget(self, uid):
+        """Forgets a uid, deleted or written without a known check sum
+        :param uid: str
+        """
+        self._lock.acquire()
+
+        try:
+            self._versions.pop(uid, None)
+
+        finally:
+            self._lock.release()
+
+
+class CacheSnapshot(object):
+    """
+    Entries of a cache and their eviction order saved into a local file by a
+    background job, and loaded at startup so a restarted node serves its hot
+    records at once. The encoded bodies of the entries are written out of
+    the locks of the cache, one line per entry.
+    """
+
+    def __init__(self, cache, base_path, name,
+                 interval=DEFAULT_SNAPSHOT_INTERVAL):
+        """
+        Constructor
+
+        :param cache: Cache
+        :param base_path: str directory with the snapshot directory.
+        :param name: str name of the snapshot of the cache.
+        :param interval: float seconds between snapshots. 0 disables the job.
+        """
+        self._cache = cache
+        self._path = '{!s}/{!s}'.format(base_path, CACHE_SNAPSHOT_DIR)
+        self._file_path = self.__format_path(base_path=base_path, name=name)
+        self._interval = interval
+        self._lock = Lock()
+        self._closed = False
+
+        try:
+            os.makedirs(self._path)
+
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        if self._interval:
+            saver = Thread(target=self._save_loop)
+            saver.daemon = True
+            saver.start()
+
+    @classmethod
+    def exists(cls, base_path, name):
+        """
+        Checks if a cache has a snapshot
+        :param base_path: str
+        :param name: str
+        :return: bool
+        """
+        return Helpers.path_exists(cls.__format_path(base_path=base_path,
+                                                     name=name))
+
+    def save(self):
+        """
+        Writes the entries of the cache atomically, and returns their number
+        :return: int
+        """
+        self._lock.acquire()
+
+        try:
+            entries = self._cache.dump()
+            handle, temp_path = tempfile.mkstemp(dir=self._path)
+
+            with os.fdopen(handle, 'wb') as target:
+                for entry, fresh_until in entries:
+                    target.write('[{!s}, {!s}]\n'.format(
+                        json.dumps(fresh_until), entry.body))
+
+            os.rename(temp_path, self._file_path)
+
+            return len(entries)
+
+        finally:
+            self._lock.release()
+
+    def load(self, now=None):
+        """
+        Puts the entries of the snapshot, if any, into the cache within its
+        size limit, and returns the number of entries loaded. A partial last
+        line is dropped.
+        :param now: float|None current time.
+        :return: int
+        """
+        entries = []
+
+        try:
+            with open(self._file_path, 'rb') as source:
+                for line in source:
+                    try:
+                        fresh_until, record = json.loads(line)
+
+                    except ValueError:
+                        break
+
+                    entries.append((CacheEntry(record=record), fresh_until))
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+        return self._cache.load(entries=entries, now=now)
+
+    def close(self):
+        """
+        Stops the background job and takes a last snapshot
+        """
+        self._closed = True
+        self.save()
+
+    def _save_loop(self):
+        """
+        Background job saving the snapshots
+        """
+        while not self._closed:
+            time.sleep(self._interval)
+
+            if not self._closed:
+                self.save()
+
+    @classmethod
+    def __format_path(cls, base_path, name):
+        """
+        :param base_path: str
+        :param name: str
+        :return: str
+        """
+        return '{!s}/{!s}/{!s}.snapshot'.format(base_path, CACHE_SNAPSHOT_DIR,
+                                                name)
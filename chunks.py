@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""Large record values stored in chunks
+"""
+import codecs
+import errno
+import os
+import shutil
+import uuid
+
+import sys
+sys.path.append('..')
+
+from minstore.helpers import Helpers
+
+CHUNKS_DIR = '.chunks'
+
+# Bytes of every chunk file but the last one of a value
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+# Values longer than this bytes are stored in chunks
+DEFAULT_CHUNK_THRESHOLD = 1024 * 1024
+
+# Bytes read or written at once while streaming a value
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Hexadecimal characters of the id naming the subdirectory of a value
+CHUNK_SHARD_WIDTH = 2
+
+
+class ChunkedValue(object):
+    """Value stored in chunk files, referenced by a record"""
+
+    def __init__(self, chunk_id, length, chunk_size):
+        """
+        Constructor
+
+        :param chunk_id: str id of the directory of the chunks.
+        :param length: int bytes of the value.
+        :param chunk_size: int bytes of every chunk.
+        """
+        self.chunk_id = chunk_id
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def dumps(self):
+        """
+        Returns the fields persisted into the record
+        :return: dict
+        """
+        return {'id': self.chunk_id,
+                'length': self.length,
+                'chunk_size': self.chunk_size}
+
+    @classmethod
+    def loads(cls, fields):
+        """
+        Returns the value of the persisted fields
+        :param fields: dict
+        :return: ChunkedValue
+        """
+        return cls(chunk_id=fields['id'],
+                   length=fields['length'],
+                   chunk_size=fields['chunk_size'])
+
+
+class ChunkStore(object):
+    """
+    Chunk files of the large values of a base path. Every written value gets
+    a new directory, so a value is never changed in place.
+    """
+
+    def __init__(self, base_path, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Constructor
+
+        :param base_path: str directory with the chunks directory.
+        :param chunk_size: int bytes of every chunk file.
+        """
+        self._path = '{!s}/{!s}'.format(base_path, CHUNKS_DIR)
+        self._chunk_size = chunk_size
+
+    def write(self, stream, length):
+        """
+        Writes the value read from a stream into chunk files, reading a block
+        at once. Raises ValueError if the stream is shorter than the length
+        or it is not UTF-8 text.
+        :param stream: file
+        :param length: int bytes to read
+        :return: ChunkedValue
+        """
+        value = ChunkedValue(chunk_id=uuid.uuid4().hex,
+                             length=length,
+                             chunk_size=self._chunk_size)
+        dir_path = self.__format_dir_path(value.chunk_id)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+
+        os.makedirs(dir_path)
+
+        try:
+            remaining = length
+            index = 0
+
+            while remaining or not index:
+                chunk_length = min(remaining, self._chunk_size)
+
+                with open('{!s}/{:d}'.format(dir_path, index), 'wb') as chunk:
+                    while chunk_length:
+                        block = stream.read(min(chunk_length,
+                                                STREAM_BLOCK_SIZE))
+
+                        if not block:
+                            raise ValueError('Value shorter than its length')
+
+                        decoder.decode(block)
+                        chunk.write(block)
+                        chunk_length -= len(block)
+                        remaining -= len(block)
+
+                index += 1
+
+            decoder.decode('', final=True)
+
+        except Exception:
+            shutil.rmtree(dir_path, ignore_errors=True)
+            raise
+
+        return value
+
+    def read(self, value, start=0, end=None):
+        """
+        Yields the bytes of a value from start to end, end excluded, reading
+        a block at once
+        :param value: ChunkedValue
+        :param start: int
+        :param end: int|None
+        :return: generator
+        """
+        if end is None or end > value.length:
+            end = value.length
+
+        dir_path = self.__format_dir_path(value.chunk_id)
+        position = start
+
+        while position < end:
+            index, offset = divmod(position, value.chunk_size)
+
+            with open('{!s}/{:d}'.format(dir_path, index), 'rb') as chunk:
+                chunk.seek(offset)
+                chunk_end = min(end - index * value.chunk_size,
+                                value.chunk_size)
+
+                while offset < chunk_end:
+                    block = chunk.read(min(chunk_end - offset,
+                                           STREAM_BLOCK_SIZE))
+
+                    if not block:
+                        raise IOError(errno.EIO,
+                                      'Chunk {!s}/{:d} is truncated'.format(
+                                          value.chunk_id, index))
+
+                    offset += len(block)
+                    position += len(block)
+
+                    yield block
+
+    def remove(self, value):
+        """
+        Removes the chunk files of a value
+        :param value: ChunkedValue
+        """
+        dir_path = self.__format_dir_path(value.chunk_id)
+
+        if Helpers.path_exists(dir_path):
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+    def __format_dir_path(self, chunk_id):
+        """
+        :param chunk_id: str
+        :return: str
+        """
+        return '{!s}/{!s}/{!s}'.format(self._path,
+                                       chunk_id[:CHUNK_SHARD_WIDTH],
+                                       chunk_id)
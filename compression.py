@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""Compression of the record values
+"""
+from collections import Counter
+import errno
+import os
+import tempfile
+import time
+import zlib
+from threading import RLock
+
+import sys
+sys.path.append('..')
+
+from minstore.helpers import Helpers
+
+# Codecs of a record value
+PLAIN_CODEC = 0
+ZLIB_CODEC = 1
+DICTIONARY_CODEC = 2
+
+# Values shorter than this bytes are not compressed
+DEFAULT_COMPRESSION_THRESHOLD = 256
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Bytes of a trained dictionary. Deflate does not look back further than
+# 32 KB.
+DEFAULT_DICTIONARY_SIZE = 32 * 1024
+
+# Longest phrase of words counted when training a dictionary
+MAX_PHRASE_WORDS = 4
+
+# Seconds between two checks of the current dictionary of a base path
+DICTIONARY_RELOAD_INTERVAL = 60
+
+DICTIONARIES_DIR = '.dictionaries'
+CURRENT_DICTIONARY = 'current'
+DICTIONARY_SUFFIX = '.zdict'
+
+
+class Compressor(object):
+    """
+    Compresses the values over a size threshold with zlib, primed with the
+    current dictionary of the base path if any.
+
+    The zlib module of Python 2 does not take preset dictionaries, so a
+    dictionary is compressed once into a stream flushed to a byte boundary
+    and every value is compressed by a copy of that stream. Only the output
+    after the dictionary is stored, and it is decompressed by a copy of a
+    stream which already decompressed the dictionary.
+    """
+
+    def __init__(self, base_path, threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 level=DEFAULT_COMPRESSION_LEVEL, dictionary=True):
+        """
+        Constructor
+
+        :param base_path: str directory with the dictionaries directory.
+        :param threshold: int minimum bytes of a compressed value.
+        :param level: int zlib compression level.
+        :param dictionary: bool. If True the values are compressed with the
+        current trained dictionary, if any.
+        """
+        self._dictionaries = DictionaryStore(base_path=base_path)
+        self._threshold = threshold
+        self._level = level
+        self._use_dictionary = dictionary
+        self._lock = RLock()
+        # dictionary id -> primed compress and decompress streams
+        self._compressors = dict()
+        self._decompressors = dict()
+        self._current_id = None
+        self._current_checked = 0
+
+    def compress(self, value):
+        """
+        Returns the codec, the dictionary id and the payload of a value.
+        Values under the threshold or not getting smaller are kept plain.
+        :param value: str
+        :return: tuple
+        """
+        if len(value) < self._threshold:
+            return PLAIN_CODEC, None, value
+
+        dictionary_id = self._current_dictionary_id()
+
+        if dictionary_id is None:
+            codec = ZLIB_CODEC
+            payload = zlib.compress(value, self._level)
+
+        else:
+            codec = DICTIONARY_CODEC
+            stream = self._primed_compressor(dictionary_id).copy()
+            payload = stream.compress(value) + stream.flush()
+
+        if len(payload) >= len(value):
+            return PLAIN_CODEC, None, value
+
+        return codec, dictionary_id, payload
+
+    def decompress(self, codec, dictionary_id, payload):
+        """
+        Returns the value of a compressed payload
+        :param codec: int
+        :param dictionary_id: int|None
+        :param payload: str
+        :return: str
+        """
+        if codec == PLAIN_CODEC:
+            return payload
+
+        if codec == ZLIB_CODEC:
+            return zlib.decompress(payload)
+
+        if codec == DICTIONARY_CODEC:
+            stream = self._primed_decompressor(dictionary_id).copy()
+            return stream.decompress(payload) + stream.flush()
+
+        raise ValueError('Unknown codec {!s}'.format(codec))
+
+    @classmethod
+    def decompress_plain(cls, codec, dictionary_id, payload):
+        """
+        Decompresses without a base path, for the records not compressed
+        with a dictionary.
+        :param codec: int
+        :param dictionary_id: int|None
+        :param payload: str
+        :return: str
+        """
+        if codec == PLAIN_CODEC:
+            return payload
+
+        if codec == ZLIB_CODEC:
+            return zlib.decompress(payload)
+
+        raise ValueError('A dictionary is required by codec {!s}'
+                         .format(codec))
+
+    def _current_dictionary_id(self):
+        """
+        Returns the id of the current dictionary, reloaded periodically so a
+        retrained dictionary is taken without restarting.
+        :return: int|None
+        """
+        if not self._use_dictionary:
+            return None
+
+        now = time.time()
+
+        if now - self._current_checked >= DICTIONARY_RELOAD_INTERVAL:
+            self._current_id = self._dictionaries.current_id()
+            self._current_checked = now
+
+        return self._current_id
+
+    def _primed_compressor(self, dictionary_id):
+        """
+        Returns the compress stream which already consumed a dictionary
+        :param dictionary_id: int
+        :return: zlib.Compress
+        """
+        self._lock.acquire()
+
+        try:
+            if dictionary_id not in self._compressors:
+                dictionary = self._dictionaries.load(dictionary_id)
+                stream = zlib.compressobj(self._level)
+                stream.compress(dictionary)
+                stream.flush(zlib.Z_SYNC_FLUSH)
+                self._compressors[dictionary_id] = stream
+
+            return self._compressors[dictionary_id]
+
+        finally:
+            self._lock.release()
+
+    def _primed_decompressor(self, dictionary_id):
+        """
+        Returns the decompress stream which already consumed a dictionary
+        :param dictionary_id: int
+        :return: zlib.Decompress
+        """
+        self._lock.acquire()
+
+        try:
+            if dictionary_id not in self._decompressors:
+                dictionary = self._dictionaries.load(dictionary_id)
+                prefix = zlib.compressobj(self._level)
+                content = prefix.compress(dictionary)
+                content += prefix.flush(zlib.Z_SYNC_FLUSH)
+                stream = zlib.decompressobj()
+                stream.decompress(content)
+                self._decompressors[dictionary_id] = stream
+
+            return self._decompressors[dictionary_id]
+
+        finally:
+            self._lock.release()
+
+
+class DictionaryStore(object):
+    """
+    Trained dictionaries of a base path. The dictionaries are never removed
+    while a record may be compressed with them.
+    """
+
+    def __init__(self, base_path):
+        self._path = '{!s}/{!s}'.format(base_path, DICTIONARIES_DIR)
+
+    def current_id(self):
+        """
+        Returns the id of the current dictionary or None if there is no one
+        :return: int|None
+        """
+        try:
+            with open(self.__format_path(CURRENT_DICTIONARY), 'rb') as current:
+                return int(current.read().strip(), 16)
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+        return None
+
+    def load(self, dictionary_id):
+        """
+        Returns the content of a dictionary
+        :param dictionary_id: int
+        :return: str
+        """
+        file_path = self.__format_path(
+            '{:08x}{!s}'.format(dictionary_id, DICTIONARY_SUFFIX))
+
+        with open(file_path, 'rb') as dictionary:
+            return dictionary.read()
+
+    def save(self, dictionary):
+        """
+        Stores a dictionary and makes it the current one. Returns its id.
+        :param dictionary: str
+        :return: int
+        """
+        dictionary_id = zlib.crc32(dictionary) & 0xffffffff
+
+        if not Helpers.path_exists(self._path):
+            os.makedirs(self._path)
+
+        self.__write(filename='{:08x}{!s}'.format(dictionary_id,
+                                                  DICTIONARY_SUFFIX),
+                     content=dictionary)
+        self.__write(filename=CURRENT_DICTIONARY,
+                     content='{:08x}'.format(dictionary_id))
+
+        return dictionary_id
+
+    @classmethod
+    def train(cls, samples, size=DEFAULT_DICTIONARY_SIZE):
+        """
+        Builds a dictionary with the phrases repeated the most within the
+        sample values. The most valuable phrases are placed at the end, the
+        nearest to the compressed values.
+        :param samples: list of str
+        :param size: int maximum bytes of the dictionary
+        :return: str
+        """
+        counts = Counter()
+
+        for sample in samples:
+            words = sample.split(' ')
+
+            for length in range(1, MAX_PHRASE_WORDS + 1):
+                for start in range(len(words) - length + 1):
+                    counts[' '.join(words[start:start + length]) + ' '] += 1
+
+        phrases = sorted(((count * len(phrase), phrase)
+                          for phrase, count in counts.iteritems()
+                          if count > 1),
+                         reverse=True)
+
+        chosen = list()
+        content = ''
+
+        for score, phrase in phrases:
+            if len(content) + len(phrase) > size or phrase in content:
+                continue
+
+            chosen.append(phrase)
+            content += phrase
+
+        return ''.join(reversed(chosen))
+
+    def __write(self, filename, content):
+        """
+        Writes atomically a file of the dictionaries directory
+        :param filename: str
+        :param content: str
+        """
+        handle, temp_path = tempfile.mkstemp(dir=self._path)
+
+        with os.fdopen(handle, 'wb') as target:
+            target.write(content)
+
+        os.rename(temp_path, self.__format_path(filename))
+
+    def __format_path(self, filename):
+        """
+        :param filename: str
+        :return: str
+        """
+        return '{!s}/{!s}'.format(self._path, filename)
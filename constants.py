@@ -8,7 +8,185 @@ MIRROR_MODE = 'mirror'
 BRIDGE_MODE = 'bridge'
 CACHE_MODE = 'cache'
 
+# Query parameter reading or writing the value of a text as the raw body
+RAW_MODE = 'raw'
+
+# Header with the record but the value of a raw mirror write
+RECORD_HEADER = 'X-Minstore-Record'
+
 # Maximum length of the total strings of the items into a record.
 # Set to 0 to disable cache feature.
 # Set to -1 for unlimited cache length.
 MAX_CACHE_SIZE_LEN = 2048
+
+# Bytes of the cache of the local texts read and written, on every node.
+# Set to 0 to disable it.
+RECORD_CACHE_SIZE = 16 * 1024 * 1024
+
+# Uids of the local texts which check sums are kept in memory, answering the
+# conditional requests without reading the texts. Set to 0 to disable it.
+CHECKSUM_MAP_SIZE = 100000
+
+# Eviction policies of the cache
+LRU_POLICY = 'lru'
+LFU_POLICY = 'lfu'
+ARC_POLICY = 'arc'
+TINYLFU_POLICY = 'tinylfu'
+
+# Policy choosing the records evicted from the caches. 'arc' and 'tinylfu'
+# keep the hot records through scans of records read once.
+CACHE_POLICY = LRU_POLICY
+
+# Independently locked segments of the caches, every one holding an even share
+# of the size of its cache. More segments let concurrent requests wait less on
+# each other, but a record bigger than a share is not cached.
+CACHE_SHARDS = 1
+
+# Seconds a cached record is fresh. Set to 0 to keep the records fresh until
+# they are evicted, changed or deleted.
+CACHE_TTL = 0
+
+# Seconds a cached record past its ttl is still served while a single
+# background request refreshes it from the dependant servers
+CACHE_STALE_WHILE_REVALIDATE = 0
+
+# Seconds a cached record past its ttl is still served when the dependant
+# servers fail to refresh it
+CACHE_STALE_IF_ERROR = 0
+
+# Uids confirmed missing by all the dependant servers remembered at most, and
+# seconds they are answered missing without asking them again. The writes of a
+# uid forget it. Set the size to 0 to disable the negative cache.
+NEGATIVE_CACHE_SIZE = 10000
+NEGATIVE_CACHE_TTL = 1.0
+
+# Seconds between the snapshots of the cache mode cache into BASE_PATH/.cache,
+# loaded when the server starts so it does not start cold. Set to 0 to disable
+# them.
+CACHE_SNAPSHOT_INTERVAL = 60.0
+
+# Set to True on the first endpoint of the Cache strategy, so it starts in
+# cache mode: its cache is created before it listens. A node with a snapshot
+# of its cache starts in cache mode too.
+CACHE_NODE = False
+
+# Uids loaded into the caches when the server starts, after the snapshots. In
+# cache mode they are read from the dependant servers.
+CACHE_PINNED_UIDS = []
+
+# Records per page of the listing, by default and at most
+LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+
+# Stores every distinct value once, shared by the records holding it. The
+# mirrors send the digest of a value before the value itself, so enable it on
+# all the nodes. Run "tools.py recount" to free leaked values.
+DEDUP = False
+
+# Stores the values longer than CHUNK_THRESHOLD bytes into chunk files of
+# CHUNK_SIZE bytes, so the raw reads and writes of them stream by blocks.
+CHUNKED = False
+CHUNK_SIZE = 256 * 1024
+CHUNK_THRESHOLD = 1024 * 1024
+
+# Answers the writes before they are on disk: they wait into a buffer of at
+# most WRITE_BEHIND_MAX_RECORDS, the writes of a text replacing its previous
+# pending one, and a background thread flushes them when
+# WRITE_BEHIND_FLUSH_RECORDS are pending or the oldest one is
+# WRITE_BEHIND_MAX_AGE seconds old. Those seconds of writes are lost on a
+# crash; the buffer is drained on a clean shutdown.
+WRITE_BEHIND = False
+WRITE_BEHIND_MAX_RECORDS = 1000
+WRITE_BEHIND_FLUSH_RECORDS = 100
+WRITE_BEHIND_MAX_AGE = 0.05
+
+# Record fields indexed for the queries of /text/_index/<field>. The hash
+# indexes answer equality queries and the sorted indexes numeric ranges.
+HASH_INDEXES = ['lang']
+SORTED_INDEXES = ['timestamp']
+
+# Changes of the indexes journaled before writing a new snapshot
+INDEX_SNAPSHOT_INTERVAL = 10000
+
+# Full text search of /text/_search over the local record values
+SEARCH_INDEX = True
+
+# Texts indexed into memory before writing them as a new segment of the
+# search index, and segments before merging them
+SEARCH_DELTA_LIMIT = 1000
+SEARCH_MAX_SEGMENTS = 8
+
+# Default number of results of a search
+SEARCH_LIMIT = 10
+
+# Timer wheel of the deadlines of the texts written with a ttl parameter:
+# seconds per tick, slots per level and levels
+EXPIRY_RESOLUTION = 1.0
+EXPIRY_WHEEL_SLOTS = 64
+EXPIRY_WHEEL_LEVELS = 4
+
+# Changes of the expiry schedule journaled before writing a new snapshot
+EXPIRY_SNAPSHOT_INTERVAL = 10000
+
+# Seconds between sweeps of the expired texts, 0 to disable it, and texts
+# deleted per batch. The expired texts are hidden until they are swept.
+EXPIRY_SWEEP_INTERVAL = 1.0
+EXPIRY_SWEEP_BATCH = 100
+
+# Results of the items of a batch
+CREATED = 'created'
+EXISTS = 'exists'
+MISSING = 'missing'
+DELETED = 'deleted'
+
+# Storage engines
+FILE_ENGINE = 'file'
+LOG_ENGINE = 'log'
+SQLITE_ENGINE = 'sqlite'
+
+# Storage engine used by the models. See the engines above.
+STORAGE_ENGINE = FILE_ENGINE
+
+# Levels of nested subdirectories of the FileStorage engine. The records are
+# spread by the hash of their uid. Set to 0 to store all the files into the
+# BASE_PATH. Run "tools.py rehash" to move an existing BASE_PATH.
+FILE_SHARD_LEVELS = 0
+
+# Hexadecimal characters of the uid hash per level. 2 are 256 directories.
+FILE_SHARD_WIDTH = 2
+
+# Write durability of the FileStorage and LogStorage engines:
+# 'atomic': writes a temporary file and renames it over the record, or appends
+# the whole record to the segment.
+# 'fsync': as atomic, syncing every write to disk before the response.
+# 'group': as fsync, sharing the syncs of the writes within a time window.
+FILE_DURABILITY = 'atomic'
+
+# Seconds the group durability waits for more writes to sync them together
+FILE_GROUP_COMMIT_WINDOW = 0.002
+
+# Record formats of the FileStorage engine
+JSON_FORMAT = 'json'
+BINARY_FORMAT = 'binary'
+
+# Format of the new record files. The binary format reads the JSON records of
+# an existing BASE_PATH too.
+RECORD_FORMAT = JSON_FORMAT
+
+# Compression of the record values. Requires and implies the binary format.
+COMPRESSION = False
+
+# Values shorter than this bytes are stored plain
+COMPRESSION_THRESHOLD = 256
+
+# zlib compression level, from 1 (fastest) to 9 (smallest)
+COMPRESSION_LEVEL = 6
+
+# Compress with the dictionary trained by "tools.py retrain", if any
+COMPRESSION_DICTIONARY = True
+
+# Default number of records sampled to train a compression dictionary
+DICTIONARY_SAMPLES = 1000
+
+# Niceness added to the "tools.py recompress" process
+RECOMPRESS_NICENESS = 10
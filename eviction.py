@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+"""Eviction policies of the caches
+"""
+from abc import ABCMeta, abstractmethod
+from array import array
+from collections import OrderedDict
+
+import sys
+sys.path.append('..')
+
+from minstore.constants import ARC_POLICY, LFU_POLICY, LRU_POLICY
+from minstore.constants import TINYLFU_POLICY
+
+# Counters per row of a count-min sketch, and rows
+DEFAULT_SKETCH_WIDTH = 4096
+DEFAULT_SKETCH_DEPTH = 4
+
+# Highest value of a counter of a count-min sketch
+SKETCH_MAX_COUNT = 15
+
+# Accesses counted by a W-TinyLFU policy per cached key before the counts
+# are halved, so the old accesses weigh less than the new ones
+SKETCH_SAMPLE_FACTOR = 10
+
+# Share of the keys of a W-TinyLFU cache into its window, and share of its
+# main keys protected from eviction
+DEFAULT_WINDOW_RATIO = 0.01
+DEFAULT_PROTECTED_RATIO = 0.8
+
+
+class EvictionPolicy(object):
+    """
+    Policy choosing the keys evicted from a cache. The cache tells the
+    policy about its keys and asks it for a victim while it is over its
+    size.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def add(self, key):
+        """
+        Records a key added to the cache
+        :param key: str
+        """
+        pass
+
+    @abstractmethod
+    def touch(self, key):
+        """
+        Records a hit of a cached key
+        :param key: str
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, key):
+        """
+        Forgets a key removed from the cache
+        :param key: str
+        """
+        pass
+
+    @abstractmethod
+    def victim(self):
+        """
+        Returns the key to evict next, without removing it. The cache calls
+        evict with it.
+        :return: str
+        """
+        pass
+
+    @abstractmethod
+    def keys(self):
+        """
+        Returns the keys of the cache, the next victims first, so the keys
+        added again in this order rank about the same
+        :return: list
+        """
+        pass
+
+    def evict(self, key):
+        """
+        Records a key evicted from the cache
+        :param key: str
+        """
+        self.remove(key=key)
+
+    def miss(self, key):
+        """
+        Records a miss of a key not cached
+        :param key: str
+        """
+        pass
+
+
+class LruPolicy(EvictionPolicy):
+    """Evicts the least recently used key"""
+
+    def __init__(self):
+        # key -> None, the least recently used first
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        self._keys[key] = None
+
+    def touch(self, key):
+        if key in self._keys:
+            del self._keys[key]
+            self._keys[key] = None
+
+    def remove(self, key):
+        self._keys.pop(key, None)
+
+    def victim(self):
+        return next(iter(self._keys))
+
+    def keys(self):
+        return list(self._keys)
+
+
+class LfuPolicy(EvictionPolicy):
+    """Evicts the least frequently used key, the least recently used one
+    among the keys of the same frequency"""
+
+    def __init__(self):
+        # key -> number of accesses
+        self._frequencies = dict()
+        # number of accesses -> keys, the least recently used first
+        self._buckets = dict()
+        self._min_frequency = 0
+
+    def add(self, key):
+        self._frequencies[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_frequency = 1
+
+    def touch(self, key):
+        frequency = self._frequencies.get(key)
+
+        if frequency is None:
+            return
+
+        self.__unlink(key=key, frequency=frequency)
+        self._frequencies[key] = frequency + 1
+        self._buckets.setdefault(frequency + 1, OrderedDict())[key] = None
+
+        if self._min_frequency == frequency and \
+                frequency not in self._buckets:
+            self._min_frequency = frequency + 1
+
+    def remove(self, key):
+        frequency = self._frequencies.pop(key, None)
+
+        if frequency is None:
+            return
+
+        self.__unlink(key=key, frequency=frequency)
+
+        if self._min_frequency == frequency and \
+                frequency not in self._buckets:
+            self._min_frequency = min(self._buckets) if self._buckets else 0
+
+    def victim(self):
+        return next(iter(self._buckets[self._min_frequency]))
+
+    def keys(self):
+        return [key for frequency in sorted(self._buckets)
+                for key in self._buckets[frequency]]
+
+    def __unlink(self, key, frequency):
+        """
+        Removes a key from the bucket of its frequency
+        :param key: str
+        :param frequency: int
+        """
+        bucket = self._buckets[frequency]
+        del bucket[key]
+
+        if not bucket:
+            del self._buckets[frequency]
+
+
+class ArcPolicy(EvictionPolicy):
+    """
+    Adaptive Replacement Cache. The keys seen once and the keys seen again
+    are kept into two LRU lists, and the evicted keys of both are
+    remembered as ghosts. A hit of a ghost moves the target size of the
+    first list towards the list which lost it, so a scan only takes over
+    the first list.
+    """
+
+    def __init__(self):
+        # keys seen once and keys seen again, the least recently used first
+        self._recent = OrderedDict()
+        self._frequent = OrderedDict()
+        # ghosts of the keys evicted from both lists
+        self._recent_ghosts = OrderedDict()
+        self._frequent_ghosts = OrderedDict()
+        # target number of keys of the recent list
+        self._target = 0.0
+
+    def add(self, key):
+        capacity = self.__capacity() + 1
+
+        if key in self._recent_ghosts:
+            delta = max(len(self._frequent_ghosts) /
+                        float(len(self._recent_ghosts)), 1)
+            self._target = min(self._target + delta, capacity)
+            del self._recent_ghosts[key]
+            self._frequent[key] = None
+
+        elif key in self._frequent_ghosts:
+            delta = max(len(self._recent_ghosts) /
+                        float(len(self._frequent_ghosts)), 1)
+            self._target = max(self._target - delta, 0)
+            del self._frequent_ghosts[key]
+            self._frequent[key] = None
+
+        else:
+            self._recent[key] = None
+
+        self.__trim_ghosts()
+
+    def touch(self, key):
+        if key in self._recent:
+            del self._recent[key]
+            self._frequent[key] = None
+
+        elif key in self._frequent:
+            del self._frequent[key]
+            self._frequent[key] = None
+
+    def remove(self, key):
+        self._recent.pop(key, None)
+        self._frequent.pop(key, None)
+
+    def victim(self):
+        if self._recent and (len(self._recent) > self._target or
+                             not self._frequent):
+            return next(iter(self._recent))
+
+        return next(iter(self._frequent))
+
+    def keys(self):
+        return list(self._recent) + list(self._frequent)
+
+    def evict(self, key):
+        if key in self._recent:
+            del self._recent[key]
+            self._recent_ghosts[key] = None
+
+        elif key in self._frequent:
+            del self._frequent[key]
+            self._frequent_ghosts[key] = None
+
+        self.__trim_ghosts()
+
+    def __capacity(self):
+        """
+        Returns the number of cached keys, the size of the cache in keys
+        :return: int
+        """
+        return len(self._recent) + len(self._frequent)
+
+    def __trim_ghosts(self):
+        """
+        Keeps the ghosts of the recent keys within the capacity, and all the
+        ghosts within twice the capacity
+        """
+        capacity = max(self.__capacity(), 1)
+
+        while self._recent_ghosts and \
+                len(self._recent) + len(self._recent_ghosts) > capacity:
+            self._recent_ghosts.popitem(last=False)
+
+        while self._frequent_ghosts and \
+                capacity + len(self._recent_ghosts) + \
+                len(self._frequent_ghosts) > 2 * capacity:
+            self._frequent_ghosts.popitem(last=False)
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of the accesses of the keys into a few rows of small
+    counters. A count is the lowest of the counters of the key, so it may be
+    too high but never too low.
+    """
+
+    def __init__(self, width=DEFAULT_SKETCH_WIDTH,
+                 depth=DEFAULT_SKETCH_DEPTH):
+        """
+        Constructor
+
+        :param width: int counters per row, rounded up to a power of 2.
+        :param depth: int rows.
+        """
+        self._width = 1
+
+        while self._width < width:
+            self._width *= 2
+
+        self._rows = [array('B', [0]) * self._width for row in xrange(depth)]
+
+    def increment(self, key):
+        """
+        Counts an access of a key
+        :param key: str
+        """
+        for row, index in self.__indexes(key=key):
+            if row[index] < SKETCH_MAX_COUNT:
+                row[index] += 1
+
+    def estimate(self, key):
+        """
+        Returns the count of the accesses of a key
+        :param key: str
+        :return: int
+        """
+        return min(row[index] for row, index in self.__indexes(key=key))
+
+    def halve(self):
+        """
+        Halves all the counters
+        """
+        for row in self._rows:
+            for index in xrange(self._width):
+                row[index] >>= 1
+
+    def __indexes(self, key):
+        """
+        Returns the counter of a key of every row
+        :param key: str
+        :return: list of tuples (array, int)
+        """
+        mask = self._width - 1
+
+        return [(row, hash((depth, key)) & mask)
+                for depth, row in enumerate(self._rows)]
+
+
+class TinyLfuPolicy(EvictionPolicy):
+    """
+    W-TinyLFU. The new keys enter a small LRU window, and leave it as
+    candidates of the main segmented LRU. A candidate is admitted only if
+    its frequency, estimated by a count-min sketch of all the accesses, is
+    higher than the frequency of the main victim, so a scan of keys seen
+    once can not evict the hot ones. The main keys hit again are protected.
+    The counts are halved after a number of accesses proportional to the
+    cached keys, so the keys not hot anymore lose their advantage.
+    """
+
+    def __init__(self, window_ratio=DEFAULT_WINDOW_RATIO,
+                 protected_ratio=DEFAULT_PROTECTED_RATIO,
+                 sketch=None):
+        """
+        Constructor
+
+        :param window_ratio: float share of the keys into the window.
+        :param protected_ratio: float share of the main keys protected.
+        :param sketch: CountMinSketch of the frequencies.
+        """
+        self._window_ratio = window_ratio
+        self._protected_ratio = protected_ratio
+        self._sketch = sketch or CountMinSketch()
+        self._accesses = 0
+        # keys of the window, of probation and protected, the least recently
+        # used first. The last keys of probation are the candidates.
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+
+    def add(self, key):
+        self.__count(key=key)
+        self._window[key] = None
+
+        window_size = max(int(self.__size() * self._window_ratio), 1)
+
+        while len(self._window) > window_size:
+            candidate, value = self._window.popitem(last=False)
+            self._probation[candidate] = None
+
+    def touch(self, key):
+        self.__count(key=key)
+
+        if key in self._window:
+            del self._window[key]
+            self._window[key] = None
+
+        elif key in self._probation:
+            del self._probation[key]
+            self._protected[key] = None
+
+            protected_size = int((len(self._probation) +
+                                  len(self._protected)) *
+                                 self._protected_ratio)
+
+            while len(self._protected) > max(protected_size, 1):
+                demoted, value = self._protected.popitem(last=False)
+                self._probation[demoted] = None
+
+        elif key in self._protected:
+            del self._protected[key]
+            self._protected[key] = None
+
+    def miss(self, key):
+        self.__count(key=key)
+
+    def remove(self, key):
+        self._window.pop(key, None)
+        self._probation.pop(key, None)
+        self._protected.pop(key, None)
+
+    def victim(self):
+        if not self._probation and not self._protected:
+            return next(iter(self._window))
+
+        if not self._probation:
+            return next(iter(self._protected))
+
+        candidate = next(reversed(self._probation))
+        victim = next(iter(self._probation))
+
+        if victim == candidate:
+            if not self._protected:
+                return candidate
+
+            victim = next(iter(self._protected))
+
+        if self._sketch.estimate(key=candidate) > \
+                self._sketch.estimate(key=victim):
+            return victim
+
+        return candidate
+
+    def keys(self):
+        return list(self._probation) + list(self._window) + \
+            list(self._protected)
+
+    def __count(self, key):
+        """
+        Counts an access of a key, and halves the counts at the end of a
+        sample of accesses
+        :param key: str
+        """
+        self._sketch.increment(key=key)
+        self._accesses += 1
+
+        if self._accesses >= SKETCH_SAMPLE_FACTOR * max(self.__size(), 1):
+            self._sketch.halve()
+            self._accesses = 0
+
+    def __size(self):
+        """
+        Returns the number of cached keys
+        :return: int
+        """
+        return len(self._window) + len(self._probation) + len(self._protected)
+
+
+# Eviction policy classes by name, as set into constants.py
+POLICIES = {
+    LRU_POLICY: LruPolicy,
+    LFU_POLICY: LfuPolicy,
+    ARC_POLICY: ArcPolicy,
+    TINYLFU_POLICY: TinyLfuPolicy,
+}
@@ -33,3 +33,19 @@ class ServerMissing(Exception):
     def __init__(self, message='Server is missing'):
 
         super(Exception, self).__init__(message)
+
+
+class BlobMissing(Exception):
+    """Exception raised when a referenced value is missing"""
+
+    def __init__(self, message='Value is missing'):
+
+        super(Exception, self).__init__(message)
+
+
+class RecordChanged(Exception):
+    """Exception raised when the record is not the version expected"""
+
+    def __init__(self, message='Record has changed'):
+
+        super(Exception, self).__init__(message)
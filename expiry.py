@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+"""Expiry of the records with a time to live
+"""
+import errno
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from threading import RLock, Thread
+
+import sys
+sys.path.append('..')
+
+from minstore.helpers import Helpers
+
+EXPIRY_DIR = '.expiry'
+SNAPSHOT_FILENAME = 'snapshot.json'
+JOURNAL_FILENAME = 'journal.log'
+
+# Seconds of a tick of the timer wheel
+DEFAULT_RESOLUTION = 1.0
+
+# Slots of every level of the timer wheel, and levels. 64 slots of 4 levels
+# of 1 second span 194 days, the later deadlines wait into an overflow list.
+DEFAULT_WHEEL_SLOTS = 64
+DEFAULT_WHEEL_LEVELS = 4
+
+# Journal entries written before the schedule takes a new snapshot
+DEFAULT_SNAPSHOT_INTERVAL = 10000
+
+# Seconds between sweeps of the expired records, and records per batch
+DEFAULT_SWEEP_INTERVAL = 1.0
+DEFAULT_SWEEP_BATCH = 100
+
+# Seconds before a batch failing to expire is swept again
+DEFAULT_SWEEP_RETRY_DELAY = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel of the uids by their deadline. Every level has
+    a number of slots, and a slot of a level spans all the slots of the level
+    below. A deadline waits into the slot of the lowest level spanning it,
+    and moves to a lower level when the wheel reaches its slot, so advancing
+    the wheel costs the ticks plus the due uids, whatever the scheduled ones.
+    """
+
+    def __init__(self, now, resolution=DEFAULT_RESOLUTION,
+                 slots=DEFAULT_WHEEL_SLOTS, levels=DEFAULT_WHEEL_LEVELS):
+        """
+        Constructor
+
+        :param now: float current time.
+        :param resolution: float seconds of a tick.
+        :param slots: int slots of every level.
+        :param levels: int levels of slots.
+        """
+        self._resolution = resolution
+        self._slots = slots
+        self._levels = levels
+        self._tick = int(now / resolution)
+        self._wheels = [[set() for slot in xrange(slots)]
+                        for level in xrange(levels)]
+        self._overflow = set()
+        # uid -> tick of the deadline
+        self._ticks = dict()
+        # uid -> set holding it
+        self._positions = dict()
+        # uids due at the current tick, not yet returned
+        self._due = set()
+
+    def __len__(self):
+        return len(self._ticks)
+
+    def __contains__(self, uid):
+        return uid in self._ticks
+
+    def schedule(self, uid, deadline):
+        """
+        Schedules a uid at a deadline, replacing its previous one
+        :param uid: str
+        :param deadline: float time
+        """
+        self.cancel(uid=uid)
+
+        self._ticks[uid] = int(math.ceil(deadline / self._resolution))
+        self.__place(uid=uid)
+
+    def cancel(self, uid):
+        """
+        Removes a uid, if it is scheduled
+        :param uid: str
+        """
+        self._ticks.pop(uid, None)
+        position = self._positions.pop(uid, None)
+
+        if position is not None:
+            position.discard(uid)
+
+    def advance(self, now):
+        """
+        Moves the wheel to the current time and returns the uids which
+        deadline has passed. They are not scheduled anymore.
+        :param now: float current time.
+        :return: list
+        """
+        target = int(now / self._resolution)
+
+        while self._tick < target:
+            self._tick += 1
+
+            # the higher levels first, their uids may fall into lower slots
+            # reached at the same tick
+
+            level = 1
+
+            while level < self._levels and \
+                    not self._tick % self._slots ** level:
+                level += 1
+
+            if level == self._levels:
+                self.__cascade(self._overflow)
+
+            for level in xrange(level - 1, 0, -1):
+                slot = (self._tick // self._slots ** level) % self._slots
+                self.__cascade(self._wheels[level][slot])
+
+            self.__cascade(self._wheels[0][self._tick % self._slots])
+
+        due, self._due = list(self._due), set()
+
+        for uid in due:
+            del self._ticks[uid]
+            del self._positions[uid]
+
+        return due
+
+    def __cascade(self, uids):
+        """
+        Places again the uids of a reached slot
+        :param uids: set
+        """
+        for uid in list(uids):
+            uids.discard(uid)
+            self.__place(uid=uid)
+
+    def __place(self, uid):
+        """
+        Places a scheduled uid into the slot of the lowest level spanning
+        its deadline
+        :param uid: str
+        """
+        tick = self._ticks[uid]
+        delta = tick - self._tick
+
+        position = self._overflow
+
+        if delta <= 0:
+            position = self._due
+
+        else:
+            for level in xrange(self._levels):
+                if delta < self._slots ** (level + 1):
+                    slot = (tick // self._slots ** level) % self._slots
+                    position = self._wheels[level][slot]
+                    break
+
+        position.add(uid)
+        self._positions[uid] = position
+
+
+class ExpirySchedule(object):
+    """
+    Deadlines of the records with a time to live, kept into a timer wheel
+    and persisted as a snapshot plus a journal of the changes after it, so
+    the expired records are found without reading the records.
+    """
+
+    def __init__(self, base_path, resolution=DEFAULT_RESOLUTION,
+                 slots=DEFAULT_WHEEL_SLOTS, levels=DEFAULT_WHEEL_LEVELS,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        """
+        Constructor
+
+        :param base_path: str directory with the expiry directory.
+        :param resolution: float seconds of a tick of the wheel.
+        :param slots: int slots of every level of the wheel.
+        :param levels: int levels of the wheel.
+        :param snapshot_interval: int journal entries between snapshots.
+        """
+        self._path = '{!s}/{!s}'.format(base_path, EXPIRY_DIR)
+        self._snapshot_interval = snapshot_interval
+        self._lock = RLock()
+        self._wheel = TimerWheel(now=time.time(),
+                                 resolution=resolution,
+                                 slots=slots,
+                                 levels=levels)
+        # uid -> deadline
+        self._deadlines = dict()
+        self._journal = None
+        self._journal_entries = 0
+
+        if not Helpers.path_exists(self._path):
+            os.makedirs(self._path)
+            self.created = True
+
+        else:
+            self.created = False
+            self._load()
+
+        self._journal = open(self.__format_path(JOURNAL_FILENAME), 'ab')
+
+        if self._journal_entries:
+            self.snapshot()
+
+    def get(self, uid):
+        """
+        Returns the deadline of a uid or None if it does not expire
+        :param uid: str
+        :return: float|None
+        """
+        return self._deadlines.get(self.__normalize(uid))
+
+    def put(self, record):
+        """
+        Schedules a new or changed record by its expires_at field, or
+        cancels it without the field
+        :param record: dict
+        """
+        self.__change(uid=record['uid'], deadline=record.get('expires_at'))
+
+    def cancel(self, uid):
+        """
+        Removes a record from the schedule
+        :param uid: str
+        """
+        self.__change(uid=uid, deadline=None)
+
+    def due(self, now=None):
+        """
+        Returns the uids which deadline has passed. They stay into the
+        schedule until they are cancelled, on the delete of their records.
+        :param now: float|None current time.
+        :return: list
+        """
+        self._lock.acquire()
+
+        try:
+            return self._wheel.advance(now=now or time.time())
+
+        finally:
+            self._lock.release()
+
+    def retry(self, uids, deadline):
+        """
+        Schedules again the due uids which records could not be removed. The
+        uids cancelled meanwhile are skipped. Nothing is journaled, the
+        stored deadlines have passed already.
+        :param uids: list
+        :param deadline: float time
+        """
+        self._lock.acquire()
+
+        try:
+            for uid in uids:
+                uid = self.__normalize(uid)
+
+                if uid in self._deadlines:
+                    self._wheel.schedule(uid=uid, deadline=deadline)
+
+        finally:
+            self._lock.release()
+
+    def rebuild(self, records):
+        """
+        Replaces the schedule with the given records and takes a snapshot
+        :param records: iterable of dict
+        """
+        self._lock.acquire()
+
+        try:
+            for uid in self._deadlines.keys():
+                self.__apply(uid=uid, deadline=None)
+
+            for record in records:
+                self.__apply(uid=record['uid'],
+                             deadline=record.get('expires_at'))
+
+            self.snapshot()
+
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Writes the deadlines atomically and empties the journal
+        """
+        self._lock.acquire()
+
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self._path)
+
+            with os.fdopen(handle, 'wb') as target:
+                json.dump(self._deadlines, target)
+
+            os.rename(temp_path, self.__format_path(SNAPSHOT_FILENAME))
+
+            self._journal.truncate(0)
+            self._journal_entries = 0
+
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+
+        try:
+            self._journal.close()
+
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        """
+        Reads the snapshot and replays the journal. A partial last entry of
+        the journal, written on a crash, is dropped.
+        """
+        try:
+            with open(self.__format_path(SNAPSHOT_FILENAME), 'rb') as source:
+                deadlines = json.load(source)
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+            deadlines = dict()
+
+        for uid, deadline in deadlines.iteritems():
+            self.__apply(uid=uid, deadline=deadline)
+
+        try:
+            with open(self.__format_path(JOURNAL_FILENAME), 'rb') as journal:
+                for line in journal:
+                    try:
+                        uid, deadline = json.loads(line)
+
+                    except ValueError:
+                        break
+
+                    self.__apply(uid=uid, deadline=deadline)
+                    self._journal_entries += 1
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def __change(self, uid, deadline):
+        """
+        Applies and journals the change of the deadline of a record. Nothing
+        is journaled for the records without deadline before and after.
+        :param uid: str
+        :param deadline: float|None. None cancels the record.
+        """
+        uid = self.__normalize(uid)
+
+        self._lock.acquire()
+
+        try:
+            if deadline is None and uid not in self._deadlines:
+                return
+
+            self.__apply(uid=uid, deadline=deadline)
+
+            self._journal.write(json.dumps([uid, deadline]) + '\n')
+            self._journal.flush()
+            self._journal_entries += 1
+
+            if self._journal_entries >= self._snapshot_interval:
+                self.snapshot()
+
+        finally:
+            self._lock.release()
+
+    def __apply(self, uid, deadline):
+        """
+        Replaces the deadline of a record into memory
+        :param uid: str
+        :param deadline: float|None. None cancels the record.
+        """
+        uid = self.__normalize(uid)
+
+        if deadline is None:
+            self._deadlines.pop(uid, None)
+            self._wheel.cancel(uid=uid)
+            return
+
+        self._deadlines[uid] = deadline
+        self._wheel.schedule(uid=uid, deadline=deadline)
+
+    @classmethod
+    def __normalize(cls, uid):
+        """
+        :param uid: str|unicode
+        :return: unicode
+        """
+        if isinstance(uid, str):
+            uid = uid.decode('utf-8')
+
+        return uid
+
+    def __format_path(self, filename):
+        """
+        :param filename: str
+        :return: str
+        """
+        return '{!s}/{!s}'.format(self._path, filename)
+
+
+class ExpirySweeper(object):
+    """
+    Background job passing the expired uids of a schedule in batches to a
+    function removing them
+    """
+
+    def __init__(self, schedule, expire, interval=DEFAULT_SWEEP_INTERVAL,
+                 batch=DEFAULT_SWEEP_BATCH,
+                 retry_delay=DEFAULT_SWEEP_RETRY_DELAY):
+        """
+        Constructor
+
+        :param schedule: ExpirySchedule
+        :param expire: callable taking a list of uids.
+        :param interval: float seconds between sweeps. 0 disables the job.
+        :param batch: int uids per call of expire.
+        :param retry_delay: float seconds before a failed batch is swept
+        again.
+        """
+        self._schedule = schedule
+        self._expire = expire
+        self._interval = interval
+        self._batch = batch
+        self._retry_delay = retry_delay
+        self._closed = False
+
+        if self._interval:
+            sweeper = Thread(target=self._sweep_loop)
+            sweeper.daemon = True
+            sweeper.start()
+
+    def sweep(self, now=None):
+        """
+        Expires the uids due, and returns their number. A batch failing to
+        expire is logged and scheduled again after the retry delay.
+        :param now: float|None current time.
+        :return: int
+        """
+        now = now or time.time()
+        uids = self._schedule.due(now=now)
+
+        for start in xrange(0, len(uids), self._batch):
+            batch = uids[start:start + self._batch]
+
+            try:
+                self._expire(batch)
+
+            except Exception:
+                logger.exception('Expiry Error: %d records retried in %s '
+                                 'seconds', len(batch), self._retry_delay)
+                self._schedule.retry(uids=batch,
+                                     deadline=now + self._retry_delay)
+
+        return len(uids)
+
+    def close(self):
+        self._closed = True
+
+    def _sweep_loop(self):
+        """
+        Background job sweeping the expired uids
+        """
+        while not self._closed:
+            time.sleep(self._interval)
+
+            if self._closed:
+                break
+
+            try:
+                self.sweep()
+
+            except Exception:
+                logger.exception('Expiry Error: sweep failed')
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 """Services and helpers
 """
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from binascii import hexlify
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
 import json
 import os
 import requests
+import time
+
+from minstore.exceptions import RecordExists
 
 
 class Helpers(object):
@@ -24,6 +32,18 @@ class Helpers(object):
 
         return target_len
 
+    @classmethod
+    def stream_size(cls, header, length):
+        """
+        Returns the iterable size of a record given its fields but the value
+        and the bytes length of the value
+        :param header: dict
+        :param length: int
+        :return: int
+        """
+        return cls.iterable_size(target=header) + len(hexlify('value')) + \
+            2 * length
+
     @classmethod
     def sign(cls, hashable):
         """
@@ -65,6 +85,99 @@ class Helpers(object):
         """
         os.remove(file_path)
 
+    @classmethod
+    def publish_file(cls, temp_path, file_path, overwrite=True):
+        """
+        Moves atomically a temporary file to its final path, sharing the lock
+        of its directory. Raises RecordExists if overwrite is False and the
+        final path already exists.
+        :param temp_path: str
+        :param file_path: str
+        :param overwrite: bool
+        """
+        if overwrite:
+            with cls.lock_dir(dir_path=os.path.dirname(file_path)):
+                os.rename(temp_path, file_path)
+
+            return
+
+        try:
+            with cls.lock_dir(dir_path=os.path.dirname(file_path)):
+                os.link(temp_path, file_path)
+
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+            raise RecordExists()
+
+        finally:
+            if cls.path_exists(temp_path):
+                cls.delete_file(file_path=temp_path)
+
+    @classmethod
+    @contextmanager
+    def lock_dir(cls, dir_path, exclusive=False):
+        """
+        Holds the advisory lock of a directory, across processes. The writes
+        of its files share it, a check followed by a write holds it alone.
+        :param dir_path: str
+        :param exclusive: bool
+        """
+        handle = os.open(dir_path, os.O_RDONLY)
+
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+        finally:
+            os.close(handle)
+
+    @classmethod
+    def sync_dir(cls, dir_path):
+        """
+        Flushes the entries of a directory to disk
+        :param dir_path: str
+        """
+        handle = os.open(dir_path, os.O_RDONLY)
+
+        try:
+            os.fsync(handle)
+
+        finally:
+            os.close(handle)
+
+    @classmethod
+    def encode_cursor(cls, uid):
+        """
+        Returns an opaque cursor to resume a scan after the given uid
+        :param uid: str
+        :return: str
+        """
+        if isinstance(uid, unicode):
+            uid = uid.encode('utf-8')
+
+        return urlsafe_b64encode(uid)
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        """
+        Returns the uid of a cursor. Raises ValueError if the cursor is not
+        valid.
+        :param cursor: str
+        :return: unicode
+        """
+        try:
+            uid = urlsafe_b64decode(str(cursor)).decode('utf-8')
+
+        except (TypeError, UnicodeError):
+            uid = None
+
+        if uid is None or cls.encode_cursor(uid=uid) != cursor:
+            raise ValueError('Invalid cursor {!s}'.format(cursor))
+
+        return uid
+
     @classmethod
     def __get_request_headers(cls):
         """
@@ -96,7 +209,8 @@ class Helpers(object):
         return response
 
     @classmethod
-    def request_put(cls, url, dirs, data, params=None, timeout=30):
+    def request_put(cls, url, dirs, data, params=None, timeout=30,
+                    headers=None):
         """
         Makes a put request.
         :param url: destination url
@@ -104,47 +218,81 @@ class Helpers(object):
         :param data: post data
         :param params: URI query params
         :param timeout: timeout seconds for request
+        :param headers: dict of additional HTTP headers
         :return: HTTP response
         """
         url = '{!s}/{!s}'.format(url, '/'.join(dirs))
-        headers = cls.__get_request_headers()
+        request_headers = cls.__get_request_headers()
+        request_headers.update(headers or {})
         response = requests.put(url,
                                 data=data,
                                 params=params,
                                 timeout=timeout,
-                                headers=headers)
+                                headers=request_headers)
         return response
 
     @classmethod
-    def request_get(cls, url, dirs, params=None, timeout=30):
+    def request_put_stream(cls, url, dirs, stream, headers, params=None,
+                           timeout=30):
+        """
+        Makes a put request sending the body from a stream.
+        :param url: destination url
+        :param dirs: route path items
+        :param stream: StreamReader body
+        :param headers: dict of additional HTTP headers
+        :param params: URI query params
+        :param timeout: timeout seconds for request
+        :return: HTTP response
+        """
+        url = '{!s}/{!s}'.format(url, '/'.join(dirs))
+        request_headers = cls.__get_request_headers()
+        request_headers['Content-Type'] = 'application/octet-stream'
+        request_headers.update(headers)
+        response = requests.put(url,
+                                data=stream,
+                                params=params,
+                                timeout=timeout,
+                                headers=request_headers)
+        return response
+
+    @classmethod
+    def request_get(cls, url, dirs, params=None, timeout=30, headers=None):
         """
         Makes a get request.
         :param url: destination url
         :param dirs: route path items
         :param params: URI query params
         :param timeout: timeout seconds for request
+        :param headers: dict of additional HTTP headers
         :return: HTTP response
         """
         url = '{!s}/{!s}'.format(url, '/'.join(dirs))
-        headers = cls.__get_request_headers()
+        request_headers = cls.__get_request_headers()
+        request_headers.update(headers or {})
         response = requests.get(url,
                                 params=params,
                                 timeout=timeout,
-                                headers=headers)
+                                headers=request_headers)
         return response
 
     @classmethod
-    def request_delete(cls, url, dirs, params=None, timeout=30):
+    def request_delete(cls, url, dirs, params=None, timeout=30, headers=None):
         """
         Makes a delete request.
         :param url: destination url
         :param dirs: route path items
         :param params: URI query params
         :param timeout: timeout seconds for request
+        :param headers: dict of additional HTTP headers
         :return: HTTP response
         """
         url = '{!s}/{!s}'.format(url, '/'.join(dirs))
-        response = requests.delete(url, params=params, timeout=timeout)
+        request_headers = cls.__get_request_headers()
+        request_headers.update(headers or {})
+        response = requests.delete(url,
+                                   params=params,
+                                   timeout=timeout,
+                                   headers=request_headers)
         return response
 
 
@@ -169,3 +317,97 @@ class RecordHelper(object):
             return None
 
         return record
+
+    @classmethod
+    def etag(cls, uid, check_sum):
+        """
+        Returns the ETag of a version of a record
+        :param uid: str
+        :param check_sum: int
+        :return: str
+        """
+        return '{uid}:{check_sum}'.format(uid=uid, check_sum=check_sum)
+
+    @classmethod
+    def is_expired(cls, record, now=None):
+        """
+        Checks if the time to live of a record is over
+        :param record: dict
+        :param now: float|None current time.
+        :return: bool
+        """
+        expires_at = record.get('expires_at')
+
+        if expires_at is None:
+            return False
+
+        return expires_at <= (now or time.time())
+
+    @classmethod
+    def stream_record(cls, record):
+        """
+        Returns the fields of a record but the value, the bytes length of the
+        value and a function returning a generator of the bytes of the value
+        from a start to an end, end excluded.
+        :param record: dict
+        :return: tuple (dict, int, callable)
+        """
+        header = dict(record)
+        value = header.pop('value').encode('utf-8')
+
+        def read(start=0, end=None):
+            yield value[start:end]
+
+        return header, len(value), read
+
+
+class HashingReader(object):
+    """Reader of a stream hashing the bytes read, for the check sum of a
+    streamed value
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hash = hashlib.md5()
+
+    def read(self, size=-1):
+        block = self._stream.read(size)
+        self._hash.update(block)
+
+        return block
+
+    def check_sum(self):
+        """
+        Returns the check sum of the bytes read as a positive integer
+        :return: int
+        """
+        return int(self._hash.hexdigest()[:15], 16)
+
+
+class StreamReader(object):
+    """Reader of the blocks of a generator with a known length, to send them
+    as a request body
+    """
+
+    def __init__(self, blocks, length):
+        self._blocks = blocks
+        self._length = length
+        self._buffer = ''
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._blocks)
+
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self._buffer)
+
+        block, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return block
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""Secondary indexes of the record fields
+"""
+from abc import ABCMeta, abstractmethod
+import bisect
+import errno
+import json
+import os
+import tempfile
+from threading import RLock
+
+import sys
+sys.path.append('..')
+
+from minstore.helpers import Helpers
+
+INDEXES_DIR = '.index'
+SNAPSHOT_FILENAME = 'snapshot.json'
+JOURNAL_FILENAME = 'journal.log'
+
+# Journal entries written before the indexes take a new snapshot
+DEFAULT_SNAPSHOT_INTERVAL = 10000
+
+
+class Index(object):
+    """Index of the uids of the records by the value of a field"""
+    __metaclass__ = ABCMeta
+
+    def __init__(self, field):
+        self.field = field
+
+    @abstractmethod
+    def add(self, uid, value):
+        """
+        Adds the value of a uid
+        :param uid: str
+        :param value: mixed
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, uid, value):
+        """
+        Removes the value of a uid
+        :param uid: str
+        :param value: mixed
+        """
+        pass
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes all the values
+        """
+        pass
+
+
+class HashIndex(Index):
+    """Index for the equality queries, as the language"""
+
+    def __init__(self, field):
+        super(HashIndex, self).__init__(field=field)
+        # value -> set of uids
+        self._uids = dict()
+
+    def add(self, uid, value):
+        self._uids.setdefault(value, set()).add(uid)
+
+    def remove(self, uid, value):
+        uids = self._uids.get(value)
+
+        if uids is None:
+            return
+
+        uids.discard(uid)
+
+        if not uids:
+            del self._uids[value]
+
+    def clear(self):
+        self._uids = dict()
+
+    def find(self, value, limit=None):
+        """
+        Returns the sorted uids with the value
+        :param value: mixed
+        :param limit: int|None
+        :return: list
+        """
+        return sorted(self._uids.get(value, ()))[:limit]
+
+
+class SortedIndex(Index):
+    """Index for the range queries, as the timestamp"""
+
+    def __init__(self, field):
+        super(SortedIndex, self).__init__(field=field)
+        # sorted list of (value, uid)
+        self._entries = list()
+
+    def add(self, uid, value):
+        bisect.insort(self._entries, (value, uid))
+
+    def remove(self, uid, value):
+        position = bisect.bisect_left(self._entries, (value, uid))
+
+        if position < len(self._entries) \
+                and self._entries[position] == (value, uid):
+            del self._entries[position]
+
+    def clear(self):
+        self._entries = list()
+
+    def range(self, low=None, high=None, limit=None):
+        """
+        Returns the uids with a value between low and high, both included,
+        sorted by value.
+        :param low: mixed|None
+        :param high: mixed|None
+        :param limit: int|None
+        :return: list
+        """
+        position = 0
+
+        if low is not None:
+            position = bisect.bisect_left(self._entries, (low,))
+
+        uids = list()
+
+        for value, uid in self._entries[position:]:
+            if high is not None and value > high:
+                break
+
+            if limit is not None and len(uids) >= limit:
+                break
+
+            uids.append(uid)
+
+        return uids
+
+
+class IndexSet(object):
+    """
+    Indexes of a base path, kept in memory and persisted as a snapshot plus
+    a journal of the changes after it. Every change appends a line to the
+    journal, and the journal is folded into a new snapshot after an
+    interval of entries.
+    """
+
+    def __init__(self, base_path, indexes,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        """
+        Constructor
+
+        :param base_path: str directory with the indexes directory.
+        :param indexes: list of Index
+        :param snapshot_interval: int journal entries between snapshots.
+        """
+        self._path = '{!s}/{!s}'.format(base_path, INDEXES_DIR)
+        self._indexes = dict((index.field, index) for index in indexes)
+        self._snapshot_interval = snapshot_interval
+        self._lock = RLock()
+        # uid -> indexed fields of the record
+        self._fields = dict()
+        self._journal = None
+        self._journal_entries = 0
+        # True if the snapshot indexes other fields, as after adding an index
+        self.outdated = False
+
+        if not Helpers.path_exists(self._path):
+            os.makedirs(self._path)
+            self.created = True
+
+        else:
+            self.created = False
+            self._load()
+
+        self._journal = open(self.__format_path(JOURNAL_FILENAME), 'ab')
+
+        if self._journal_entries:
+            self.snapshot()
+
+    def get(self, field):
+        """
+        Returns the index of a field or None if it is not indexed
+        :param field: str
+        :return: Index|None
+        """
+        return self._indexes.get(field)
+
+    def find(self, field, value, limit=None):
+        """
+        Returns the sorted uids with a value of a hash index
+        :param field: str
+        :param value: mixed
+        :param limit: int|None
+        :return: list
+        """
+        self._lock.acquire()
+
+        try:
+            return self._indexes[field].find(value=value, limit=limit)
+
+        finally:
+            self._lock.release()
+
+    def range(self, field, low=None, high=None, limit=None):
+        """
+        Returns the uids within a range of a sorted index
+        :param field: str
+        :param low: mixed|None
+        :param high: mixed|None
+        :param limit: int|None
+        :return: list
+        """
+        self._lock.acquire()
+
+        try:
+            return self._indexes[field].range(low=low, high=high, limit=limit)
+
+        finally:
+            self._lock.release()
+
+    def put(self, record):
+        """
+        Indexes a new or changed record
+        :param record: dict
+        """
+        self.__change(uid=record['uid'],
+                      fields=self.__indexed_fields(record=record))
+
+    def remove(self, uid):
+        """
+        Removes a record from the indexes
+        :param uid: str
+        """
+        self.__change(uid=uid, fields=None)
+
+    def rebuild(self, records):
+        """
+        Replaces the indexes with the given records and takes a snapshot
+        :param records: iterable of dict
+        """
+        self._lock.acquire()
+
+        try:
+            self._fields = dict()
+
+            for index in self._indexes.values():
+                index.clear()
+
+            for record in records:
+                self.__apply(uid=record['uid'],
+                             fields=self.__indexed_fields(record=record))
+
+            self.snapshot()
+
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Writes the indexed fields of all the records atomically, along with
+        the names of the indexed fields, and empties the journal
+        """
+        self._lock.acquire()
+
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self._path)
+
+            with os.fdopen(handle, 'wb') as target:
+                json.dump({'indexes': sorted(self._indexes),
+                           'records': self._fields}, target)
+
+            os.rename(temp_path, self.__format_path(SNAPSHOT_FILENAME))
+
+            self._journal.truncate(0)
+            self._journal_entries = 0
+
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+
+        try:
+            self._journal.close()
+
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        """
+        Reads the snapshot and replays the journal. A partial last entry of
+        the journal, written on a crash, is dropped. The indexes are outdated
+        if the snapshot is missing or indexes other fields than the
+        configured ones.
+        """
+        try:
+            with open(self.__format_path(SNAPSHOT_FILENAME), 'rb') as source:
+                snapshot = json.load(source)
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+            snapshot = {'indexes': None, 'records': dict()}
+
+        self.outdated = snapshot['indexes'] != sorted(self._indexes)
+
+        for uid, fields in snapshot['records'].iteritems():
+            self.__apply(uid=uid, fields=fields)
+
+        try:
+            with open(self.__format_path(JOURNAL_FILENAME), 'rb') as journal:
+                for line in journal:
+                    try:
+                        uid, fields = json.loads(line)
+
+                    except ValueError:
+                        break
+
+                    self.__apply(uid=uid, fields=fields)
+                    self._journal_entries += 1
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def __change(self, uid, fields):
+        """
+        Applies and journals the change of a record
+        :param uid: str
+        :param fields: dict|None. None removes the record.
+        """
+        self._lock.acquire()
+
+        try:
+            self.__apply(uid=uid, fields=fields)
+
+            self._journal.write(json.dumps([uid, fields]) + '\n')
+            self._journal.flush()
+            self._journal_entries += 1
+
+            if self._journal_entries >= self._snapshot_interval:
+                self.snapshot()
+
+        finally:
+            self._lock.release()
+
+    def __apply(self, uid, fields):
+        """
+        Replaces the indexed fields of a record into memory
+        :param uid: str
+        :param fields: dict|None. None removes the record.
+        """
+        if isinstance(uid, str):
+            uid = uid.decode('utf-8')
+
+        previous = self._fields.pop(uid, None)
+
+        if previous:
+            for field, value in previous.iteritems():
+                if field in self._indexes:
+                    self._indexes[field].remove(uid=uid, value=value)
+
+        if fields is None:
+            return
+
+        self._fields[uid] = fields
+
+        for field, value in fields.iteritems():
+            if field in self._indexes:
+                self._indexes[field].add(uid=uid, value=value)
+
+    def __indexed_fields(self, record):
+        """
+        Returns the indexed fields of a record
+        :param record: dict
+        :return: dict
+        """
+        return dict((field, record[field]) for field in self._indexes
+                    if field in record)
+
+    def __format_path(self, filename):
+        """
+        :param filename: str
+        :return: str
+        """
+        return '{!s}/{!s}'.format(self._path, filename)
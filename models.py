@@ -2,13 +2,19 @@
 """Models
 """
 from abc import ABCMeta, abstractmethod
+from threading import Lock
 import time
 
 import sys
 sys.path.append('..')
 
-from minstore.exceptions import RecordMissing, RecordExists
-from minstore.helpers import Helpers
+from minstore.cache import CacheEntry
+from minstore.constants import CREATED, DELETED
+from minstore.exceptions import RecordChanged, RecordMissing, RecordExists
+from minstore.helpers import HashingReader, Helpers, RecordHelper
+
+# Locks shared by the uids of a model, serializing the writes of every uid
+MODEL_LOCK_STRIPES = 64
 
 
 class Model(object):
@@ -55,129 +61,472 @@ class Model(object):
         """
         pass
 
-    def _valid_exists(self, uid):
+
+class TextModel(Model):
+    """Text Model"""
+
+    def __init__(self, **params):
+        super(TextModel, self).__init__(**params)
+        self._processes = params['processes']
+        self._indexes = params.get('indexes')
+        self._search = params.get('search')
+        self._expiry = params.get('expiry')
+        self._cache = params.get('cache')
+        self._check_sums = params.get('check_sums')
+        self._locks = [Lock() for _ in range(MODEL_LOCK_STRIPES)]
+
+    def get(self, uid):
         """
-        Checks if record exists. Raises an exception if does not.
+        Retrieves a Text from the cache, if any, or from database, caching
+        it. An expired Text is missing.
         :param uid: str
-        :return: bool
+        :return: dict
+        :raise RecordMissing
         """
-        if not self._storage.exists(uid=uid):
+        return self.get_entry(uid=uid).record
 
-            raise RecordMissing(
-                'Select Error: Record {!s} is missing'.format(uid))
-
-    def _valid_no_exists(self, uid):
+    def get_entry(self, uid):
         """
-        Checks if record no exists. Raises an exception if does.
+        Retrieves a Text with its encoded response body from the cache, if
+        any, or from database, caching it. The Text is read and cached under
+        the lock of its uid, so a write or a delete finishing meanwhile is
+        never hidden by the cached copy. An expired Text is missing.
         :param uid: str
-        :return: bool
+        :return: CacheEntry
+        :raise RecordMissing
         """
-        if self._storage.exists(uid=uid):
+        if self._cache:
+            try:
+                entry = self._cache.get_entry(uid=uid)
 
-            raise RecordExists(
-                'Insert Error: Record {!s} already exists'.format(uid))
+                if entry:
+                    return entry
 
+            except RecordMissing:
+                pass
 
-class TextModel(Model):
-    """Text Model"""
+        lock = self.__lock(uid=uid)
+        lock.acquire()
 
-    def __init__(self, **params):
-        super(TextModel, self).__init__(**params)
-        self._processes = params['processes']
+        try:
+            record = self._storage.select(uid=uid)
 
-    def get(self, uid):
+            if RecordHelper.is_expired(record=record):
+                raise RecordMissing('Record {!s} is expired'.format(uid))
+
+            entry = CacheEntry(record=record)
+
+            if self._cache and isinstance(record['value'], basestring):
+                self._cache.put_entry(entry=entry)
+
+            self.__remember(record=record, replace=False)
+
+        finally:
+            lock.release()
+
+        return entry
+
+    def find_check_sum(self, uid):
         """
-        Retrieves a Text from database
+        Returns the check sum of a Text without reading its value, from the
+        map of the check sums if any. None if the Text is missing or expired.
         :param uid: str
-        :return: dict
+        :return: int|None
         """
-        self._valid_exists(uid=uid)
+        try:
+            if not self._check_sums:
+                raise KeyError(uid)
 
-        record = self._storage.select(uid=uid)
+            check_sum, expires_at = self._check_sums.get(uid)
 
-        return record
+        except KeyError:
+            lock = self.__lock(uid=uid)
+            lock.acquire()
 
-    def delete(self, uid):
+            try:
+                header = self._storage.select_header(uid=uid)
+                self.__remember(record=header, replace=False)
+
+            except RecordMissing:
+                return None
+
+            finally:
+                lock.release()
+
+            check_sum = header.get('check_sum')
+            expires_at = header.get('expires_at')
+
+        if RecordHelper.is_expired(record={'expires_at': expires_at}):
+            return None
+
+        return check_sum
+
+    def delete(self, uid, expected=None):
         """
-        Deletes a Text from database
+        Deletes a Text from database. With an expected check sum, the Text
+        is deleted only if it has not changed.
         :param uid: str
+        :param expected: int|None check sum the Text must have
+        :raise RecordMissing
+        :raise RecordChanged
         """
-        self._valid_exists(uid=uid)
+        lock = self.__lock(uid=uid)
+        lock.acquire()
 
-        self._storage.delete(uid=uid)
+        try:
+            if expected is not None and \
+                    self.get_check_sum(uid=uid) != expected:
+                raise RecordChanged('Record {!s} has changed'.format(uid))
+
+            self._storage.delete(uid=uid)
+            self.__unindex(uid=uid)
+
+        finally:
+            lock.release()
 
     def insert(self, uid, values):
         """
-        Inserts a new record
+        Inserts a new record. The optional ttl value sets the seconds to
+        live of the record.
         :param uid: str
         :param values: dict
         :return: dict
+        :raise RecordExists
         """
         text = values['value']
-        self._valid_no_exists(uid=uid)
 
         record = self.create(uid=uid,
                              value=text,
+                             ttl=values.get('ttl'),
                              processes=self._processes)
 
-        self._storage.insert(record=record)
+        lock = self.__lock(uid=uid)
+        lock.acquire()
+
+        try:
+            self._storage.insert(record=record)
+            self.__index(record=record)
+
+        finally:
+            lock.release()
 
         return record
 
-    def update(self, uid, values):
+    def update(self, uid, values, expected=None):
         """
-        Updates a record. Raises an exception if record exists
+        Updates a record. Raises an exception if record exists. The optional
+        ttl value sets the seconds to live of the record, and renews it with
+        the same value. With an expected check sum, the record is updated
+        only if it has not changed, as a compare and swap.
         :param uid: str
         :param values: dict
+        :param expected: int|None check sum the record must have
         :return: dict
+        :raise RecordChanged
         """
         text = values['value']
+        ttl = values.get('ttl')
 
-        self._valid_exists(uid=uid)
+        lock = self.__lock(uid=uid)
+        lock.acquire()
 
-        last_check_sum = self.get_check_sum(uid=uid)
+        try:
+            last_check_sum = self.get_check_sum(uid=uid)
 
-        new_check_sum = Helpers.sign(text)
+            if expected is not None and last_check_sum != expected:
+                raise RecordChanged('Record {!s} has changed'.format(uid))
 
-        if last_check_sum == new_check_sum:
-            raise RecordExists('Record has no change')
+            new_check_sum = Helpers.sign(text)
 
-        record = self.create(uid=uid,
-                             value=text,
-                             check_sum=new_check_sum,
-                             processes=self._processes)
+            if last_check_sum == new_check_sum and not ttl:
+                raise RecordExists('Record has no change')
+
+            record = self.create(uid=uid,
+                                 value=text,
+                                 check_sum=new_check_sum,
+                                 ttl=ttl,
+                                 processes=self._processes)
+
+            self._storage.update(record=record)
+            self.__index(record=record)
 
-        self._storage.update(record=record)
+        finally:
+            lock.release()
 
         return record
 
     def copy(self, record):
         """
-        Forces to create or update a record. Acts as mirror.
+        Forces to create or update a record. Acts as mirror. A record with
+        the digest of its value instead of the value takes the value already
+        stored with the digest.
         :param record: dict
         :return: dict
+        :raise BlobMissing
         """
-        self._storage.update(record=record)
+        lock = self.__lock(uid=record['uid'])
+        lock.acquire()
+
+        try:
+            if 'value' in record:
+                self._storage.update(record=record)
+
+            else:
+                self._storage.update_by_digest(record=record)
+                record = self._storage.select(uid=record['uid'])
+
+            self.__index(record=record)
+
+        finally:
+            lock.release()
 
         return record
 
+    def get_stream(self, uid):
+        """
+        Retrieves a Text from database to stream its value. Returns the
+        record but the value, the bytes length of the value and a function
+        returning a generator of the bytes from a start to an end.
+        :param uid: str
+        :return: tuple (dict, int, callable)
+        :raise RecordMissing
+        """
+        stream = self._storage.select_stream(uid=uid)
+
+        if RecordHelper.is_expired(record=stream[0]):
+            raise RecordMissing('Record {!s} is expired'.format(uid))
+
+        return stream
+
+    def insert_stream(self, uid, stream, length, ttl=None):
+        """
+        Inserts a new record reading its value from a stream. Returns the
+        record but the value.
+        :param uid: str
+        :param stream: file
+        :param length: int bytes of the value
+        :param ttl: float|None seconds to live
+        :return: dict
+        :raise RecordExists
+        :raise ValueError
+        """
+        record = self.create_stream(uid=uid,
+                                    stream=stream,
+                                    length=length,
+                                    ttl=ttl)
+
+        lock = self.__lock(uid=uid)
+        lock.acquire()
+
+        try:
+            self._storage.insert(record=record)
+            self.__index(record=record)
+
+        finally:
+            lock.release()
+
+        return self.__header(record=record)
+
+    def update_stream(self, uid, stream, length, ttl=None):
+        """
+        Updates a record reading its value from a stream. Returns the record
+        but the value.
+        :param uid: str
+        :param stream: file
+        :param length: int bytes of the value
+        :param ttl: float|None seconds to live
+        :return: dict
+        :raise RecordMissing
+        :raise ValueError
+        """
+        if not self._storage.exists(uid=uid):
+            raise RecordMissing('Record {!s} is missing'.format(uid))
+
+        # the value is staged before locking, the stream may be slow
+        record = self.create_stream(uid=uid,
+                                    stream=stream,
+                                    length=length,
+                                    ttl=ttl)
+
+        lock = self.__lock(uid=uid)
+        lock.acquire()
+
+        try:
+            if not self._storage.exists(uid=uid):
+                raise RecordMissing('Record {!s} is missing'.format(uid))
+
+            self._storage.update(record=record)
+            self.__index(record=record)
+
+        finally:
+            lock.release()
+
+        return self.__header(record=record)
+
+    def copy_stream(self, header, stream, length):
+        """
+        Forces to create or update a record given its fields but the value,
+        reading the value from a stream. Acts as mirror.
+        :param header: dict
+        :param stream: file
+        :param length: int bytes of the value
+        :return: dict
+        :raise ValueError
+        """
+        record = dict(header)
+        record['value'] = self._storage.stage_value(stream=stream,
+                                                    length=length)
+
+        lock = self.__lock(uid=record['uid'])
+        lock.acquire()
+
+        try:
+            self._storage.update(record=record)
+            self.__index(record=record)
+
+        finally:
+            lock.release()
+
+        return self.__header(record=record)
+
+    def create_stream(self, uid, stream, length, ttl=None):
+        """
+        Creates and processes a record reading its value from a stream. The
+        value is staged by the storage, and the processes needing the value
+        are skipped.
+        :param uid: str
+        :param stream: file
+        :param length: int bytes of the value
+        :param ttl: float|None seconds to live
+        :return: dict
+        :raise ValueError
+        """
+        reader = HashingReader(stream)
+
+        record = dict()
+        record['uid'] = uid
+        record['value'] = self._storage.stage_value(stream=reader,
+                                                    length=length)
+        record['timestamp'] = time.time()
+        record['check_sum'] = reader.check_sum()
+
+        if ttl:
+            record['expires_at'] = record['timestamp'] + ttl
+
+        for process in self._processes:
+            if not process.NEEDS_VALUE:
+                process.process(record)
+
+        record['size'] = Helpers.stream_size(
+            header=self.__header(record=record), length=length)
+
+        return record
+
+    def get_many(self, uids):
+        """
+        Retrieves a batch of Texts from database, None for the missing and
+        the expired ones
+        :param uids: list
+        :return: dict
+        """
+        records = self._storage.select_many(uids=uids)
+        now = time.time()
+
+        for uid, record in records.iteritems():
+            if record and RecordHelper.is_expired(record=record, now=now):
+                records[uid] = None
+
+        return records
+
+    def insert_many(self, items):
+        """
+        Inserts a batch of new records. Returns the result and the record
+        by uid, the batch is not aborted by the existing ones.
+        :param items: dict of values by uid
+        :return: dict of tuples (result, record)
+        """
+        records = self.create_many(
+            values=[(uid, values['value']) for uid, values in items.items()],
+            processes=self._processes)
+
+        results = self._storage.insert_many(records=records)
+
+        for record in records:
+            if results[record['uid']] == CREATED:
+                self.__index(record=record)
+
+        return dict((record['uid'], (results[record['uid']], record))
+                    for record in records)
+
+    def delete_many(self, uids):
+        """
+        Deletes a batch of Texts from database
+        :param uids: list
+        :return: dict of results by uid
+        """
+        results = self._storage.delete_many(uids=uids)
+
+        for uid, result in results.iteritems():
+            if result == DELETED:
+                self.__unindex(uid=uid)
+
+        return results
+
+    def expire_many(self, uids, now=None):
+        """
+        Deletes the expired Texts of a batch. The ones renewed meanwhile are
+        kept.
+        :param uids: list
+        :param now: float|None current time.
+        :return: dict of results by uid
+        """
+        now = now or time.time()
+        expired = list()
+        # the locks of the batch, in a fixed order so two batches never
+        # wait for each other
+        stripes = set(hash(uid) % MODEL_LOCK_STRIPES for uid in uids)
+        locks = [self._locks[stripe] for stripe in sorted(stripes)]
+
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            for uid in uids:
+                try:
+                    header = self._storage.select_header(uid=uid)
+
+                except RecordMissing:
+                    self.__unindex(uid=uid)
+                    continue
+
+                if RecordHelper.is_expired(record=header, now=now):
+                    expired.append(uid)
+
+            return self.delete_many(uids=expired)
+
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
     def get_check_sum(self, uid):
         """
-        Retrieves the check_sum of a record.
+        Retrieves the check_sum of a record without reading its value.
         :param uid: str
         :return: str
+        :raise RecordMissing
         """
-        values = self._storage.select(uid=uid)
+        header = self._storage.select_header(uid=uid)
 
-        return values['check_sum']
+        return header['check_sum']
 
     @classmethod
-    def create(cls, uid, value, check_sum=None, processes=list()):
+    def create(cls, uid, value, check_sum=None, ttl=None, processes=list()):
         """
         Creates, processes and returns a record
         :param uid: str
         :param value: str
         :param check_sum: str
+        :param ttl: float|None seconds to live
         :param processes: list
         :return: object
         """
@@ -186,6 +535,9 @@ class TextModel(Model):
         record['value'] = value
         record['timestamp'] = time.time()
 
+        if ttl:
+            record['expires_at'] = record['timestamp'] + ttl
+
         if not check_sum:
             check_sum = Helpers.sign(value)
 
@@ -197,3 +549,134 @@ class TextModel(Model):
         record['size'] = Helpers.iterable_size(target=record)
 
         return record
+
+    def __index(self, record):
+        """
+        Updates the cache, the indexes, the search index and the expiry
+        schedule, if any, with a written record. A record with a staged value
+        is removed from the cache instead.
+        :param record: dict
+        """
+        if self._cache:
+            self.__uncache(uid=record['uid'])
+            self.__cache(record=record)
+
+        self.__remember(record=record)
+
+        if self._indexes:
+            self._indexes.put(record=record)
+
+        if self._expiry:
+            self._expiry.put(record=record)
+
+        if not self._search:
+            return
+
+        if isinstance(record['value'], basestring):
+            self._search.put(uid=record['uid'], value=record['value'])
+
+        else:
+            self._search.remove(uid=record['uid'])
+
+    def __unindex(self, uid):
+        """
+        Removes a deleted record from the cache, the indexes, the search
+        index and the expiry schedule, if any
+        :param uid: str
+        """
+        if self._cache:
+            self.__uncache(uid=uid)
+
+        if self._check_sums:
+            self._check_sums.forget(uid=uid)
+
+        if self._indexes:
+            self._indexes.remove(uid=uid)
+
+        if self._expiry:
+            self._expiry.cancel(uid=uid)
+
+        if self._search:
+            self._search.remove(uid=uid)
+
+    def __lock(self, uid):
+        """
+        :param uid: str
+        :return: Lock
+        """
+        return self._locks[hash(uid) % MODEL_LOCK_STRIPES]
+
+    def __cache(self, record):
+        """
+        Puts a record into the cache, but a record with a staged value or
+        without check sum
+        :param record: dict
+        """
+        if isinstance(record['value'], basestring) and 'check_sum' in record:
+            self._cache.put(record)
+
+    def __remember(self, record, replace=True):
+        """
+        Sets the check sum of a record into the map of the check sums, if
+        any, or forgets the uid of a record without check sum
+        :param record: dict
+        :param replace: bool. False for a read record, keeping the check sum
+        of a write meanwhile.
+        """
+        if not self._check_sums:
+            return
+
+        if 'check_sum' in record:
+            self._check_sums.put(record=record, replace=replace)
+
+        else:
+            self._check_sums.forget(uid=record['uid'])
+
+    def __uncache(self, uid):
+        """
+        Removes a record from the cache, if it is cached
+        :param uid: str
+        """
+        try:
+            self._cache.forget(uid=uid)
+
+        except RecordMissing:
+            pass
+
+    @classmethod
+    def __header(cls, record):
+        """
+        Returns the fields of a record but the value
+        :param record: dict
+        :return: dict
+        """
+        header = dict(record)
+        del header['value']
+
+        return header
+
+    @classmethod
+    def create_many(cls, values, processes=list()):
+        """
+        Creates, processes and returns a batch of records. Every process runs
+        once over the whole batch.
+        :param values: list of tuples (uid, value)
+        :param processes: list
+        :return: list
+        """
+        timestamp = time.time()
+        records = list()
+
+        for uid, value in values:
+            records.append({'uid': uid,
+                            'value': value,
+                            'timestamp': timestamp,
+                            'check_sum': Helpers.sign(value)})
+
+        for process in processes:
+            process.process_many(records)
+
+        for record in records:
+            record['size'] = Helpers.iterable_size(target=record)
+
+        return records
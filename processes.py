@@ -9,6 +9,10 @@ from abc import abstractmethod, ABCMeta
 class Process(object):
     __metaclass__ = ABCMeta
 
+    # False for the processes not reading nor changing the value, which run
+    # over the streamed values too
+    NEEDS_VALUE = True
+
     def __init__(self):
         """
         Constructor
@@ -22,9 +26,20 @@ class Process(object):
         :param record: dict
         """
 
+    @classmethod
+    def process_many(cls, records):
+        """
+        Processes a batch of records
+        :param records: list
+        """
+        for record in records:
+            cls.process(record)
+
 
 class DetectLangProcess(Process):
 
+    NEEDS_VALUE = False
+
     @classmethod
     def process(cls, record):
         """
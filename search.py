@@ -0,0 +1,643 @@
+#!/usr/bin/env python
+"""Full text search over the record values
+"""
+from array import array
+from collections import Counter
+import errno
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import tempfile
+from threading import RLock
+
+import sys
+sys.path.append('..')
+
+from minstore.helpers import Helpers
+
+SEARCH_DIR = '.search'
+MANIFEST_FILENAME = 'manifest.json'
+JOURNAL_FILENAME = 'journal.log'
+POSTINGS_SUFFIX = '.postings'
+TERMS_SUFFIX = '.terms'
+DOCUMENTS_SUFFIX = '.documents'
+
+# Documents indexed into memory before they are written as a segment
+DEFAULT_DELTA_LIMIT = 1000
+
+# Segments on disk before they are merged into one
+DEFAULT_MAX_SEGMENTS = 8
+
+DEFAULT_SEARCH_LIMIT = 10
+
+# Shortest and longest indexed terms
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+# Keyword between the alternatives of a query
+OR_OPERATOR = 'OR'
+
+# Type of the document ids and term frequencies of the posting lists
+POSTING_TYPE = 'I'
+
+
+class Tokenizer(object):
+    """Splits a text into lowercase terms"""
+
+    WORD = re.compile(r'\w+', re.UNICODE)
+
+    @classmethod
+    def tokenize(cls, text):
+        """
+        Returns the terms of a text, repeated as many times as they appear
+        :param text: str|unicode
+        :return: list of unicode
+        """
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+
+        return [term for term in cls.WORD.findall(text.lower())
+                if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH]
+
+    @classmethod
+    def parse_query(cls, query):
+        """
+        Returns the clauses of a query. The terms of a clause are all
+        required, and the clauses are alternatives separated by OR.
+        :param query: str|unicode
+        :return: list of lists of unicode
+        """
+        clauses = list()
+        words = list()
+
+        for word in query.split() + [OR_OPERATOR]:
+            if word != OR_OPERATOR:
+                words.append(word)
+                continue
+
+            terms = cls.tokenize(' '.join(words))
+
+            if terms:
+                clauses.append(sorted(set(terms)))
+
+            words = list()
+
+        return clauses
+
+
+class Segment(object):
+    """
+    Immutable posting lists written to disk. The terms dictionary is read
+    into memory, and the posting lists are read from a memory map of the
+    postings file. Every posting list is an array of sorted document ids
+    followed by an array of their term frequencies. The documents file keeps
+    the uids of the documents of the segment, and the uids of the documents
+    of the previous segments removed meanwhile.
+    """
+
+    def __init__(self, path, segment_id):
+        self.segment_id = segment_id
+
+        with open(Segment.format_path(path, segment_id, TERMS_SUFFIX),
+                  'rb') as terms_file:
+            # term -> (offset, count)
+            self._terms = json.load(terms_file)
+
+        self._file = open(Segment.format_path(path, segment_id,
+                                              POSTINGS_SUFFIX), 'rb')
+        self._map = None
+
+        # a segment of removed documents only has no postings to map
+        if self._terms:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def terms(self):
+        return self._terms.iterkeys()
+
+    def postings(self, term):
+        """
+        Returns the document ids and the frequencies of a term
+        :param term: unicode
+        :return: tuple of arrays
+        """
+        location = self._terms.get(term)
+
+        if location is None:
+            return array(POSTING_TYPE), array(POSTING_TYPE)
+
+        offset, count = location
+        size = count * array(POSTING_TYPE).itemsize
+
+        doc_ids = array(POSTING_TYPE, self._map[offset:offset + size])
+        frequencies = array(POSTING_TYPE,
+                            self._map[offset + size:offset + 2 * size])
+
+        return doc_ids, frequencies
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+
+        self._file.close()
+
+    @classmethod
+    def read_documents(cls, path, segment_id):
+        """
+        Returns the uids of the documents of a segment, None for the
+        tombstones, and the uids removed from the previous segments
+        :param path: str
+        :param segment_id: int
+        :return: tuple of lists
+        """
+        with open(Segment.format_path(path, segment_id, DOCUMENTS_SUFFIX),
+                  'rb') as documents_file:
+            documents = json.load(documents_file)
+
+        return documents['uids'], documents['removed']
+
+    @classmethod
+    def write(cls, path, segment_id, postings, uids, removed):
+        """
+        Writes a segment with the posting lists of the terms and its
+        documents
+        :param path: str
+        :param segment_id: int
+        :param postings: dict of term -> (doc ids array, frequencies array)
+        :param uids: list of the uids of the documents, None for the
+        tombstones
+        :param removed: list of the uids removed from the previous segments
+        """
+        handle, temp_path = tempfile.mkstemp(dir=path)
+
+        with os.fdopen(handle, 'wb') as target:
+            json.dump({'uids': uids, 'removed': removed}, target)
+            os.fsync(target.fileno())
+
+        os.rename(temp_path, cls.format_path(path, segment_id,
+                                             DOCUMENTS_SUFFIX))
+
+        terms = dict()
+        offset = 0
+
+        handle, temp_path = tempfile.mkstemp(dir=path)
+
+        with os.fdopen(handle, 'wb') as target:
+            for term in sorted(postings):
+                doc_ids, frequencies = postings[term]
+
+                target.write(doc_ids.tostring())
+                target.write(frequencies.tostring())
+
+                terms[term] = (offset, len(doc_ids))
+                offset += len(doc_ids) * doc_ids.itemsize * 2
+
+            os.fsync(target.fileno())
+
+        os.rename(temp_path, cls.format_path(path, segment_id,
+                                             POSTINGS_SUFFIX))
+
+        handle, temp_path = tempfile.mkstemp(dir=path)
+
+        with os.fdopen(handle, 'wb') as target:
+            json.dump(terms, target)
+            os.fsync(target.fileno())
+
+        os.rename(temp_path, cls.format_path(path, segment_id, TERMS_SUFFIX))
+
+    @classmethod
+    def format_path(cls, path, segment_id, suffix):
+        """
+        :param path: str
+        :param segment_id: int
+        :param suffix: str
+        :return: str
+        """
+        return '{!s}/segment-{:06d}{!s}'.format(path, segment_id, suffix)
+
+
+class SearchIndex(object):
+    """
+    Inverted index of the record values of a base path.
+
+    Every record gets a document id, a new one on every change. The new
+    documents are indexed into memory and journaled, and written as a new
+    segment after a limit of documents. The document of a deleted or
+    changed record is a tombstone, dropped from the results and from the
+    segments when they are merged, and the documents left are renumbered.
+    The segments are merged when they are too many or when the tombstones
+    outnumber the alive documents.
+
+    The manifest keeps the list of segments. Every segment keeps the uids of
+    its documents, so the uids of the documents are rebuilt on load.
+    """
+
+    def __init__(self, base_path, delta_limit=DEFAULT_DELTA_LIMIT,
+                 max_segments=DEFAULT_MAX_SEGMENTS):
+        """
+        Constructor
+
+        :param base_path: str directory with the search directory.
+        :param delta_limit: int documents into memory before a new segment.
+        :param max_segments: int segments before merging them.
+        """
+        self._path = '{!s}/{!s}'.format(base_path, SEARCH_DIR)
+        self._delta_limit = delta_limit
+        self._max_segments = max_segments
+        self._lock = RLock()
+        self._segments = list()
+        self._next_segment = 1
+        # document id -> uid, None for a tombstone
+        self._uids = list()
+        # uid -> document id of the alive documents
+        self._doc_ids = dict()
+        # term -> (doc ids array, frequencies array) of the new documents
+        self._delta = dict()
+        self._delta_docs = 0
+        # first document id of the new documents, and uids of the documents
+        # of the segments removed meanwhile
+        self._delta_start = 0
+        self._removed = set()
+        self._journal = None
+
+        if not Helpers.path_exists(self._path):
+            os.makedirs(self._path)
+            self.created = True
+
+        else:
+            self.created = False
+            self._load()
+
+        self._journal = open(self.__format_path(JOURNAL_FILENAME), 'ab')
+
+        if self._delta_docs >= self._delta_limit:
+            self.flush()
+
+    def put(self, uid, value):
+        """
+        Indexes the value of a new or changed record
+        :param uid: str
+        :param value: str
+        """
+        frequencies = Counter(Tokenizer.tokenize(text=value))
+
+        self.__change(uid=uid, frequencies=frequencies)
+
+    def remove(self, uid):
+        """
+        Removes a record from the results
+        :param uid: str
+        """
+        self.__change(uid=uid, frequencies=None)
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Returns the uids and scores of the best records for a query, best
+        first. A record matches a clause of the query if its value has all
+        the terms of the clause; its score is the sum of the tf-idf of the
+        terms.
+        :param query: str
+        :param limit: int
+        :return: list of tuples (uid, score)
+        """
+        scores = dict()
+
+        self._lock.acquire()
+
+        try:
+            alive = float(max(len(self._doc_ids), 1))
+
+            for clause in Tokenizer.parse_query(query=query):
+                matches = None
+
+                for term in clause:
+                    frequencies = self.__postings(term=term)
+                    weight = math.log(1 + alive / max(len(frequencies), 1))
+
+                    if matches is None:
+                        matches = dict((doc_id, frequency * weight)
+                                       for doc_id, frequency
+                                       in frequencies.iteritems())
+
+                    else:
+                        matches = dict((doc_id,
+                                        score + frequencies[doc_id] * weight)
+                                       for doc_id, score
+                                       in matches.iteritems()
+                                       if doc_id in frequencies)
+
+                    if not matches:
+                        break
+
+                for doc_id, score in (matches or dict()).iteritems():
+                    scores[doc_id] = max(scores.get(doc_id, 0), score)
+
+            best = heapq.nlargest(limit, scores.iteritems(),
+                                  key=lambda item: item[1])
+
+            return [(self._uids[doc_id], score) for doc_id, score in best]
+
+        finally:
+            self._lock.release()
+
+    def rebuild(self, records):
+        """
+        Replaces the index with the values of the given records
+        :param records: iterable of dict
+        """
+        self._lock.acquire()
+
+        try:
+            for segment in self._segments:
+                segment.close()
+
+            self._segments = list()
+            self._uids = list()
+            self._doc_ids = dict()
+            self._delta = dict()
+            self._delta_docs = 0
+            self._delta_start = 0
+            self._removed = set()
+            self._journal.truncate(0)
+
+            for record in records:
+                self.put(uid=record['uid'], value=record['value'])
+
+            self.flush()
+
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        Writes the documents into memory as a new segment, merges the
+        segments over the maximum or with more tombstones than alive
+        documents, and writes the manifest.
+        """
+        self._lock.acquire()
+
+        try:
+            if len(self._uids) > self._delta_start or self._removed:
+                Segment.write(path=self._path,
+                              segment_id=self._next_segment,
+                              postings=self._delta,
+                              uids=self._uids[self._delta_start:],
+                              removed=sorted(self._removed))
+                self._segments.append(Segment(path=self._path,
+                                              segment_id=self._next_segment))
+                self._next_segment += 1
+
+            self._delta = dict()
+            self._delta_docs = 0
+            self._delta_start = len(self._uids)
+            self._removed = set()
+
+            tombstones = len(self._uids) - len(self._doc_ids)
+
+            if len(self._segments) > self._max_segments or \
+                    tombstones > len(self._doc_ids):
+                self._merge()
+
+            self._write_manifest()
+            self._journal.truncate(0)
+            self._remove_orphans()
+
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+
+        try:
+            self._journal.close()
+
+            for segment in self._segments:
+                segment.close()
+
+        finally:
+            self._lock.release()
+
+    def _merge(self):
+        """
+        Replaces all the segments with one without the tombstones, and
+        renumbers the alive documents. The new documents are written before.
+        """
+        # old document id -> new one, None for the tombstones
+        renumbered = list()
+        uids = list()
+
+        for uid in self._uids:
+            if uid is None:
+                renumbered.append(None)
+                continue
+
+            renumbered.append(len(uids))
+            uids.append(uid)
+
+        terms = set()
+
+        for segment in self._segments:
+            terms.update(segment.terms())
+
+        postings = dict()
+
+        for term in terms:
+            merged_ids = array(POSTING_TYPE)
+            merged_frequencies = array(POSTING_TYPE)
+
+            for segment in self._segments:
+                doc_ids, frequencies = segment.postings(term=term)
+
+                for doc_id, frequency in zip(doc_ids, frequencies):
+                    if renumbered[doc_id] is not None:
+                        merged_ids.append(renumbered[doc_id])
+                        merged_frequencies.append(frequency)
+
+            if merged_ids:
+                postings[term] = (merged_ids, merged_frequencies)
+
+        for segment in self._segments:
+            segment.close()
+
+        self._segments = list()
+
+        if uids:
+            Segment.write(path=self._path,
+                          segment_id=self._next_segment,
+                          postings=postings,
+                          uids=uids,
+                          removed=[])
+            self._segments.append(Segment(path=self._path,
+                                          segment_id=self._next_segment))
+            self._next_segment += 1
+
+        self._uids = uids
+        self._doc_ids = dict((uid, doc_id)
+                             for doc_id, uid in enumerate(uids))
+        self._delta_start = len(uids)
+
+    def _load(self):
+        """
+        Opens the segments of the manifest, rebuilds their documents and
+        replays the journal. A partial last entry of the journal, written on
+        a crash, is dropped.
+        """
+        try:
+            with open(self.__format_path(MANIFEST_FILENAME), 'rb') as source:
+                manifest = json.load(source)
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+            manifest = {'segments': [], 'next_segment': 1}
+
+        self._segments = [Segment(path=self._path, segment_id=segment_id)
+                          for segment_id in manifest['segments']]
+        self._next_segment = manifest['next_segment']
+
+        for segment in self._segments:
+            uids, removed = Segment.read_documents(
+                path=self._path, segment_id=segment.segment_id)
+
+            for uid in removed:
+                doc_id = self._doc_ids.pop(uid, None)
+
+                if doc_id is not None:
+                    self._uids[doc_id] = None
+
+            for uid in uids:
+                if uid is not None:
+                    self._doc_ids[uid] = len(self._uids)
+
+                self._uids.append(uid)
+
+        self._delta_start = len(self._uids)
+
+        try:
+            with open(self.__format_path(JOURNAL_FILENAME), 'rb') as journal:
+                for line in journal:
+                    try:
+                        uid, frequencies = json.loads(line)
+
+                    except ValueError:
+                        break
+
+                    self.__apply(uid=uid, frequencies=frequencies)
+
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def _write_manifest(self):
+        """
+        Writes atomically the list of the segments
+        """
+        manifest = {'segments': [segment.segment_id
+                                 for segment in self._segments],
+                    'next_segment': self._next_segment}
+
+        handle, temp_path = tempfile.mkstemp(dir=self._path)
+
+        with os.fdopen(handle, 'wb') as target:
+            json.dump(manifest, target)
+            os.fsync(target.fileno())
+
+        os.rename(temp_path, self.__format_path(MANIFEST_FILENAME))
+
+    def _remove_orphans(self):
+        """
+        Removes the files of the segments out of the manifest
+        """
+        names = set()
+
+        for segment in self._segments:
+            for suffix in (POSTINGS_SUFFIX, TERMS_SUFFIX, DOCUMENTS_SUFFIX):
+                names.add(os.path.basename(Segment.format_path(
+                    self._path, segment.segment_id, suffix)))
+
+        for name in os.listdir(self._path):
+            if name.startswith('segment-') and name not in names:
+                Helpers.delete_file(file_path=self.__format_path(name))
+
+    def __change(self, uid, frequencies):
+        """
+        Applies and journals the change of a record
+        :param uid: str
+        :param frequencies: dict|None of term -> frequency. None removes the
+        record.
+        """
+        self._lock.acquire()
+
+        try:
+            self.__apply(uid=uid, frequencies=frequencies)
+
+            self._journal.write(json.dumps([uid, frequencies]) + '\n')
+            self._journal.flush()
+
+            if self._delta_docs >= self._delta_limit:
+                self.flush()
+
+        finally:
+            self._lock.release()
+
+    def __apply(self, uid, frequencies):
+        """
+        Replaces the document of a record into memory
+        :param uid: str
+        :param frequencies: dict|None. None removes the record.
+        """
+        if isinstance(uid, str):
+            uid = uid.decode('utf-8')
+
+        previous = self._doc_ids.pop(uid, None)
+
+        if previous is not None:
+            self._uids[previous] = None
+
+            if previous < self._delta_start:
+                self._removed.add(uid)
+
+        if frequencies is None:
+            return
+
+        doc_id = len(self._uids)
+        self._uids.append(uid)
+        self._doc_ids[uid] = doc_id
+
+        for term, frequency in frequencies.iteritems():
+            doc_ids, term_frequencies = self._delta.setdefault(
+                term, (array(POSTING_TYPE), array(POSTING_TYPE)))
+            doc_ids.append(doc_id)
+            term_frequencies.append(frequency)
+
+        self._delta_docs += 1
+
+    def __postings(self, term):
+        """
+        Returns the frequencies by document id of a term, without the
+        tombstones
+        :param term: unicode
+        :return: dict
+        """
+        frequencies = dict()
+        postings = [segment.postings(term=term) for segment in self._segments]
+        postings.append(self._delta.get(term, (array(POSTING_TYPE),
+                                               array(POSTING_TYPE))))
+
+        for doc_ids, term_frequencies in postings:
+            for doc_id, frequency in zip(doc_ids, term_frequencies):
+                if self._uids[doc_id] is not None:
+                    frequencies[doc_id] = frequency
+
+        return frequencies
+
+    def __format_path(self, filename):
+        """
+        :param filename: str
+        :return: str
+        """
+        return '{!s}/{!s}'.format(self._path, filename)
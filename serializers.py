@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""Formats of the records persisted by the storage engines
+"""
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import json
+import struct
+import zlib
+
+import sys
+sys.path.append('..')
+
+from minstore.compression import Compressor, DICTIONARY_CODEC, PLAIN_CODEC
+from minstore.helpers import RecordHelper
+
+# Bytes read from a JSON record looking for the beginning of its value
+HEADER_READ_SIZE = 4096
+
+# JSON of the value field, the last one of a JSON record
+VALUE_MARKER = ', "value": '
+
+# Fields always returned by a header load
+HEADER_FIELDS = ('check_sum', 'timestamp', 'size')
+
+# Leading bytes of a binary record. A JSON record never starts with them.
+BINARY_MAGIC = '\x00MSR'
+
+BINARY_VERSION = 1
+
+# Magic, version, codec, uid length, check_sum, timestamp, size, lang length
+# and extra fields length
+BINARY_HEADER = struct.Struct('>4sBBHqdQBI')
+
+# Id of the dictionary of a value compressed with a dictionary
+DICTIONARY_ID = struct.Struct('>I')
+
+# Lang length of a record without lang
+NO_LANG = 0xFF
+
+# Fields with a place into the binary header
+BINARY_FIELDS = ('uid', 'value', 'check_sum', 'timestamp', 'size', 'lang')
+
+
+class Serializer(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def dumps(self, record):
+        """
+        Returns the record formatted to be persisted
+        :param record: dict
+        :return: str
+        """
+        pass
+
+    @abstractmethod
+    def loads(self, content):
+        """
+        Returns the record of a persisted content or None if it is not valid
+        :param content: str
+        :return: dict|None
+        """
+        pass
+
+    @abstractmethod
+    def load_header(self, source):
+        """
+        Reads from a file the fields of a record but the value, reading and
+        decoding the value only if the format does not allow to skip it.
+        Returns None if the content is not valid.
+        :param source: file
+        :return: dict|None
+        """
+        pass
+
+
+class JsonSerializer(Serializer):
+    """
+    Records as JSON objects with the value as the last field
+    """
+
+    def dumps(self, record):
+        ordered = OrderedDict(sorted((key, item)
+                                     for key, item in record.items()
+                                     if key != 'value'))
+
+        if 'value' in record:
+            ordered['value'] = record['value']
+
+        return json.dumps(ordered)
+
+    def loads(self, content):
+        return RecordHelper.str2record(content=content)
+
+    def load_header(self, source, content=''):
+        """
+        Reads the beginning of the file and returns the fields of the record
+        written before the value, which is left undecoded. Falls back to
+        decode the full record when the header fields are not found before
+        the value, as into the files written by former versions.
+        :param source: file
+        :param content: str beginning of the file already read
+        :return dict|None
+        """
+        content += source.read(HEADER_READ_SIZE)
+        position = content.find(VALUE_MARKER)
+
+        if position >= 0:
+            header = self.loads(content=content[:position] + '}')
+
+            if header and all(field in header for field in HEADER_FIELDS):
+                return header
+
+        record = self.loads(content=content + source.read())
+
+        if record:
+            record.pop('value', None)
+
+        return record
+
+
+class BinarySerializer(Serializer):
+    """
+    Records as a fixed binary header followed by the raw UTF-8 value. Reads
+    the JSON records transparently and writes as JSON the records whose
+    fields do not fit into the header. The codec of the header tells if the
+    value is compressed.
+    """
+
+    def __init__(self, compressor=None):
+        """
+        Constructor
+
+        :param compressor: Compressor of the values. If None the values are
+        written plain, but compressed values are still read if they do not
+        require a dictionary.
+        """
+        self._json = JsonSerializer()
+        self._compressor = compressor
+
+    def dumps(self, record):
+        try:
+            return self._dumps_binary(record=record)
+
+        except (KeyError, TypeError, ValueError, struct.error):
+            return self._json.dumps(record=record)
+
+    def loads(self, content):
+        if not content.startswith(BINARY_MAGIC):
+            return self._json.loads(content=content)
+
+        try:
+            header, codec, dictionary_id, position = \
+                self._loads_header(content=content)
+
+        except (ValueError, struct.error):
+            return None
+
+        if header is None:
+            return None
+
+        try:
+            value = self._decompress(codec=codec,
+                                     dictionary_id=dictionary_id,
+                                     payload=content[position:])
+            header['value'] = value.decode('utf-8')
+
+        except (ValueError, zlib.error):
+            return None
+
+        return header
+
+    def load_header(self, source):
+        content = source.read(BINARY_HEADER.size)
+
+        if not content.startswith(BINARY_MAGIC):
+            return self._json.load_header(source=source, content=content)
+
+        try:
+            fields = BINARY_HEADER.unpack(content)
+
+        except struct.error:
+            return None
+
+        content += source.read(self._fields_length(fields=fields))
+
+        try:
+            header = self._loads_header(content=content)[0]
+
+        except (ValueError, struct.error):
+            return None
+
+        return header
+
+    def _decompress(self, codec, dictionary_id, payload):
+        """
+        Returns the value of a payload
+        :param codec: int
+        :param dictionary_id: int|None
+        :param payload: str
+        :return: str
+        """
+        if self._compressor:
+            return self._compressor.decompress(codec=codec,
+                                               dictionary_id=dictionary_id,
+                                               payload=payload)
+
+        return Compressor.decompress_plain(codec=codec,
+                                           dictionary_id=dictionary_id,
+                                           payload=payload)
+
+    def _dumps_binary(self, record):
+        """
+        Returns the binary format of a record. Raises an exception if any
+        field does not fit into the header.
+        :param record: dict
+        :return: str
+        """
+        uid = self._encode(text=record['uid'])
+        value = self._encode(text=record['value'])
+        lang = record.get('lang')
+
+        if lang is None:
+            lang, lang_length = '', NO_LANG
+
+        else:
+            lang = self._encode(text=lang)
+            lang_length = len(lang)
+
+            if lang_length >= NO_LANG:
+                raise ValueError('Lang too long')
+
+        extra = dict((key, item) for key, item in record.items()
+                     if key not in BINARY_FIELDS)
+        extra = json.dumps(extra) if extra else ''
+
+        if not isinstance(record['check_sum'], (int, long)) \
+                or isinstance(record['check_sum'], bool):
+            raise TypeError('Check sum is not an integer')
+
+        codec, dictionary_id = PLAIN_CODEC, None
+
+        if self._compressor:
+            codec, dictionary_id, value = self._compressor.compress(value)
+
+        header = BINARY_HEADER.pack(BINARY_MAGIC,
+                                    BINARY_VERSION,
+                                    codec,
+                                    len(uid),
+                                    record['check_sum'],
+                                    float(record['timestamp']),
+                                    record['size'],
+                                    lang_length,
+                                    len(extra))
+
+        if codec == DICTIONARY_CODEC:
+            extra += DICTIONARY_ID.pack(dictionary_id)
+
+        return ''.join((header, uid, lang, extra, value))
+
+    @classmethod
+    def _loads_header(cls, content):
+        """
+        Decodes the fields of a binary record but the value. Returns the
+        fields, the codec and dictionary id of the value and its position
+        into the content.
+        :param content: str
+        :return: tuple
+        """
+        fields = BINARY_HEADER.unpack_from(content)
+        magic, version, codec, uid_length, check_sum, timestamp, size, \
+            lang_length, extra_length = fields
+
+        if version != BINARY_VERSION:
+            return None, None, None, None
+
+        position = BINARY_HEADER.size
+        header = dict()
+
+        header['uid'] = content[position:position + uid_length]\
+            .decode('utf-8')
+        position += uid_length
+
+        if lang_length != NO_LANG:
+            header['lang'] = content[position:position + lang_length]\
+                .decode('utf-8')
+            position += lang_length
+
+        if extra_length:
+            header.update(json.loads(content[position:
+                                             position + extra_length]))
+            position += extra_length
+
+        dictionary_id = None
+
+        if codec == DICTIONARY_CODEC:
+            dictionary_id, = DICTIONARY_ID.unpack_from(content, position)
+            position += DICTIONARY_ID.size
+
+        header['check_sum'] = check_sum
+        header['timestamp'] = timestamp
+        header['size'] = size
+
+        return header, codec, dictionary_id, position
+
+    @classmethod
+    def _fields_length(cls, fields):
+        """
+        Returns the bytes between the fixed header and the value
+        :param fields: tuple
+        :return: int
+        """
+        codec, uid_length = fields[2], fields[3]
+        lang_length, extra_length = fields[7], fields[8]
+
+        if lang_length == NO_LANG:
+            lang_length = 0
+
+        length = uid_length + lang_length + extra_length
+
+        if codec == DICTIONARY_CODEC:
+            length += DICTIONARY_ID.size
+
+        return length
+
+    @classmethod
+    def _encode(cls, text):
+        """
+        Returns the UTF-8 bytes of a text
+        :param text: unicode|str
+        :return: str
+        """
+        if isinstance(text, unicode):
+            return text.encode('utf-8')
+
+        if not isinstance(text, str):
+            raise TypeError('Not a text')
+
+        text.decode('utf-8')
+
+        return text
@@ -3,12 +3,103 @@
 """
 
 from abc import ABCMeta, abstractmethod
+import bisect
+import errno
+import hashlib
 import json
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from Queue import Empty, LifoQueue
+from StringIO import StringIO
+from threading import Condition, Event, Lock, RLock, Thread, local
 
 import sys
 sys.path.append('..')
 
+from minstore.chunks import ChunkedValue, DEFAULT_CHUNK_THRESHOLD
+from minstore.constants import CREATED, DELETED, EXISTS, MISSING
+from minstore.exceptions import BlobMissing, RecordExists, RecordMissing
 from minstore.helpers import Helpers, RecordHelper
+from minstore.serializers import JsonSerializer
+
+# Number of shard levels of a flat layout, all the files into the base path
+FLAT_LAYOUT = 0
+
+# Hexadecimal characters of the uid hash per shard level, 2 are 256 dirs
+DEFAULT_SHARD_WIDTH = 2
+
+# Uids copied at once out of the sorted uids of a FileStorage while listing
+UID_LIST_BATCH = 1000
+
+# Write durability of the FileStorage and LogStorage engines.
+# Atomic: the records are written to a temporary file renamed over the record,
+# or appended whole to the segment.
+# Fsync: as atomic, and every write is synced to disk before returning.
+# Group: as fsync, but the concurrent writes share the syncs to disk.
+ATOMIC_DURABILITY = 'atomic'
+FSYNC_DURABILITY = 'fsync'
+GROUP_DURABILITY = 'group'
+
+# Seconds a group commit waits for more writes before syncing them
+DEFAULT_GROUP_COMMIT_WINDOW = 0.002
+
+# Suffix of the temporary files of the writes in progress
+TEMP_SUFFIX = '.tmp'
+
+# Size in bytes of a log segment before rolling over to a new one
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Ratio of dead bytes over total bytes which triggers a log compaction
+DEFAULT_COMPACTION_RATIO = 0.5
+
+# Seconds between two checks of the log compaction thread.
+# Set to 0 to disable background compaction.
+DEFAULT_COMPACTION_INTERVAL = 60
+
+# Database file of the SQLite engine into the base path
+SQLITE_FILENAME = 'minstore.sqlite'
+
+# Idle connections kept open by the SQLite engine
+DEFAULT_SQLITE_POOL_SIZE = 8
+
+# Seconds a SQLite connection waits for a lock before failing
+DEFAULT_SQLITE_TIMEOUT = 30
+
+# Compiled statements cached by every SQLite connection
+SQLITE_CACHED_STATEMENTS = 32
+
+# Parameters of a SQLite statement, under the lowest compiled limit
+SQLITE_MAX_PARAMETERS = 500
+
+# Rows read by every query of a scan
+SQLITE_SCAN_PAGE_SIZE = 100
+
+# Locks shared by the uids of a wrapper storage
+WRAPPER_LOCK_STRIPES = 64
+
+# Field of a deduplicated record with the digest of its value
+DIGEST_FIELD = 'digest'
+
+# Field of a record with the location of the chunks of its value
+CHUNKS_FIELD = 'chunks'
+
+# Operations of the records pending into a write-behind buffer
+WRITE_PENDING = 'write'
+DELETE_PENDING = 'delete'
+
+# Records pending into a write-behind buffer at most. A write over it
+# flushes the buffer before returning.
+DEFAULT_WRITE_BEHIND_MAX_RECORDS = 1000
+
+# Records pending into a write-behind buffer which start a flush
+DEFAULT_WRITE_BEHIND_FLUSH_RECORDS = 100
+
+# Seconds a write waits into a write-behind buffer at most
+DEFAULT_WRITE_BEHIND_MAX_AGE = 0.05
 
 
 class Storage(object):
@@ -23,20 +114,34 @@ class Storage(object):
         Select query for database
         :param uid: str|int
         :return: dict
+        :raise RecordMissing
         """
         pass
 
+    def select_header(self, uid):
+        """
+        Select query for database of all the fields of a record but the value
+        :param uid: str|int
+        :return: dict
+        :raise RecordMissing
+        """
+        record = self.select(uid=uid)
+        record.pop('value', None)
+
+        return record
+
     @abstractmethod
     def insert(self, **params):
         """
         Insert query for database
+        :raise RecordExists
         """
         pass
 
     @abstractmethod
     def update(self, **params):
         """
-        Update query for database
+        Update query for database. Creates the record if it is missing.
         """
         pass
 
@@ -45,94 +150,2633 @@ class Storage(object):
         """
         Delete query for database
         :param uid: str|int
+        :raise RecordMissing
+        """
+        pass
+
+    def update_by_digest(self, record):
+        """
+        Update query for database of a record without value, taking the
+        value already stored with the digest of the record.
+        :param record: dict
+        :raise BlobMissing
+        """
+        raise BlobMissing('Blob Error: Storage has no values by digest')
+
+    def select_stream(self, uid):
+        """
+        Select query for database of a record to stream its value. Returns
+        the fields of the record but the value, the bytes length of the
+        value and a function returning a generator of the bytes of the value
+        from a start to an end, end excluded.
+        :param uid: str|int
+        :return: tuple (dict, int, callable)
+        :raise RecordMissing
+        """
+        return RecordHelper.stream_record(record=self.select(uid=uid))
+
+    def stage_value(self, stream, length):
+        """
+        Reads a value from a stream to insert or update it as the value of a
+        record. Raises ValueError if the stream is shorter than the length
+        or it is not UTF-8 text.
+        :param stream: file
+        :param length: int bytes to read
+        :return: unicode|object
+        """
+        content = stream.read(length)
+
+        if len(content) < length:
+            raise ValueError('Value shorter than its length')
+
+        return content.decode('utf-8')
+
+    def exists(self, uid):
+        """
+        Checks if a record exists and returns True or False.
+        :param uid: str|int
+        :return: bool
+        """
+        try:
+            self.select_header(uid=uid)
+
+        except RecordMissing:
+            return False
+
+        return True
+
+    @abstractmethod
+    def iter_uids(self, prefix=None, start_after=None):
+        """
+        Yields the uids of the records in uid order
+        :param prefix: str only the uids starting with it
+        :param start_after: str only the uids greater than it
+        :return: generator
+        """
+        pass
+
+    def scan(self, prefix=None, start_after=None, limit=None):
+        """
+        Yields the records in uid order, reading them one by one. The records
+        deleted meanwhile are skipped.
+        :param prefix: str only the uids starting with it
+        :param start_after: str only the uids greater than it
+        :param limit: int maximum number of records
+        :return: generator
+        """
+        count = 0
+
+        for uid in self.iter_uids(prefix=prefix, start_after=start_after):
+            if limit is not None and count >= limit:
+                return
+
+            try:
+                record = self.select(uid=uid)
+
+            except RecordMissing:
+                continue
+
+            count += 1
+            yield record
+
+    @classmethod
+    def _iter_sorted(cls, uids, prefix=None, start_after=None):
+        """
+        Yields the uids of a sorted list in the range of a scan
+        :param uids: list sorted
+        :param prefix: str
+        :param start_after: str
+        :return: generator
+        """
+        position = 0
+
+        if prefix:
+            position = bisect.bisect_left(uids, prefix)
+
+        if start_after is not None:
+            position = max(position, bisect.bisect_right(uids, start_after))
+
+        for uid in uids[position:]:
+            if prefix and not uid.startswith(prefix):
+                return
+
+            yield uid
+
+    def select_many(self, uids):
+        """
+        Select query for database of a batch of records. Returns the records
+        by uid, None for the missing ones.
+        :param uids: list
+        :return: dict
+        """
+        records = dict()
+
+        for uid in uids:
+            try:
+                records[uid] = self.select(uid=uid)
+
+            except RecordMissing:
+                records[uid] = None
+
+        return records
+
+    def insert_many(self, records):
+        """
+        Insert query for database of a batch of records. Returns the result
+        by uid, CREATED or EXISTS.
+        :param records: list
+        :return: dict
+        """
+        results = dict()
+
+        for record in records:
+            try:
+                self.insert(record=record)
+                results[record['uid']] = CREATED
+
+            except RecordExists:
+                results[record['uid']] = EXISTS
+
+        return results
+
+    def delete_many(self, uids):
+        """
+        Delete query for database of a batch of records. Returns the result
+        by uid, DELETED or MISSING.
+        :param uids: list
+        :return: dict
+        """
+        results = dict()
+
+        for uid in uids:
+            try:
+                self.delete(uid=uid)
+                results[uid] = DELETED
+
+            except RecordMissing:
+                results[uid] = MISSING
+
+        return results
+
+    def close(self):
+        """
+        Releases the resources held by the engine
         """
         pass
 
 
+class GroupCommit(object):
+    """
+    Shares the syncs to disk of the writes arriving within a time window. The
+    first write of a window leads the batch: waits for the window to end,
+    syncs the files of all the writes, renames them over their records and
+    syncs their directories once. Every write returns when its batch is
+    durable.
+    """
+
+    def __init__(self, window=DEFAULT_GROUP_COMMIT_WINDOW):
+        """
+        Constructor
+
+        :param window: float seconds the leader of a batch waits for more
+        writes.
+        """
+        self._window = window
+        self._lock = Lock()
+        self._batch = None
+        self._last_batch = None
+
+    def commit(self, temp_file, temp_path, file_path, overwrite=True):
+        """
+        Joins the write to the open batch and blocks until the batch is
+        durable. Raises the error of the write or the batch if any.
+        :param temp_file: file
+        :param temp_path: str
+        :param file_path: str
+        :param overwrite: bool. If False raises RecordExists when the record
+        file already exists.
+        """
+        self._lock.acquire()
+
+        try:
+            batch = self._batch
+            is_leader = batch is None
+
+            if is_leader:
+                batch = _CommitBatch(previous=self._last_batch)
+                self._batch = batch
+                self._last_batch = batch
+
+            write = _CommitWrite(temp_file=temp_file,
+                                 temp_path=temp_path,
+                                 file_path=file_path,
+                                 overwrite=overwrite)
+            batch.writes.append(write)
+
+        finally:
+            self._lock.release()
+
+        if is_leader:
+            time.sleep(self._window)
+
+            self._lock.acquire()
+
+            try:
+                self._batch = None
+
+            finally:
+                self._lock.release()
+
+            batch.flush()
+
+        else:
+            batch.done.wait()
+
+        if batch.error:
+            raise batch.error
+
+        if write.error:
+            raise write.error
+
+
+class _CommitWrite(object):
+    """
+    Write of a group commit
+    """
+
+    def __init__(self, temp_file, temp_path, file_path, overwrite):
+        self.temp_file = temp_file
+        self.temp_path = temp_path
+        self.file_path = file_path
+        self.overwrite = overwrite
+        self.error = None
+
+
+class _CommitBatch(object):
+    """
+    Writes of a group commit
+    """
+
+    def __init__(self, previous=None):
+        self.writes = list()
+        self.done = Event()
+        self.error = None
+        self._previous = previous
+
+    def flush(self):
+        """
+        Syncs and renames the writes of the batch after the previous batch
+        is done, so the renames keep the order of the writes.
+        """
+        if self._previous:
+            self._previous.done.wait()
+            self._previous = None
+
+        try:
+            for write in self.writes:
+                os.fsync(write.temp_file.fileno())
+
+            dir_paths = set()
+
+            for write in self.writes:
+                try:
+                    Helpers.publish_file(temp_path=write.temp_path,
+                                         file_path=write.file_path,
+                                         overwrite=write.overwrite)
+
+                except RecordExists, exc:
+                    write.error = exc
+                    continue
+
+                dir_paths.add(os.path.dirname(write.file_path))
+
+            for dir_path in dir_paths:
+                Helpers.sync_dir(dir_path=dir_path)
+
+        except Exception, exc:
+            self.error = exc
+
+        finally:
+            self.done.set()
+
+
 class FileStorage(Storage):
     """
     Engine for a storage based on files
+
+    The scans keep the uids of all the records in memory, as a sorted list
+    built by the first scan and kept up to date by the writes: the sharded
+    layout spreads the uids by their hash, so no directory order lists them
+    sorted. The memory of the list grows with the number of records, about
+    the size of the uids.
     """
 
     def __init__(self, **params):
         """
         Constructor
+
+        :param base_path: str directory for the record files.
+        :param shard_levels: int levels of nested subdirectories to spread the
+        records into. If 0 all the records are stored into the base path.
+        :param shard_width: int hexadecimal characters of the uid hash per
+        level. 2 characters are 256 subdirectories per level.
+        :param durability: str ATOMIC_DURABILITY renames a temporary file
+        over the record file, FSYNC_DURABILITY syncs every write to disk and
+        GROUP_DURABILITY shares the syncs of the concurrent writes.
+        :param group_commit_window: float seconds a group commit waits for
+        more writes.
+        :param serializer: Serializer format of the record files. JSON by
+        default.
         """
         super(FileStorage, self).__init__(**params)
 
         self._base_path = params['base_path']
-        self._file = None
+        self._shard_levels = params.get('shard_levels', FLAT_LAYOUT)
+        self._shard_width = params.get('shard_width', DEFAULT_SHARD_WIDTH)
+        self._durability = params.get('durability', ATOMIC_DURABILITY)
+        self._serializer = params.get('serializer') or JsonSerializer()
+        self._group_commit = None
+        # sorted names of the files of the base path, listed on the first
+        # scan and kept up to date by the writes
+        self._uids = None
+        self._uids_lock = Lock()
+
+        if self._durability == GROUP_DURABILITY:
+            self._group_commit = GroupCommit(
+                window=params.get('group_commit_window',
+                                  DEFAULT_GROUP_COMMIT_WINDOW))
 
     def update(self, record):
-        file_path = self.__format_filename(filename=record['uid'],
-                                           base_path=self._base_path)
-        with open(file_path, 'wb+') as self._file:
-            self._write(record=record)
+        file_path = self.__format_filename(filename=record['uid'])
+        self._write_file(file_path=file_path, record=record)
+        self.__add_uid(uid=record['uid'])
 
     def insert(self, record):
-        file_path = self.__format_filename(filename=record['uid'],
-                                           base_path=self._base_path)
-        with open(file_path, 'wb+') as self._file:
-            self._write(record=record)
+        uid = record['uid']
+
+        if self._shard_levels != FLAT_LAYOUT and Helpers.path_exists(
+                self.__format_flat_filename(filename=uid)):
+            # Not migrated yet
+            raise RecordExists(
+                'Insert Error: Record {!s} already exists'.format(uid))
+
+        file_path = self.__format_filename(filename=uid)
+        self._write_file(file_path=file_path, record=record, overwrite=False)
+        self.__add_uid(uid=uid)
 
     def select(self, uid):
-        file_path = self.__format_filename(filename=uid,
-                                           base_path=self._base_path)
-        with open(file_path, 'rb') as self._file:
-            record = self._read()
+        with self._open_for_read(uid=uid) as record_file:
+            record = self._read(source=record_file)
+
+        return record
+
+    def select_header(self, uid):
+        with self._open_for_read(uid=uid) as record_file:
+            record = self._read_header(source=record_file)
 
         return record
 
     def delete(self, uid):
         self._remove_file_by_uid(uid=uid)
+        self.__remove_uid(uid=uid)
+
+    def select_many(self, uids):
+        """
+        Reads the records sorted by file path, so the files of a directory
+        are read together.
+        """
+        ordered = sorted(uids, key=lambda uid: self.__format_filename(uid))
+
+        return super(FileStorage, self).select_many(uids=ordered)
+
+    def insert_many(self, records):
+        """
+        Writes the temporary files of all the records, syncs them to disk if
+        the durability requires it and publishes them. Every directory is
+        created and synced once for the batch.
+        """
+        results = dict()
+        writes = list()
+        dir_paths = set()
+
+        try:
+            for record in records:
+                uid = record['uid']
+
+                if self._shard_levels != FLAT_LAYOUT and Helpers.path_exists(
+                        self.__format_flat_filename(filename=uid)):
+                    results[uid] = EXISTS
+                    continue
+
+                file_path = self.__format_filename(filename=uid)
+                temp_file, temp_path = self._open_for_write(
+                    file_path=file_path)
+                writes.append((uid, temp_path, file_path))
+
+                try:
+                    self._write(target=temp_file, record=record)
+                    temp_file.flush()
+
+                    if self._durability != ATOMIC_DURABILITY:
+                        os.fsync(temp_file.fileno())
+
+                finally:
+                    temp_file.close()
+
+            for uid, temp_path, file_path in writes:
+                try:
+                    Helpers.publish_file(temp_path=temp_path,
+                                         file_path=file_path,
+                                         overwrite=False)
+                    results[uid] = CREATED
+                    dir_paths.add(os.path.dirname(file_path))
+                    self.__add_uid(uid=uid)
+
+                except RecordExists:
+                    results[uid] = EXISTS
+
+        finally:
+            for uid, temp_path, file_path in writes:
+                if Helpers.path_exists(temp_path):
+                    Helpers.delete_file(file_path=temp_path)
+
+        if self._durability != ATOMIC_DURABILITY:
+            for dir_path in dir_paths:
+                Helpers.sync_dir(dir_path=dir_path)
+
+        return results
+
+    def migrate(self):
+        """
+        Moves the records stored into the flat base path to the sharded
+        layout. The records keep being available while moving. Returns the
+        number of moved records.
+        :return: int
+        """
+        moved = 0
+
+        if self._shard_levels == FLAT_LAYOUT:
+            return moved
+
+        for filename in os.listdir(self._base_path):
+            flat_path = self.__format_flat_filename(filename=filename)
+
+            if not self.__is_flat_record(filename=filename,
+                                         file_path=flat_path):
+                continue
+
+            file_path = self.__format_filename(filename=filename)
+            self._make_shard_dirs(file_path=file_path)
+            moved += 1
+
+            if not os.path.isfile(flat_path):
+                # Relocated because of colliding with its shard directory
+                continue
+
+            try:
+                os.link(flat_path, file_path)
+
+            except OSError, exc:
+                # A newer copy was already written to the sharded layout
+                if exc.errno != errno.EEXIST:
+                    raise
+
+            with Helpers.lock_dir(dir_path=self._base_path):
+                Helpers.delete_file(file_path=flat_path)
+
+        return moved
+
+    def iter_uids(self, prefix=None, start_after=None):
+        """
+        Yields the names of the record files from a sorted list of them. The
+        list is built once, listing both layouts, and kept up to date by the
+        writes, since the sharded layout spreads the uids out of order. A
+        page costs the uids it yields, copied a batch at once. The files
+        written by other processes after the listing are not seen.
+        """
+        prefix = self.__filename(prefix)
+        start_after = self.__filename(start_after)
+
+        while True:
+            self._uids_lock.acquire()
+
+            try:
+                uids = self.__list_uids()
+                position = 0
+
+                if prefix:
+                    position = bisect.bisect_left(uids, prefix)
+
+                if start_after is not None:
+                    position = max(position,
+                                   bisect.bisect_right(uids, start_after))
+
+                batch = uids[position:position + UID_LIST_BATCH]
+
+            finally:
+                self._uids_lock.release()
+
+            if not batch:
+                return
+
+            for uid in batch:
+                if prefix and not uid.startswith(prefix):
+                    return
+
+                yield uid
+
+            start_after = batch[-1]
 
-    def _read(self):
+    def scan(self, prefix=None, start_after=None, limit=None):
+        """
+        Yields the records in uid order. The files which are not records,
+        as the servers list, are skipped.
+        """
+        count = 0
+
+        for uid in self.iter_uids(prefix=prefix, start_after=start_after):
+            if limit is not None and count >= limit:
+                return
+
+            try:
+                with self._open_for_read(uid=uid) as record_file:
+                    record = self._read(source=record_file)
+
+            except RecordMissing:
+                continue
+
+            except ValueError:
+                continue
+
+            if isinstance(record, dict) and record.get('uid') == uid:
+                count += 1
+                yield record
+
+    def iter_records(self):
+        """
+        Yields the path and the record of every record file of the base path
+        in both layouts, in no particular order.
+        :return: generator
+        """
+        for file_path, record, stat in self._iter_record_files():
+            yield file_path, record
+
+    def _iter_record_files(self):
+        """
+        Yields the path, the record and the stat of every record file, the
+        stat taken from the opened file so it matches the read record.
+        :return: generator
+        """
+        for dir_path, dir_names, filenames in os.walk(self._base_path):
+            dir_names[:] = [name for name in dir_names
+                            if not name.startswith('.')]
+
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+
+                file_path = '{!s}/{!s}'.format(dir_path, filename)
+
+                try:
+                    with open(file_path, 'rb') as record_file:
+                        stat = os.fstat(record_file.fileno())
+                        record = self._read(source=record_file)
+
+                except IOError, exc:
+                    # Deleted meanwhile
+                    if exc.errno != errno.ENOENT:
+                        raise
+
+                    continue
+
+                if isinstance(record, dict) and record.get('uid') == filename:
+                    yield file_path, record, stat
+
+    def rewrite(self, pause=0):
+        """
+        Rewrites every record with the current format and compression. The
+        records written meanwhile are skipped: the file is compared with the
+        one read right before renaming the rewritten one over it, holding
+        alone the lock of the directory the writes of any process share.
+        Returns the number of rewritten records.
+        :param pause: float seconds to sleep between two records to leave
+        disk time to the server.
+        :return: int
+        """
+        rewritten = 0
+
+        for file_path, record, stat in self._iter_record_files():
+            temp_file, temp_path = self._open_for_write(file_path=file_path)
+
+            try:
+                self._write(target=temp_file, record=record)
+                temp_file.flush()
+
+                if self._durability != ATOMIC_DURABILITY:
+                    os.fsync(temp_file.fileno())
+
+            finally:
+                temp_file.close()
+
+            # the writes of the directory wait for the check and the rename
+            with Helpers.lock_dir(dir_path=os.path.dirname(file_path),
+                                  exclusive=True):
+                unchanged = self.__is_unchanged(file_path=file_path,
+                                                stat=stat)
+
+                if unchanged:
+                    os.rename(temp_path, file_path)
+                    rewritten += 1
+
+            if not unchanged:
+                Helpers.delete_file(file_path=temp_path)
+
+            if pause:
+                time.sleep(pause)
+
+        return rewritten
+
+    def _read(self, source):
         """
         Reads the file and returns the content formatted as expected record
+        :param source: file
         :return dict
         """
-        content = self._file.read()
-        record = RecordHelper.str2record(content=content)
+        content = source.read()
+        record = self._serializer.loads(content=content)
 
         return record
 
-    def _write(self, record):
+    def _read_header(self, source):
+        """
+        Reads the file and returns the fields of the record but the value
+        :param source: file
+        :return dict
+        """
+        return self._serializer.load_header(source=source)
+
+    def _write(self, target, record):
         """
         Writes a formatted record to the file
+        :param target: file
+        :param record: dict
+        """
+        content = self._serializer.dumps(record=record)
+
+        target.write(content)
+
+    def _write_file(self, file_path, record, overwrite=True):
+        """
+        Writes the record to a temporary file and renames it to the record
+        path, so a crash never leaves a truncated record. Returns once the
+        write is as durable as configured.
+        :param file_path: str
         :param record: dict
+        :param overwrite: bool. If False raises RecordExists when the record
+        file already exists.
         """
-        content = json.dumps(record)
+        temp_file, temp_path = self._open_for_write(file_path=file_path)
+
+        try:
+            self._write(target=temp_file, record=record)
+            temp_file.flush()
+
+            if self._durability == GROUP_DURABILITY:
+                self._group_commit.commit(temp_file=temp_file,
+                                          temp_path=temp_path,
+                                          file_path=file_path,
+                                          overwrite=overwrite)
+                return
+
+            if self._durability == FSYNC_DURABILITY:
+                os.fsync(temp_file.fileno())
+
+            Helpers.publish_file(temp_path=temp_path,
+                                 file_path=file_path,
+                                 overwrite=overwrite)
+
+            if self._durability == FSYNC_DURABILITY:
+                Helpers.sync_dir(dir_path=os.path.dirname(file_path))
+
+        except Exception:
+            if Helpers.path_exists(temp_path):
+                Helpers.delete_file(file_path=temp_path)
+
+            raise
 
-        self._file.write(content)
+        finally:
+            temp_file.close()
 
     def exists(self, uid):
+        for file_path in self.__candidate_filenames(uid=uid):
+            if Helpers.path_exists(file_path):
+                return True
+
+        return False
+
+    def _remove_file_by_uid(self, uid):
         """
-        Checks if a record exists and returns True or False.
+        Removes the file. While migrating, removes the copies of both layouts.
         :param uid: str
-        :return: bool
         """
-        file_path = self.__format_filename(filename=uid,
-                                           base_path=self._base_path)
+        removed = False
 
-        return Helpers.path_exists(file_path)
+        for file_path in self.__candidate_filenames(uid=uid):
+            try:
+                # a rewrite in progress must not bring the file back
+                with Helpers.lock_dir(dir_path=os.path.dirname(file_path)):
+                    Helpers.delete_file(file_path=file_path)
 
-    def _remove_file_by_uid(self, uid):
+                removed = True
+
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+
+        if not removed:
+            raise RecordMissing(
+                'Delete Error: Record {!s} is missing'.format(uid))
+
+    def _open_for_read(self, uid):
         """
-        Removes the file
+        Opens the file of a record for reading. Looks for the file into the
+        sharded layout first and into the flat one after.
         :param uid: str
+        :return: file
+        :raise RecordMissing
         """
-        file_path = self.__format_filename(filename=uid,
-                                           base_path=self._base_path)
+        for file_path in self.__candidate_filenames(uid=uid):
+            try:
+                return open(file_path, 'rb')
 
-        return Helpers.delete_file(file_path=file_path)
+            except IOError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
 
-    @classmethod
-    def __format_filename(cls, filename, base_path):
+        raise RecordMissing(
+            'Select Error: Record {!s} is missing'.format(uid))
+
+    def _open_for_write(self, file_path):
         """
-        :param filename: str
-        :param base_path: str
-        :return: str
+        Opens a temporary file next to the file of a record for writing.
+        Creates the shard directories when missing. Returns the file and its
+        path.
+        :param file_path: str
+        :return: tuple
         """
-        file_path = '{!s}/{!s}'.format(base_path, filename)
+        dir_path, filename = os.path.split(file_path)
+        prefix = '.{!s}.'.format(filename)
 
-        return file_path
+        try:
+            handle, temp_path = tempfile.mkstemp(suffix=TEMP_SUFFIX,
+                                                 prefix=prefix,
+                                                 dir=dir_path)
+
+        except OSError, exc:
+            if exc.errno != errno.ENOENT or self._shard_levels == FLAT_LAYOUT:
+                raise
+
+            self._make_shard_dirs(file_path=file_path)
+            handle, temp_path = tempfile.mkstemp(suffix=TEMP_SUFFIX,
+                                                 prefix=prefix,
+                                                 dir=dir_path)
+
+        return os.fdopen(handle, 'wb'), temp_path
+
+    def _make_shard_dirs(self, file_path):
+        """
+        Creates the directories of a sharded file path. A flat record named
+        as the first level directory is moved to the sharded layout before.
+        :param file_path: str
+        """
+        dir_path = os.path.dirname(file_path)
+        top_name = dir_path[len(self._base_path) + 1:].split('/')[0]
+        top_path = self.__format_flat_filename(filename=top_name)
+
+        if os.path.isfile(top_path):
+            self.__relocate_flat_record(filename=top_name)
+
+        try:
+            os.makedirs(dir_path)
+
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def __relocate_flat_record(self, filename):
+        """
+        Moves away a flat record whose name collides with a shard directory
+        :param filename: str
+        """
+        flat_path = self.__format_flat_filename(filename=filename)
+        moving_path = self.__format_flat_filename(
+            filename='.relocating-{!s}'.format(filename))
+
+        os.rename(flat_path, moving_path)
+        os.mkdir(flat_path)
+
+        file_path = self.__format_filename(filename=filename)
+        self._make_shard_dirs(file_path=file_path)
+
+        if Helpers.path_exists(file_path):
+            Helpers.delete_file(file_path=moving_path)
+
+        else:
+            os.rename(moving_path, file_path)
+
+    def __list_uids(self):
+        """
+        Returns the sorted names of the files of both layouts, listing them
+        on the first call. The caller holds the lock of the uids. The list
+        takes memory in proportion to the records, see the class.
+        :return: list
+        """
+        if self._uids is None:
+            uids = set()
+
+            for dir_path, dir_names, filenames in os.walk(self._base_path):
+                dir_names[:] = [name for name in dir_names
+                                if not name.startswith('.')]
+                uids.update(filename for filename in filenames
+                            if not filename.startswith('.'))
+
+            self._uids = sorted(uids)
+
+        return self._uids
+
+    def __add_uid(self, uid):
+        """
+        Adds a written uid to the sorted uids, if they are listed
+        :param uid: str
+        """
+        uid = self.__filename(uid)
+
+        self._uids_lock.acquire()
+
+        try:
+            if self._uids is None:
+                return
+
+            position = bisect.bisect_left(self._uids, uid)
+
+            if position == len(self._uids) or self._uids[position] != uid:
+                self._uids.insert(position, uid)
+
+        finally:
+            self._uids_lock.release()
+
+    def __remove_uid(self, uid):
+        """
+        Removes a deleted uid from the sorted uids, if they are listed
+        :param uid: str
+        """
+        uid = self.__filename(uid)
+
+        self._uids_lock.acquire()
+
+        try:
+            if self._uids is None:
+                return
+
+            position = bisect.bisect_left(self._uids, uid)
+
+            if position < len(self._uids) and self._uids[position] == uid:
+                del self._uids[position]
+
+        finally:
+            self._uids_lock.release()
+
+    def __candidate_filenames(self, uid):
+        """
+        Returns the file paths where a record can be found, the current
+        layout first.
+        :param uid: str
+        :return: list
+        """
+        file_paths = [self.__format_filename(filename=uid)]
+
+        if self._shard_levels != FLAT_LAYOUT:
+            file_paths.append(self.__format_flat_filename(filename=uid))
+
+        return file_paths
+
+    @classmethod
+    def __filename(cls, uid):
+        """
+        Returns a uid as it is listed into the base path
+        :param uid: str|unicode|None
+        :return: str|None
+        """
+        if isinstance(uid, unicode):
+            return uid.encode('utf-8')
+
+        return uid
+
+    def __is_flat_record(self, filename, file_path):
+        """
+        Checks if a file of the flat base path is a record
+        :param filename: str
+        :param file_path: str
+        :return: bool
+        """
+        if filename.startswith('.') or not os.path.isfile(file_path):
+            return False
+
+        with open(file_path, 'rb') as record_file:
+            record = self._read(source=record_file)
+
+        return isinstance(record, dict) and record.get('uid') == filename
+
+    @classmethod
+    def __is_unchanged(cls, file_path, stat):
+        """
+        Checks if a file is still the one of a stat. A write renames a new
+        file over it, changing the inode, and an in place change moves the
+        modification time or the size.
+        :param file_path: str
+        :param stat: posix.stat_result
+        :return: bool
+        """
+        try:
+            current = os.stat(file_path)
+
+        except OSError:
+            return False
+
+        return (current.st_ino, current.st_mtime, current.st_size) == \
+            (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def __format_filename(self, filename):
+        """
+        Returns the path of the record file for the configured layout
+        :param filename: str
+        :return: str
+        """
+        if self._shard_levels == FLAT_LAYOUT:
+            return self.__format_flat_filename(filename=filename)
+
+        if isinstance(filename, unicode):
+            digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+
+        else:
+            digest = hashlib.md5(filename).hexdigest()
+
+        width = self._shard_width
+        shards = [digest[level * width:(level + 1) * width]
+                  for level in range(self._shard_levels)]
+
+        file_path = '{!s}/{!s}/{!s}'.format(self._base_path,
+                                            '/'.join(shards),
+                                            filename)
+
+        return file_path
+
+    def __format_flat_filename(self, filename):
+        """
+        :param filename: str
+        :return: str
+        """
+        file_path = '{!s}/{!s}'.format(self._base_path, filename)
+
+        return file_path
+
+
+class LogStorage(Storage):
+    """
+    Engine for a storage based on append-only segment files. Keeps an
+    in-memory index of the position of every live record and compacts the
+    dead entries in the background.
+    """
+
+    SEGMENT_PREFIX = 'segment-'
+    SEGMENT_SUFFIX = '.log'
+
+    def __init__(self, **params):
+        """
+        Constructor
+
+        :param base_path: str directory for the segment files.
+        :param segment_size: int maximum bytes of a segment before rolling
+        over to a new one.
+        :param compaction_ratio: float ratio of dead bytes triggering a
+        compaction.
+        :param compaction_interval: int seconds between compaction checks. If
+        0 the background compaction is disabled.
+        :param durability: str ATOMIC_DURABILITY only flushes the appends,
+        FSYNC_DURABILITY syncs every append to disk and GROUP_DURABILITY
+        shares the syncs of the concurrent appends.
+        :param group_commit_window: float seconds the first append of a group
+        sync waits for more appends.
+        """
+        super(LogStorage, self).__init__(**params)
+
+        self._base_path = params['base_path']
+        self._segment_size = params.get('segment_size', DEFAULT_SEGMENT_SIZE)
+        self._compaction_ratio = params.get('compaction_ratio',
+                                            DEFAULT_COMPACTION_RATIO)
+        self._compaction_interval = params.get('compaction_interval',
+                                               DEFAULT_COMPACTION_INTERVAL)
+        self._durability = params.get('durability', ATOMIC_DURABILITY)
+        self._group_commit_window = params.get('group_commit_window',
+                                               DEFAULT_GROUP_COMMIT_WINDOW)
+
+        # uid -> (segment id, offset, length)
+        self._index = dict()
+        # segment id -> total bytes and dead bytes
+        self._segment_bytes = dict()
+        self._dead_bytes = dict()
+        # segment id -> file opened for reading
+        self._readers = dict()
+
+        self._active_id = 0
+        self._active = None
+        self._lock = RLock()
+        self._closed = False
+
+        # appends written and synced to disk, the syncs are serialized by
+        # their own lock so the appends keep going meanwhile
+        self._written = 0
+        self._synced = 0
+        self._sync_lock = Lock()
+
+        self._load()
+        self._open_active(segment_id=max(self._active_id, 1))
+
+        if self._compaction_interval:
+            compactor = Thread(target=self._compaction_loop)
+            compactor.daemon = True
+            compactor.start()
+
+    def insert(self, record):
+        self._append(uid=record['uid'], record=record, expected=False)
+
+    def update(self, record):
+        self._append(uid=record['uid'], record=record)
+
+    def select(self, uid):
+        self._lock.acquire()
+
+        try:
+            try:
+                segment_id, offset, length = self._index[uid]
+
+            except KeyError:
+                raise RecordMissing(
+                    'Select Error: Record {!s} is missing'.format(uid))
+
+            content = self._read_entry(segment_id=segment_id,
+                                       offset=offset,
+                                       length=length)
+
+        finally:
+            self._lock.release()
+
+        entry_uid, record = json.loads(content)
+
+        return record
+
+    def delete(self, uid):
+        self._append(uid=uid, record=None, expected=True)
+
+    def exists(self, uid):
+        self._lock.acquire()
+
+        try:
+            return uid in self._index
+
+        finally:
+            self._lock.release()
+
+    def iter_uids(self, prefix=None, start_after=None):
+        """
+        Yields the uids of a sorted copy of the index
+        """
+        self._lock.acquire()
+
+        try:
+            uids = sorted(self._index)
+
+        finally:
+            self._lock.release()
+
+        return self._iter_sorted(uids=uids,
+                                 prefix=prefix,
+                                 start_after=start_after)
+
+    def insert_many(self, records):
+        """
+        Appends all the new records with a single write to the segment
+        """
+        results = dict()
+        entries = list()
+
+        self._lock.acquire()
+
+        try:
+            for record in records:
+                uid = record['uid']
+
+                if uid in self._index or results.get(uid) == CREATED:
+                    results[uid] = EXISTS
+                    continue
+
+                results[uid] = CREATED
+                entries.append((uid, record))
+
+            sequence = self._append_many(entries=entries)
+
+        finally:
+            self._lock.release()
+
+        self._sync(sequence=sequence)
+
+        return results
+
+    def delete_many(self, uids):
+        """
+        Appends the tombstones of all the existing records with a single
+        write to the segment
+        """
+        results = dict()
+        entries = list()
+
+        self._lock.acquire()
+
+        try:
+            for uid in uids:
+                if uid not in self._index or results.get(uid) == DELETED:
+                    results[uid] = MISSING
+                    continue
+
+                results[uid] = DELETED
+                entries.append((uid, None))
+
+            sequence = self._append_many(entries=entries)
+
+        finally:
+            self._lock.release()
+
+        self._sync(sequence=sequence)
+
+        return results
+
+    def close(self):
+        self._lock.acquire()
+
+        try:
+            self._closed = True
+            self._active.close()
+
+            for reader in self._readers.values():
+                reader.close()
+
+            self._readers = dict()
+
+        finally:
+            self._lock.release()
+
+    def compact(self):
+        """
+        Rewrites the live entries of all the segments into a new one and
+        removes the old segments. Writes keep going to a fresh active segment
+        meanwhile. The new segment and the active one are synced to disk
+        before removing the old segments, whatever the durability, so a crash
+        never loses the compacted records.
+        """
+        self._lock.acquire()
+
+        try:
+            output_id = self._active_id + 1
+            compacted = sorted(self._segment_bytes.keys())
+            self._open_active(segment_id=output_id + 1)
+            live = [(uid, location) for uid, location in self._index.items()
+                    if location[0] in compacted]
+
+        finally:
+            self._lock.release()
+
+        moved = dict()
+        output_path = self.__format_segment_path(segment_id=output_id)
+
+        with open(output_path, 'ab') as output:
+            offset = 0
+
+            for uid, location in live:
+                self._lock.acquire()
+
+                try:
+                    content = self._read_entry(*location)
+
+                finally:
+                    self._lock.release()
+
+                output.write(content)
+                moved[uid] = (location, (output_id, offset, len(content)))
+                offset += len(content)
+
+            output.flush()
+            os.fsync(output.fileno())
+
+        Helpers.sync_dir(dir_path=self._base_path)
+
+        self._lock.acquire()
+
+        try:
+            # the newer entries superseding the compacted ones must be
+            # durable before the old segments go away
+            self._active.flush()
+            os.fsync(self._active.fileno())
+
+            self._segment_bytes[output_id] = offset
+            self._dead_bytes[output_id] = 0
+
+            for uid, (old_location, new_location) in moved.items():
+                if self._index.get(uid) == old_location:
+                    self._index[uid] = new_location
+
+                else:
+                    self._dead_bytes[output_id] += new_location[2]
+
+            for segment_id in compacted:
+                self._drop_segment(segment_id=segment_id)
+
+        finally:
+            self._lock.release()
+
+    def _append(self, uid, record, expected=None):
+        """
+        Appends an entry to the active segment and updates the index. A None
+        record is a tombstone for the uid. Returns once the append is as
+        durable as configured.
+        :param uid: str
+        :param record: dict|None
+        :param expected: bool|None. If True the record must exist, if False
+        it must not, if None it does not matter.
+        :raise RecordExists
+        :raise RecordMissing
+        """
+        content = json.dumps([uid, record]) + '\n'
+
+        self._lock.acquire()
+
+        try:
+            if expected is False and uid in self._index:
+                raise RecordExists(
+                    'Insert Error: Record {!s} already exists'.format(uid))
+
+            if expected is True and uid not in self._index:
+                raise RecordMissing(
+                    'Delete Error: Record {!s} is missing'.format(uid))
+
+            if self._segment_bytes[self._active_id] >= self._segment_size:
+                self._open_active(segment_id=self._active_id + 1)
+
+            offset = self._segment_bytes[self._active_id]
+            self._active.write(content)
+            self._active.flush()
+
+            self._account(uid=uid,
+                          record=record,
+                          location=(self._active_id, offset, len(content)))
+            self._written += 1
+            sequence = self._written
+
+        finally:
+            self._lock.release()
+
+        self._sync(sequence=sequence)
+
+    def _append_many(self, entries):
+        """
+        Appends a batch of entries to the active segment with a single write
+        and updates the index. The caller holds the lock and syncs the
+        returned append sequence.
+        :param entries: list of tuples (uid, record|None)
+        :return: int
+        """
+        if not entries:
+            return self._synced
+
+        contents = [json.dumps([uid, record]) + '\n'
+                    for uid, record in entries]
+
+        self._lock.acquire()
+
+        try:
+            if self._segment_bytes[self._active_id] >= self._segment_size:
+                self._open_active(segment_id=self._active_id + 1)
+
+            offset = self._segment_bytes[self._active_id]
+            self._active.write(''.join(contents))
+            self._active.flush()
+
+            for (uid, record), content in zip(entries, contents):
+                self._account(uid=uid,
+                              record=record,
+                              location=(self._active_id, offset, len(content)))
+                offset += len(content)
+
+            self._written += 1
+
+            return self._written
+
+        finally:
+            self._lock.release()
+
+    def _sync(self, sequence):
+        """
+        Syncs the active segment to disk up to the given append, unless the
+        durability is atomic. The appends waiting meanwhile are covered by the
+        same sync; with group durability it waits for more appends first.
+        :param sequence: int
+        """
+        if self._durability == ATOMIC_DURABILITY:
+            return
+
+        self._sync_lock.acquire()
+
+        try:
+            if self._synced >= sequence:
+                return
+
+            if self._durability == GROUP_DURABILITY:
+                time.sleep(self._group_commit_window)
+
+            self._lock.acquire()
+
+            try:
+                written = self._written
+                # a duplicate keeps the descriptor valid if the segment rolls
+                # over while syncing
+                handle = os.dup(self._active.fileno())
+
+            finally:
+                self._lock.release()
+
+            try:
+                os.fsync(handle)
+
+            finally:
+                os.close(handle)
+
+            self._synced = written
+
+        finally:
+            self._sync_lock.release()
+
+    def _account(self, uid, record, location):
+        """
+        Updates the index and the segment counters with an appended entry.
+        :param uid: str
+        :param record: dict|None
+        :param location: tuple (segment id, offset, length)
+        """
+        segment_id, offset, length = location
+        self._segment_bytes[segment_id] = offset + length
+
+        previous = self._index.pop(uid, None)
+
+        if previous:
+            self._dead_bytes[previous[0]] += previous[2]
+
+        if record is None:
+            self._dead_bytes[segment_id] += length
+
+        else:
+            self._index[uid] = location
+
+    def _read_entry(self, segment_id, offset, length):
+        """
+        Reads the raw content of an entry
+        :param segment_id: int
+        :param offset: int
+        :param length: int
+        :return: str
+        """
+        reader = self._readers.get(segment_id)
+
+        if reader is None:
+            reader = open(self.__format_segment_path(segment_id), 'rb')
+            self._readers[segment_id] = reader
+
+        reader.seek(offset)
+
+        return reader.read(length)
+
+    def _load(self):
+        """
+        Rebuilds the index replaying all the segments from the oldest one
+        """
+        for segment_id in self._list_segments():
+            self._segment_bytes[segment_id] = 0
+            self._dead_bytes[segment_id] = 0
+            self._active_id = segment_id
+            offset = 0
+
+            with open(self.__format_segment_path(segment_id), 'rb+') as segment:
+                for content in segment:
+                    try:
+                        if not content.endswith('\n'):
+                            raise ValueError()
+
+                        uid, record = json.loads(content)
+
+                    except ValueError:
+                        # Drops the truncated tail of an interrupted write
+                        segment.seek(offset)
+                        segment.truncate()
+                        break
+
+                    self._account(uid=uid,
+                                  record=record,
+                                  location=(segment_id, offset, len(content)))
+                    offset += len(content)
+
+    def _list_segments(self):
+        """
+        Returns the sorted ids of the segments found into base path
+        :return: list
+        """
+        segments = list()
+
+        for filename in os.listdir(self._base_path):
+            if filename.startswith(self.SEGMENT_PREFIX) \
+                    and filename.endswith(self.SEGMENT_SUFFIX):
+                segments.append(int(filename[len(self.SEGMENT_PREFIX):
+                                             -len(self.SEGMENT_SUFFIX)]))
+
+        return sorted(segments)
+
+    def _open_active(self, segment_id):
+        """
+        Closes the current active segment and opens a new one for appending.
+        Unless the durability is atomic the closed segment is synced to disk
+        and so is the directory entry of the new one.
+        :param segment_id: int
+        """
+        if self._active:
+            if self._durability != ATOMIC_DURABILITY:
+                os.fsync(self._active.fileno())
+
+            self._active.close()
+
+        self._active_id = segment_id
+        self._active = open(self.__format_segment_path(segment_id), 'ab')
+
+        if self._durability != ATOMIC_DURABILITY:
+            Helpers.sync_dir(dir_path=self._base_path)
+
+        self._active.seek(0, os.SEEK_END)
+        self._segment_bytes[segment_id] = self._active.tell()
+        self._dead_bytes.setdefault(segment_id, 0)
+
+    def _drop_segment(self, segment_id):
+        """
+        Forgets and removes a segment file
+        :param segment_id: int
+        """
+        reader = self._readers.pop(segment_id, None)
+
+        if reader:
+            reader.close()
+
+        del self._segment_bytes[segment_id]
+        del self._dead_bytes[segment_id]
+
+        Helpers.delete_file(
+            file_path=self.__format_segment_path(segment_id=segment_id))
+
+    def _needs_compaction(self):
+        """
+        Checks if the dead bytes are over the compaction ratio
+        :return: bool
+        """
+        total = sum(self._segment_bytes.values())
+        dead = sum(self._dead_bytes.values())
+
+        if not total:
+            return False
+
+        return float(dead) / total >= self._compaction_ratio
+
+    def _compaction_loop(self):
+        """
+        Background job compacting the segments when needed
+        """
+        while not self._closed:
+            time.sleep(self._compaction_interval)
+
+            if not self._closed and self._needs_compaction():
+                self.compact()
+
+    def __format_segment_path(self, segment_id):
+        """
+        :param segment_id: int
+        :return: str
+        """
+        return '{!s}/{!s}{:010d}{!s}'.format(self._base_path,
+                                              self.SEGMENT_PREFIX,
+                                              segment_id,
+                                              self.SEGMENT_SUFFIX)
+
+
+class SqliteStorage(Storage):
+    """
+    Engine for a storage based on a SQLite database in WAL mode, so readers
+    do not block the writer.
+
+    Every thread uses its own connection, taken from a pool of idle
+    connections and returned after the query, or kept by the thread along a
+    transaction. The statements are constant strings, so every connection
+    compiles them once into its statement cache.
+    """
+
+    CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS records (' \
+                   'uid TEXT PRIMARY KEY, ' \
+                   'fields TEXT NOT NULL, ' \
+                   'value TEXT)'
+    SELECT = 'SELECT fields, value FROM records WHERE uid = ?'
+    SELECT_HEADER = 'SELECT fields FROM records WHERE uid = ?'
+    INSERT = 'INSERT INTO records (uid, fields, value) VALUES (?, ?, ?)'
+    UPDATE = 'INSERT OR REPLACE INTO records (uid, fields, value) ' \
+             'VALUES (?, ?, ?)'
+    DELETE = 'DELETE FROM records WHERE uid = ?'
+    EXISTS = 'SELECT 1 FROM records WHERE uid = ?'
+    SELECT_MANY = 'SELECT uid, fields, value FROM records WHERE uid IN ({!s})'
+    INSERT_IGNORE = 'INSERT OR IGNORE INTO records (uid, fields, value) ' \
+                    'VALUES (?, ?, ?)'
+    SCAN = 'SELECT uid, fields, value FROM records ' \
+           'WHERE uid >= ? AND uid > ? ORDER BY uid LIMIT ?'
+    SCAN_UIDS = 'SELECT uid FROM records ' \
+                'WHERE uid >= ? AND uid > ? ORDER BY uid LIMIT ?'
+
+    def __init__(self, **params):
+        """
+        Constructor
+
+        :param base_path: str directory for the database file.
+        :param pool_size: int maximum idle connections kept open.
+        :param timeout: float seconds waiting for a lock of the database.
+        :param synchronous: str SQLite synchronous pragma. NORMAL is durable
+        enough into WAL mode, FULL syncs every transaction.
+        """
+        super(SqliteStorage, self).__init__(**params)
+
+        self._path = '{!s}/{!s}'.format(params['base_path'], SQLITE_FILENAME)
+        self._pool_size = params.get('pool_size', DEFAULT_SQLITE_POOL_SIZE)
+        self._timeout = params.get('timeout', DEFAULT_SQLITE_TIMEOUT)
+        self._synchronous = params.get('synchronous', 'NORMAL')
+        self._pool = LifoQueue()
+        self._local = local()
+
+        connection = self._connect()
+        connection.execute(self.CREATE_TABLE)
+        self._release(connection)
+
+    def select(self, uid):
+        row = self._fetch_one(self.SELECT, (self._text(uid),))
+
+        if row is None:
+            raise RecordMissing(
+                'Select Error: Record {!s} is missing'.format(uid))
+
+        record = json.loads(row[0])
+        record['value'] = row[1]
+
+        return record
+
+    def select_header(self, uid):
+        row = self._fetch_one(self.SELECT_HEADER, (self._text(uid),))
+
+        if row is None:
+            raise RecordMissing(
+                'Select Error: Record {!s} is missing'.format(uid))
+
+        return json.loads(row[0])
+
+    def insert(self, record):
+        try:
+            self._execute(self.INSERT, self._row(record=record))
+
+        except sqlite3.IntegrityError:
+            raise RecordExists(
+                'Insert Error: Record {!s} already exists'.format(
+                    record['uid']))
+
+    def update(self, record):
+        self._execute(self.UPDATE, self._row(record=record))
+
+    def delete(self, uid):
+        if not self._execute(self.DELETE, (self._text(uid),)):
+            raise RecordMissing(
+                'Delete Error: Record {!s} is missing'.format(uid))
+
+    def exists(self, uid):
+        return self._fetch_one(self.EXISTS, (self._text(uid),)) is not None
+
+    def iter_uids(self, prefix=None, start_after=None):
+        for row in self._scan_rows(self.SCAN_UIDS, prefix, start_after):
+            yield row[0]
+
+    def scan(self, prefix=None, start_after=None, limit=None):
+        """
+        Yields the records reading them by pages of the uid index
+        """
+        count = 0
+
+        for uid, fields, value in self._scan_rows(self.SCAN,
+                                                  prefix,
+                                                  start_after):
+            if limit is not None and count >= limit:
+                return
+
+            record = json.loads(fields)
+            record['value'] = value
+
+            count += 1
+            yield record
+
+    def select_many(self, uids):
+        """
+        Selects the records with one query per chunk of uids
+        """
+        records = dict((uid, None) for uid in uids)
+        uids = list(records)
+
+        for start in range(0, len(uids), SQLITE_MAX_PARAMETERS):
+            chunk = [self._text(uid)
+                     for uid in uids[start:start + SQLITE_MAX_PARAMETERS]]
+            statement = self.SELECT_MANY.format(', '.join('?' * len(chunk)))
+
+            for uid, fields, value in self._fetch_all(statement, chunk):
+                record = json.loads(fields)
+                record['value'] = value
+                records[uid] = record
+
+        return records
+
+    def insert_many(self, records):
+        """
+        Inserts the records into a single transaction
+        """
+        results = dict()
+
+        with self.transaction():
+            for record in records:
+                if self._execute(self.INSERT_IGNORE, self._row(record=record)):
+                    results[record['uid']] = CREATED
+
+                else:
+                    results[record['uid']] = EXISTS
+
+        return results
+
+    def delete_many(self, uids):
+        """
+        Deletes the records into a single transaction
+        """
+        results = dict()
+
+        with self.transaction():
+            for uid in uids:
+                if self._execute(self.DELETE, (self._text(uid),)):
+                    results[uid] = DELETED
+
+                else:
+                    results[uid] = MISSING
+
+        return results
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+
+            except Empty:
+                break
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the queries of the block into a single transaction of the
+        current thread, committed at the end of the block or rolled back on
+        exception. Nested blocks join the outer transaction.
+        """
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is not None:
+            yield
+            return
+
+        connection = self._acquire()
+        connection.execute('BEGIN IMMEDIATE')
+        self._local.connection = connection
+
+        try:
+            yield
+            connection.execute('COMMIT')
+
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        finally:
+            self._local.connection = None
+            self._release(connection)
+
+    def _execute(self, statement, parameters):
+        """
+        Executes a write statement and returns the number of changed rows
+        :param statement: str
+        :param parameters: tuple
+        :return: int
+        """
+        connection = self._acquire()
+
+        try:
+            return connection.execute(statement, parameters).rowcount
+
+        finally:
+            self._release(connection)
+
+    def _fetch_one(self, statement, parameters):
+        """
+        Executes a query and returns its first row or None
+        :param statement: str
+        :param parameters: tuple
+        :return: tuple|None
+        """
+        connection = self._acquire()
+
+        try:
+            return connection.execute(statement, parameters).fetchone()
+
+        finally:
+            self._release(connection)
+
+    def _scan_rows(self, statement, prefix, start_after):
+        """
+        Yields the rows of a scan query, by pages following the uid index
+        :param statement: str query with the uid as first column
+        :param prefix: str|None
+        :param start_after: str|None
+        :return: generator
+        """
+        prefix = self._text(prefix or '')
+        last_uid = self._text(start_after or '')
+
+        while True:
+            rows = self._fetch_all(statement,
+                                   (prefix, last_uid, SQLITE_SCAN_PAGE_SIZE))
+
+            for row in rows:
+                if not row[0].startswith(prefix):
+                    return
+
+                yield row
+
+            if len(rows) < SQLITE_SCAN_PAGE_SIZE:
+                return
+
+            last_uid = rows[-1][0]
+
+    def _fetch_all(self, statement, parameters):
+        """
+        Executes a query and returns all its rows
+        :param statement: str
+        :param parameters: tuple
+        :return: list
+        """
+        connection = self._acquire()
+
+        try:
+            return connection.execute(statement, parameters).fetchall()
+
+        finally:
+            self._release(connection)
+
+    def _acquire(self):
+        """
+        Returns the connection of the transaction of the current thread, or
+        an idle connection of the pool, or a new connection.
+        :return: sqlite3.Connection
+        """
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is not None:
+            return connection
+
+        try:
+            return self._pool.get_nowait()
+
+        except Empty:
+            return self._connect()
+
+    def _release(self, connection):
+        """
+        Returns a connection to the pool unless a transaction holds it
+        :param connection: sqlite3.Connection
+        """
+        if connection is getattr(self._local, 'connection', None):
+            return
+
+        if self._pool.qsize() >= self._pool_size:
+            connection.close()
+            return
+
+        self._pool.put(connection)
+
+    def _connect(self):
+        """
+        Opens a connection into autocommit mode. Transactions are started
+        explicitly.
+        :return: sqlite3.Connection
+        """
+        connection = sqlite3.connect(self._path,
+                                     timeout=self._timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=SQLITE_CACHED_STATEMENTS)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous={!s}'.format(self._synchronous))
+
+        return connection
+
+    @classmethod
+    def _row(cls, record):
+        """
+        Returns the parameters of a record row
+        :param record: dict
+        :return: tuple
+        """
+        fields = dict((key, item) for key, item in record.items()
+                      if key != 'value')
+
+        return (cls._text(record['uid']),
+                json.dumps(fields),
+                cls._text(record.get('value')))
+
+    @classmethod
+    def _text(cls, text):
+        """
+        Returns a text as unicode, as the byte strings are not accepted by
+        SQLite.
+        :param text: str|unicode
+        :return: unicode
+        """
+        if isinstance(text, str):
+            return text.decode('utf-8')
+
+        return text
+
+
+class WrapperStorage(Storage):
+    """
+    Base of the storages wrapping another storage, which keep a part of the
+    records apart and reference it from a field of the wrapped records. The
+    part of a replaced or deleted record is released.
+    """
+
+    # Field of the wrapped records referencing the part kept apart
+    FIELD = None
+
+    def __init__(self, **params):
+        """
+        Constructor
+
+        :param storage: Storage wrapped.
+        """
+        super(WrapperStorage, self).__init__(**params)
+
+        self._storage = params['storage']
+        # Serialize the changes of a uid, so a replaced part is released
+        # once.
+        self._locks = [Lock() for _ in range(WRAPPER_LOCK_STRIPES)]
+
+    def select_header(self, uid):
+        record = self._storage.select_header(uid=uid)
+        record.pop(self.FIELD, None)
+
+        return record
+
+    def update_by_digest(self, record):
+        self._write(record=record, write=self._storage.update_by_digest)
+
+    def delete(self, uid):
+        lock = self.__lock(uid=uid)
+        lock.acquire()
+
+        try:
+            previous = self._part(uid=uid)
+            self._storage.delete(uid=uid)
+
+        finally:
+            lock.release()
+
+        if previous:
+            self._release(part=previous)
+
+    def exists(self, uid):
+        return self._storage.exists(uid=uid)
+
+    def iter_uids(self, prefix=None, start_after=None):
+        return self._storage.iter_uids(prefix=prefix,
+                                       start_after=start_after)
+
+    def close(self):
+        self._storage.close()
+
+    @abstractmethod
+    def _release(self, part):
+        """
+        Releases the part of a replaced or deleted record
+        :param part: mixed value of the field
+        """
+        pass
+
+    def _write(self, record, write):
+        """
+        Writes a wrapped record and releases the part of the record it
+        replaces. Releases the part of the new record if the write fails.
+        :param record: dict
+        :param write: callable of the wrapped storage
+        """
+        lock = self.__lock(uid=record['uid'])
+        lock.acquire()
+
+        try:
+            previous = self._part(uid=record['uid'])
+            write(record=record)
+
+        except Exception:
+            if record.get(self.FIELD):
+                self._release(part=record[self.FIELD])
+
+            raise
+
+        finally:
+            lock.release()
+
+        if previous:
+            self._release(part=previous)
+
+    def _part(self, uid):
+        """
+        Returns the part of a stored record, None if it is missing
+        :param uid: str
+        :return: mixed|None
+        """
+        try:
+            return self._storage.select_header(uid=uid).get(self.FIELD)
+
+        except RecordMissing:
+            return None
+
+    def __lock(self, uid):
+        """
+        :param uid: str
+        :return: Lock
+        """
+        return self._locks[hash(uid) % WRAPPER_LOCK_STRIPES]
+
+
+class DedupStorage(WrapperStorage):
+    """
+    Wrapper of a storage keeping every distinct value once into a blob
+    store. The records of the wrapped storage hold the digest of their value
+    and an empty value.
+    """
+
+    FIELD = DIGEST_FIELD
+
+    def __init__(self, **params):
+        """
+        Constructor
+
+        :param storage: Storage wrapped.
+        :param blobs: BlobStore of the values.
+        """
+        super(DedupStorage, self).__init__(**params)
+
+        self._blobs = params['blobs']
+
+    def select(self, uid):
+        record = self._storage.select(uid=uid)
+        digest = record.pop(DIGEST_FIELD, None)
+
+        if digest:
+            record['value'] = self._blobs.get(digest=digest)
+
+        return record
+
+    def insert(self, record):
+        digest = self._blobs.acquire(value=record['value'])
+
+        self._write(record=self.__with_digest(record, digest),
+                    write=self._storage.insert)
+
+    def update(self, record):
+        digest = self._blobs.acquire(value=record['value'])
+
+        self._write(record=self.__with_digest(record, digest),
+                    write=self._storage.update)
+
+    def update_by_digest(self, record):
+        digest = record[DIGEST_FIELD]
+
+        self._blobs.acquire_digest(digest=digest)
+
+        self._write(record=self.__with_digest(record, digest),
+                    write=self._storage.update)
+
+    def recount(self):
+        """
+        Counts again the references to the values from the records and
+        removes the values without references. Returns the number of removed
+        values.
+        :return: int
+        """
+        return self._blobs.recount(digests=self.__digests())
+
+    def close(self):
+        super(DedupStorage, self).close()
+        self._blobs.close()
+
+    def _release(self, part):
+        self._blobs.release(digest=part)
+
+    def __digests(self):
+        """
+        Yields the digest of every record
+        :return: generator
+        """
+        for uid in self.iter_uids():
+            digest = self._part(uid=uid)
+
+            if digest:
+                yield digest
+
+    @classmethod
+    def __with_digest(cls, record, digest):
+        """
+        Returns a copy of a record with the digest instead of the value
+        :param record: dict
+        :param digest: str
+        :return: dict
+        """
+        stored = dict(record)
+        stored['value'] = u''
+        stored[DIGEST_FIELD] = digest
+
+        return stored
+
+
+class ChunkedStorage(WrapperStorage):
+    """
+    Wrapper of a storage keeping the large values in chunk files. The
+    records of the wrapped storage hold the location of their chunks and an
+    empty value. The values are streamed from and to the chunks by blocks,
+    so the memory used by a stream is bounded.
+    """
+
+    FIELD = CHUNKS_FIELD
+
+    def __init__(self, **params):
+        """
+        Constructor
+
+        :param storage: Storage wrapped.
+        :param chunks: ChunkStore of the values.
+        :param threshold: int bytes of the shortest value into chunks.
+        """
+        super(ChunkedStorage, self).__init__(**params)
+
+        self._chunks = params['chunks']
+        self._threshold = params.get('threshold', DEFAULT_CHUNK_THRESHOLD)
+
+    def select(self, uid):
+        record = self._storage.select(uid=uid)
+        fields = record.pop(CHUNKS_FIELD, None)
+
+        if fields:
+            value = ChunkedValue.loads(fields=fields)
+            record['value'] = ''.join(
+                self._chunks.read(value=value)).decode('utf-8')
+
+        return record
+
+    def select_stream(self, uid):
+        record = self._storage.select(uid=uid)
+        fields = record.pop(CHUNKS_FIELD, None)
+
+        if not fields:
+            return RecordHelper.stream_record(record=record)
+
+        del record['value']
+        value = ChunkedValue.loads(fields=fields)
+
+        def read(start=0, end=None):
+            return self._chunks.read(value=value, start=start, end=end)
+
+        return record, value.length, read
+
+    def stage_value(self, stream, length):
+        if length < self._threshold:
+            return super(ChunkedStorage, self).stage_value(stream=stream,
+                                                           length=length)
+
+        return self._chunks.write(stream=stream, length=length)
+
+    def insert(self, record):
+        self._write(record=self.__with_chunks(record),
+                    write=self._storage.insert)
+
+    def update(self, record):
+        self._write(record=self.__with_chunks(record),
+                    write=self._storage.update)
+
+    def _release(self, part):
+        self._chunks.remove(value=ChunkedValue.loads(fields=part))
+
+    def __with_chunks(self, record):
+        """
+        Returns a record to write into the wrapped storage. A large value is
+        written into chunks if it is not yet.
+        :param record: dict
+        :return: dict
+        """
+        value = record['value']
+
+        if not isinstance(value, ChunkedValue):
+            if len(value) < self._threshold:
+                return record
+
+            content = value.encode('utf-8')
+
+            if len(content) < self._threshold:
+                return record
+
+            value = self._chunks.write(stream=StringIO(content),
+                                       length=len(content))
+
+        stored = dict(record)
+        stored['value'] = u''
+        stored[CHUNKS_FIELD] = value.dumps()
+
+        return stored
+
+
+class WriteBehindStorage(Storage):
+    """
+    Wrapper of a storage buffering the writes into memory and flushing them
+    from a background thread, when enough records are pending or the oldest
+    pending write is too old. The writes of a uid are coalesced, the reads
+    of the pending records are served from the buffer and the buffer is
+    drained on close. The writes of the last max_age seconds are lost on a
+    crash.
+
+    The values staged by the wrapped storage and the writes by digest are
+    written through, after the pending write of their uid.
+    """
+
+    def __init__(self, **params):
+        """
+        Constructor
+
+        :param storage: Storage wrapped.
+        :param max_records: int pending records at most.
+        :param flush_records: int pending records starting a flush.
+        :param max_age: float seconds a write is pending at most.
+        """
+        super(WriteBehindStorage, self).__init__(**params)
+
+        self._storage = params['storage']
+        self._max_records = params.get('max_records',
+                                       DEFAULT_WRITE_BEHIND_MAX_RECORDS)
+        self._flush_records = params.get('flush_records',
+                                         DEFAULT_WRITE_BEHIND_FLUSH_RECORDS)
+        self._max_age = params.get('max_age', DEFAULT_WRITE_BEHIND_MAX_AGE)
+
+        # uid -> (operation, record, time of the oldest pending write)
+        self._pending = OrderedDict()
+        # pending records taken by the flush in progress
+        self._flushing = dict()
+        # flushes done, so a check of the wrapped storage out of the lock
+        # knows if a flush wrote into it meanwhile
+        self._flushes = 0
+        self._lock = RLock()
+        self._ready = Condition(self._lock)
+        # Serialize the writes into the wrapped storage, so an older record
+        # never overwrites a newer one
+        self._flush_lock = Lock()
+        self._closed = False
+
+        flusher = Thread(target=self._flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def select(self, uid):
+        entry = self.__pending_entry(uid=uid)
+
+        if entry is None:
+            return self._storage.select(uid=uid)
+
+        return dict(self.__pending_record(uid=uid, entry=entry))
+
+    def select_header(self, uid):
+        entry = self.__pending_entry(uid=uid)
+
+        if entry is None:
+            return self._storage.select_header(uid=uid)
+
+        record = dict(self.__pending_record(uid=uid, entry=entry))
+        del record['value']
+
+        return record
+
+    def select_stream(self, uid):
+        entry = self.__pending_entry(uid=uid)
+
+        if entry is None:
+            return self._storage.select_stream(uid=uid)
+
+        return RecordHelper.stream_record(
+            record=self.__pending_record(uid=uid, entry=entry))
+
+    def select_many(self, uids):
+        records = dict()
+        stored = list()
+
+        for uid in uids:
+            entry = self.__pending_entry(uid=uid)
+
+            if entry is None:
+                stored.append(uid)
+
+            elif entry[0] == WRITE_PENDING:
+                records[uid] = dict(entry[1])
+
+            else:
+                records[uid] = None
+
+        if stored:
+            records.update(self._storage.select_many(uids=stored))
+
+        return records
+
+    def exists(self, uid):
+        entry = self.__pending_entry(uid=uid)
+
+        if entry is None:
+            return self._storage.exists(uid=uid)
+
+        return entry[0] == WRITE_PENDING
+
+    def stage_value(self, stream, length):
+        return self._storage.stage_value(stream=stream, length=length)
+
+    def insert(self, record):
+        uid = record['uid']
+
+        if not isinstance(record['value'], basestring):
+            self.__write_through(uid=uid,
+                                 write=self._storage.insert,
+                                 record=record)
+            return
+
+        full = self.__buffer_checked(uid=uid,
+                                     operation=WRITE_PENDING,
+                                     record=record,
+                                     expected=False)
+
+        if full:
+            self.flush()
+
+    def update(self, record):
+        uid = record['uid']
+
+        if not isinstance(record['value'], basestring):
+            self.__write_through(uid=uid,
+                                 write=self._storage.update,
+                                 record=record)
+            return
+
+        self._lock.acquire()
+
+        try:
+            full = self.__buffer(uid=uid,
+                                 operation=WRITE_PENDING,
+                                 record=record)
+
+        finally:
+            self._lock.release()
+
+        if full:
+            self.flush()
+
+    def update_by_digest(self, record):
+        self.__write_through(uid=record['uid'],
+                             write=self._storage.update_by_digest,
+                             record=record)
+
+    def delete(self, uid):
+        full = self.__buffer_checked(uid=uid,
+                                     operation=DELETE_PENDING,
+                                     record=None,
+                                     expected=True)
+
+        if full:
+            self.flush()
+
+    def iter_uids(self, prefix=None, start_after=None):
+        self.flush()
+
+        return self._storage.iter_uids(prefix=prefix, start_after=start_after)
+
+    def scan(self, prefix=None, start_after=None, limit=None):
+        self.flush()
+
+        return self._storage.scan(prefix=prefix,
+                                  start_after=start_after,
+                                  limit=limit)
+
+    def flush(self):
+        """
+        Writes all the pending records into the wrapped storage. On a failed
+        write, the records not written yet are pending again.
+        """
+        self._flush_lock.acquire()
+
+        try:
+            self._lock.acquire()
+
+            try:
+                self._flushing = self._pending
+                self._pending = OrderedDict()
+
+            finally:
+                self._lock.release()
+
+            entries = self._flushing.items()
+
+            for position, (uid, entry) in enumerate(entries):
+                try:
+                    self.__apply(uid=uid, entry=entry)
+
+                except Exception:
+                    self.__requeue(entries=entries[position:])
+                    raise
+
+        finally:
+            self._lock.acquire()
+            self._flushing = dict()
+            self._flushes += 1
+            self._lock.release()
+            self._flush_lock.release()
+
+    def close(self):
+        self._lock.acquire()
+
+        try:
+            self._closed = True
+            self._ready.notify()
+
+        finally:
+            self._lock.release()
+
+        self.flush()
+        self._storage.close()
+
+    def _flush_loop(self):
+        """
+        Background job flushing the buffer by size or by age
+        """
+        while not self._closed:
+            self._lock.acquire()
+
+            try:
+                timeout = self.__flush_timeout()
+
+                while not self._closed and timeout != 0:
+                    self._ready.wait(timeout)
+                    timeout = self.__flush_timeout()
+
+            finally:
+                self._lock.release()
+
+            if self._closed:
+                return
+
+            try:
+                self.flush()
+
+            except Exception:
+                # The records are pending again, retry after a while
+                time.sleep(self._max_age)
+
+    def __flush_timeout(self):
+        """
+        Returns the seconds to wait before the next flush, 0 to flush now
+        and None to wait for a write
+        :return: float|None
+        """
+        if not self._pending:
+            return None
+
+        if len(self._pending) >= self._flush_records:
+            return 0
+
+        operation, record, since = next(self._pending.itervalues())
+
+        return max(since + self._max_age - time.time(), 0)
+
+    def __buffer(self, uid, operation, record):
+        """
+        Adds a pending write of a uid replacing the previous one, if any.
+        Returns True if the buffer is over its limit.
+        :param uid: str
+        :param operation: str
+        :param record: dict|None
+        :return: bool
+        """
+        entry = self._pending.get(uid)
+        since = entry[2] if entry else time.time()
+
+        self._pending[uid] = (operation, record, since)
+        self._ready.notify()
+
+        return len(self._pending) > self._max_records
+
+    def __buffer_checked(self, uid, operation, record, expected):
+        """
+        Adds a pending write of a uid which record must exist or not. The
+        wrapped storage is read out of the lock, so the other writes and the
+        flushes do not wait for it, and read again if a flush wrote into it
+        meanwhile. Returns True if the buffer is over its limit.
+        :param uid: str
+        :param operation: str
+        :param record: dict|None
+        :param expected: bool. True if the record must exist.
+        :return: bool
+        :raise RecordExists
+        :raise RecordMissing
+        """
+        stored = None
+        flushes = None
+
+        while True:
+            self._lock.acquire()
+
+            try:
+                entry = self.__pending_entry(uid=uid)
+
+                if entry is not None:
+                    exists = entry[0] == WRITE_PENDING
+
+                elif flushes == self._flushes:
+                    exists = stored
+
+                else:
+                    exists = None
+
+                if exists is not None:
+                    if exists and not expected:
+                        raise RecordExists(
+                            'Insert Error: Record {!s} already exists'
+                            .format(uid))
+
+                    if not exists and expected:
+                        raise RecordMissing(
+                            'Delete Error: Record {!s} is missing'
+                            .format(uid))
+
+                    return self.__buffer(uid=uid,
+                                         operation=operation,
+                                         record=record)
+
+                flushes = self._flushes
+
+            finally:
+                self._lock.release()
+
+            stored = self._storage.exists(uid=uid)
+
+    def __pending_entry(self, uid):
+        """
+        Returns the pending write of a uid, flushing or not, None without it
+        :param uid: str
+        :return: tuple|None
+        """
+        self._lock.acquire()
+
+        try:
+            entry = self._pending.get(uid)
+
+            if entry is None:
+                entry = self._flushing.get(uid)
+
+            return entry
+
+        finally:
+            self._lock.release()
+
+    @classmethod
+    def __pending_record(cls, uid, entry):
+        """
+        Returns the record of a pending write
+        :param uid: str
+        :param entry: tuple
+        :return: dict
+        :raise RecordMissing
+        """
+        operation, record, since = entry
+
+        if operation == DELETE_PENDING:
+            raise RecordMissing(
+                'Select Error: Record {!s} is missing'.format(uid))
+
+        return record
+
+    def __apply(self, uid, entry):
+        """
+        Writes a pending record into the wrapped storage
+        :param uid: str
+        :param entry: tuple
+        """
+        operation, record, since = entry
+
+        if operation == WRITE_PENDING:
+            self._storage.update(record=record)
+            return
+
+        try:
+            self._storage.delete(uid=uid)
+
+        except RecordMissing:
+            pass
+
+    def __requeue(self, entries):
+        """
+        Makes pending again the records of a failed flush ahead of the
+        writes buffered meanwhile, so they are the next ones flushed and the
+        oldest pending write stays first. A record written again meanwhile
+        keeps its newer write, pending since the failed one.
+        :param entries: list of tuples (uid, entry)
+        """
+        self._lock.acquire()
+
+        try:
+            pending = OrderedDict()
+
+            for uid, entry in entries:
+                newer = self._pending.pop(uid, None)
+
+                if newer is not None:
+                    entry = (newer[0], newer[1], entry[2])
+
+                pending[uid] = entry
+
+            pending.update(self._pending)
+            self._pending = pending
+
+        finally:
+            self._lock.release()
+
+    def __write_through(self, uid, write, record):
+        """
+        Writes a record into the wrapped storage after the pending write of
+        its uid
+        :param uid: str
+        :param write: callable of the wrapped storage
+        :param record: dict
+        """
+        self._flush_lock.acquire()
+
+        try:
+            self._lock.acquire()
+
+            try:
+                entry = self._pending.pop(uid, None)
+
+                if entry is not None:
+                    self._flushing[uid] = entry
+
+            finally:
+                self._lock.release()
+
+            if entry is not None:
+                try:
+                    self.__apply(uid=uid, entry=entry)
+
+                except Exception:
+                    self.__requeue(entries=[(uid, entry)])
+                    raise
+
+            write(record=record)
+
+        finally:
+            self._lock.acquire()
+            self._flushing = dict()
+            self._flushes += 1
+            self._lock.release()
+            self._flush_lock.release()
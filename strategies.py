@@ -3,10 +3,14 @@
 """
 import json
 from thread import start_new_thread
+from threading import Lock
 
+from minstore.blobs import BlobStore
+from minstore.cache import SingleFlight
 from minstore.constants import *
 from minstore.exceptions import ServerMissing, RecordMissing
-from minstore.helpers import Helpers, RecordHelper
+from minstore.helpers import Helpers, RecordHelper, StreamReader
+from minstore.storage import DIGEST_FIELD
 
 
 class Spread(object):
@@ -20,7 +24,13 @@ class Spread(object):
         self._route = route
         self._servers = list()
         self._cache = None
+        self._missing = None
         self._request_bridge = None
+        # uids of the cached records being refreshed in the background
+        self._revalidating = set()
+        self._revalidating_lock = Lock()
+        # concurrent gets of a uid from the dependants, run once
+        self._flights = SingleFlight()
 
         self._load_servers()
         self._set_bridge_request()
@@ -34,6 +44,14 @@ class Spread(object):
         self._cache = instance
         self._validate_cache_config()
 
+    @property
+    def missing(self):
+        return self._missing
+
+    @missing.setter
+    def missing(self, instance):
+        self._missing = instance
+
     def _validate_cache_config(self):
         """Validates cache config and returns True if it is fine or raises an
         exception on wrong configuration is found.
@@ -112,7 +130,8 @@ class Spread(object):
 
         return
 
-    def _bounce_put_job(self, url, uid, value, to_cache=False, params=None):
+    def _bounce_put_job(self, url, uid, value, to_cache=False, params=None,
+                        ttl=None):
         """
         Requests a put job given an url, uid and value, and optionally a
         get url parameters.
@@ -128,12 +147,13 @@ class Spread(object):
         :param value: str
         :param to_cache: bool. If True records the response into cache.
         :param params: dict
+        :param ttl: float|None seconds to live
         :return: dict
         """
         response = Helpers.request_put(
             url=url,
             dirs=[uid],
-            data={'value': value},
+            data=self.__format_data(value=value, ttl=ttl),
             params=params,
         )
 
@@ -147,12 +167,13 @@ class Spread(object):
 
         return record
 
-    def bounce_put(self, uid, value):
+    def bounce_put(self, uid, value, ttl=None):
         """
         Bounces a put request to all dependants. Records the first valid
         response content into the cache. Returns the record got from dependants.
         :param uid: str
         :param value: str
+        :param ttl: float|None seconds to live
         :return dict
         """
         valid_response = None
@@ -162,12 +183,14 @@ class Spread(object):
             record = self._bounce_put_job(url=url,
                                           uid=uid,
                                           value=value,
-                                          to_cache=valid_response)
+                                          to_cache=valid_response,
+                                          ttl=ttl)
             valid_response = bool(record)
 
         return record
 
-    def _bounce_post_job(self, url, uid, value, to_cache=False, params=None):
+    def _bounce_post_job(self, url, uid, value, to_cache=False, params=None,
+                         ttl=None):
         """
         Requests a post job given an url, uid and value, and optionally a
         get url parameters.
@@ -183,12 +206,13 @@ class Spread(object):
         :param value: str
         :param to_cache: bool. If True records the response into cache.
         :param params: dict
+        :param ttl: float|None seconds to live
         :return: dict
         """
         response = Helpers.request_post(
             url=url,
             dirs=[uid],
-            data={'value': value},
+            data=self.__format_data(value=value, ttl=ttl),
             params=params,
         )
 
@@ -202,12 +226,13 @@ class Spread(object):
 
         return record
 
-    def bounce_post(self, uid, value):
+    def bounce_post(self, uid, value, ttl=None):
         """
         Bounces a post request to all dependants. Records the first valid
         response content into the cache. Returns the record got from dependants.
         :param uid: str
         :param value: str
+        :param ttl: float|None seconds to live
         :return dict
         """
         valid_response = None
@@ -217,20 +242,36 @@ class Spread(object):
             record = self._bounce_post_job(url=url,
                                            uid=uid,
                                            value=value,
-                                           to_cache=valid_response)
+                                           to_cache=valid_response,
+                                           ttl=ttl)
             valid_response = bool(record)
 
         return record
 
+    @classmethod
+    def __format_data(cls, value, ttl):
+        """
+        Returns the post data of a bounced write
+        :param value: str
+        :param ttl: float|None
+        :return: dict
+        """
+        data = {'value': value}
+
+        if ttl:
+            data['ttl'] = ttl
+
+        return data
+
     @classmethod
     def _bounce_get_job(cls, url, uid, params=None):
         """
         Requests a get job given an url and uid, and optionally a set of url
         parameters.
 
-        Returns False if response code is not 200. Converts the response
-        content into a valid record if possible and returns the record on
-        success.
+        Returns False if response code is not 200, and None if it is 404.
+        Converts the response content into a valid record if possible and
+        returns the record on success.
 
         :param url: str
         :param uid: str
@@ -239,6 +280,9 @@ class Spread(object):
         """
         response = Helpers.request_get(url=url, dirs=[uid], params=params)
 
+        if response.status_code == 404:
+            return None
+
         record = RecordHelper.str2record(content=response.content)
 
         if response.status_code != 200 or not record:
@@ -248,18 +292,141 @@ class Spread(object):
 
     def bounce_get(self, uid):
         """
-        Looks for the uid within all dependant servers.
+        Looks for the uid within all dependant servers, and records the found
+        record into the cache. A uid all of them miss is remembered into the
+        negative cache, and not looked for again while it is there. The
+        concurrent calls of a uid share a single look up and its result or
+        error.
         :param uid: str
         :return: dict
         """
+        if self._missing and self._missing.contains(uid=uid):
+            raise RecordMissing()
+
+        return self._flights.do(key=uid,
+                                function=lambda: self.__bounce_get(uid=uid))
+
+    def __bounce_get(self, uid):
+        """
+        Looks for the uid within all dependant servers
+        :param uid: str
+        :return: dict
+        :raise RecordMissing
+        """
+        confirmed = True
+
         for url in self._servers:
             url = '{!s}/{!s}'.format(url, self._route)
             record = self._bounce_get_job(url=url, uid=uid)
             if record:
+                if self._cache:
+                    self._cache.put(record)
+
                 return record
 
+            confirmed = confirmed and record is None
+
+        if self._missing and confirmed:
+            self._missing.add(uid=uid)
+
         raise RecordMissing()
 
+    def forget_missing(self, uid):
+        """
+        Forgets a uid from the negative cache, on a write of the uid
+        :param uid: str
+        """
+        if self._missing:
+            self._missing.forget(uid=uid)
+
+    def refresh(self, uid):
+        """
+        Gets a record from the dependants into the cache and returns it.
+        Forgets the cached record if all the dependants miss it, remembering
+        the uid into the negative cache, and keeps it if any of them fails.
+        :param uid: str
+        :return: dict
+        :raise RecordMissing, IOError
+        """
+        failed = False
+
+        for url in self._servers:
+            url = '{!s}/{!s}'.format(url, self._route)
+
+            try:
+                response = Helpers.request_get(url=url, dirs=[uid])
+
+            except IOError:
+                failed = True
+                continue
+
+            if response.status_code == 404:
+                continue
+
+            record = RecordHelper.str2record(content=response.content)
+
+            if response.status_code != 200 or not record:
+                failed = True
+                continue
+
+            self._cache.put(record)
+
+            return record
+
+        if failed:
+            raise IOError('Dependant servers failed to get {!s}'.format(uid))
+
+        try:
+            self._cache.forget(uid=uid)
+
+        except RecordMissing:
+            pass
+
+        if self._missing:
+            self._missing.add(uid=uid)
+
+        raise RecordMissing()
+
+    def revalidate(self, uid):
+        """
+        Refreshes a stale cached record in the background. A single refresh
+        of a uid runs at once, the others are dropped.
+        :param uid: str
+        """
+        self._revalidating_lock.acquire()
+
+        try:
+            if uid in self._revalidating:
+                return
+
+            self._revalidating.add(uid)
+
+        finally:
+            self._revalidating_lock.release()
+
+        start_new_thread(self._revalidate_job, (uid,))
+
+    def _revalidate_job(self, uid):
+        """
+        Refreshes a cached record. On failure the stale record stays, served
+        while its windows last.
+        :param uid: str
+        """
+        try:
+            self.refresh(uid=uid)
+
+        except (IOError, RecordMissing):
+            pass
+
+        finally:
+            self._revalidating_lock.acquire()
+
+            try:
+                self._revalidating.discard(uid)
+
+            finally:
+                self._revalidating_lock.release()
+
     def spread_put(self, record):
         """
         Spreads a put call in the background.
@@ -272,6 +439,21 @@ class Spread(object):
                             record,
                             bridge_mode=self._request_bridge)
 
+    def spread_put_stream(self, uid, source):
+        """
+        Spreads a put call streaming the value in the background.
+        :param uid: str
+        :param source: callable returning the record but the value, the
+        bytes length of the value and a function reading it, as
+        TextModel.get_stream does
+        """
+        for url in self._servers:
+            url = '{!s}/{!s}'.format(url, self._route)
+            self._async_put_stream(url,
+                                   uid,
+                                   source,
+                                   bridge_mode=self._request_bridge)
+
     def spread_delete(self, uid):
         """
         Spreads a delete call in the background
@@ -304,15 +486,60 @@ class Spread(object):
                             data=data,
                             params=params)
 
-    def _async_put(self, url, uid, record, bridge_mode):
-        content = json.dumps(record)
+    @classmethod
+    def _put_digest_job(cls, url, dirs, params, record):
+        """Puts the record with the digest of its value instead of the value,
+        and the full record only if the destination has not the value
+        """
+        reference = dict(record)
+        reference[DIGEST_FIELD] = BlobStore.digest(reference.pop('value'))
 
-        data = {'value': content}
+        response = Helpers.request_put(url=url,
+                                       dirs=dirs,
+                                       data={'value': json.dumps(reference)},
+                                       params=params)
+
+        if response.status_code == 409:
+            cls._put_job(url=url,
+                         dirs=dirs,
+                         params=params,
+                         data={'value': json.dumps(record)})
+
+    @classmethod
+    def _put_stream_job(cls, url, dirs, params, source):
+        """Puts the record streaming its value from the source
+        """
+        header, length, read = source()
+
+        Helpers.request_put_stream(url=url,
+                                   dirs=dirs,
+                                   stream=StreamReader(read(), length),
+                                   headers={RECORD_HEADER: json.dumps(header)},
+                                   params=params)
+
+    def _async_put_stream(self, url, uid, source, bridge_mode):
+        params = {MIRROR_MODE: int(True), RAW_MODE: int(True)}
+
+        if bridge_mode:
+            params[BRIDGE_MODE] = int(True)
+
+        start_new_thread(self._put_stream_job, (url, [uid], params, source))
+
+    def _async_put(self, url, uid, record, bridge_mode):
         params = {MIRROR_MODE: int(True)}
 
         if bridge_mode:
             params[BRIDGE_MODE] = int(True)
 
+        if DEDUP:
+            start_new_thread(self._put_digest_job,
+                             (url, [uid], params, record))
+            return
+
+        content = json.dumps(record)
+
+        data = {'value': content}
+
         start_new_thread(self._put_job, (url, [uid], params, data))
 
     def _delete_job(self, url, dirs, params):
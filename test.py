@@ -1,21 +1,46 @@
 #!/usr/bin/env python
 """Basic test cases
 """
+import hashlib
 import json
 import os
+import requests
+import shutil
+import tempfile
 import time
 import unittest2
 import uuid
+from StringIO import StringIO
 from threading import Thread
 
 import sys
-from minstore.cache import MemoryCache
-from minstore.constants import CACHE_MODE
-from minstore.exceptions import RecordExists, RecordMissing
+from minstore.blobs import BlobStore
+from minstore.chunks import ChunkStore
+from minstore.cache import CacheEntry, FRESH, STALE, STALE_IF_ERROR
+from minstore.cache import MemoryCache, NegativeCache, ShardedMemoryCache
+from minstore.cache import CacheSnapshot, ChecksumMap, SingleFlight
+from minstore.compression import Compressor, DictionaryStore
+from minstore.constants import CACHE_MODE, CREATED, DELETED, EXISTS, MISSING
+from minstore.constants import RAW_MODE
+from minstore.eviction import ArcPolicy, CountMinSketch, LfuPolicy, LruPolicy
+from minstore.eviction import TinyLfuPolicy
+from minstore.exceptions import BlobMissing, RecordChanged, RecordExists
+from minstore.exceptions import RecordMissing
+from minstore.expiry import ExpirySchedule, ExpirySweeper, TimerWheel
 
 sys.path.append('..')
 
-from minstore.helpers import Helpers, RecordHelper
+from minstore.helpers import Helpers, RecordHelper, StreamReader
+from minstore.indexes import HashIndex, IndexSet, SortedIndex
+from minstore.models import TextModel
+from minstore.processes import DetectLangProcess, MarkProcess
+from minstore.search import SearchIndex, Tokenizer
+from minstore.serializers import BinarySerializer, JsonSerializer
+from minstore.storage import ChunkedStorage, DedupStorage, FileStorage
+from minstore.storage import LogStorage, WriteBehindStorage
+from minstore.storage import SqliteStorage
+from minstore.storage import FSYNC_DURABILITY, GROUP_DURABILITY
+from minstore.strategies import Spread
 
 URL = 'http://127.0.0.1:8010'
 
@@ -61,7 +86,7 @@ class TestCases(unittest2.TestCase):
             'check_sum': '123456789012345678901'
         }
 
-        cache = MemoryCache(size_limit=std_value * 4)
+        cache = MemoryCache(size_limit=CacheEntry(record=record1).size * 4)
 
         self.assertTrue(cache.put(record=record1))
 
@@ -113,6 +138,1492 @@ class TestCases(unittest2.TestCase):
 
         self.assertRaises(RecordMissing, cache.get, uid='1')
 
+        # check the least recently used record is freed, and a forgotten
+        # record frees its memory
+
+        self.assertEqual(cache.get(uid='2'), record2)
+
+        record6 = dict(record5, uid='6')
+        self.assertTrue(cache.put(record=record6))
+
+        self.assertRaises(RecordMissing, cache.get, uid='3')
+        self.assertEqual(cache.get(uid='2'), record2)
+
+        cache.forget(uid='2')
+        self.assertTrue(cache.put(record=dict(record5, uid='7')))
+        self.assertEqual(cache.get(uid='4'), record4)
+
+    def test_eviction_policies(self):
+        """Unit testing cases for the eviction policies of MemoryCache
+        """
+        def access(cache, uid):
+            try:
+                cache.get(uid=uid)
+
+            except RecordMissing:
+                cache.put(record={'uid': uid, 'check_sum': 1})
+
+        size = CacheEntry(record={'uid': '00', 'check_sum': 1}).size
+
+        # check every policy keeps the cache within its size
+
+        for policy in (LruPolicy, LfuPolicy, ArcPolicy, TinyLfuPolicy):
+            cache = MemoryCache(size_limit=size * 10, policy=policy())
+
+            for index in xrange(50):
+                access(cache=cache, uid='{:02d}'.format(index))
+
+            self.assertEqual(len(cache._buffer), 10)
+            self.assertEqual(cache._buffer_size, size * 10)
+
+        # check a scan of uids read once evicts the hot uids of LRU only
+
+        for policy, kept in ((LruPolicy, False), (LfuPolicy, True),
+                             (ArcPolicy, True), (TinyLfuPolicy, True)):
+            cache = MemoryCache(size_limit=size * 100, policy=policy())
+
+            for round in xrange(10):
+                for index in xrange(20):
+                    access(cache=cache, uid='hot{:d}'.format(index))
+
+            for index in xrange(200):
+                access(cache=cache, uid='scan{:d}'.format(index))
+
+            self.assertEqual(all('hot{:d}'.format(index) in cache._buffer
+                                 for index in xrange(20)), kept)
+
+        # check LFU evicts the least frequently used, then least recently used
+
+        policy = LfuPolicy()
+
+        for key in ('a', 'b', 'c'):
+            policy.add(key=key)
+
+        policy.touch(key='a')
+        policy.touch(key='c')
+        self.assertEqual(policy.victim(), 'b')
+
+        policy.evict(key='b')
+        self.assertEqual(policy.victim(), 'a')
+
+        # check the sketch never counts less than the accesses
+
+        sketch = CountMinSketch(width=64)
+
+        for index in xrange(100):
+            for count in xrange(index % 8):
+                sketch.increment(key=index)
+
+        self.assertTrue(all(sketch.estimate(key=index) >= index % 8
+                            for index in xrange(100)))
+
+        sketch.halve()
+        self.assertTrue(sketch.estimate(key=7) >= 3)
+
+        # check a renewal of the same value takes its new expiration
+
+        now = time.time()
+        cache = MemoryCache()
+        cache.put({'uid': 'r', 'value': 'renewed', 'check_sum': 1,
+                   'expires_at': now + 1})
+        self.assertFalse(cache.put({'uid': 'r', 'value': 'renewed',
+                                    'check_sum': 1,
+                                    'expires_at': now + 3600}))
+
+        entry, state = cache.lookup(uid='r', now=now + 10)
+        self.assertEqual(entry.record['expires_at'], now + 3600)
+
+    def test_sharded_memory_cache_class(self):
+        """Unit testing cases for ShardedMemoryCache class
+        """
+        cache = ShardedMemoryCache(size_limit=1000, shards=4)
+
+        # check the size is split across the segments, every one with its
+        # own policy
+
+        self.assertEqual(sum(shard._size_limit for shard in cache._shards),
+                         1000)
+        self.assertIsNone(cache._policy)
+        self.assertEqual(len(set(id(shard._policy)
+                                 for shard in cache._shards)), 4)
+
+        record = {'uid': '1', 'value': 'text', 'check_sum': 1}
+        self.assertTrue(cache.put(record=record))
+        self.assertFalse(cache.put(record=record))
+        self.assertEqual(cache.get(uid='1'), record)
+
+        cache.forget(uid='1')
+        self.assertRaises(RecordMissing, cache.get, uid='1')
+
+        # check a record bigger than the share of a segment is not cached
+
+        self.assertFalse(cache.put(record=dict(record, value='x' * 300)))
+
+        # check concurrent threads keep every segment within its size and the
+        # stats consistent
+
+        def access(thread):
+            for index in xrange(500):
+                uid = '{:d}-{:02d}'.format(thread, index % 50)
+
+                try:
+                    cache.get(uid=uid)
+
+                except RecordMissing:
+                    cache.put(record=dict(record, uid=uid))
+
+        threads = [Thread(target=access, args=(thread,))
+                   for thread in xrange(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        stats = cache.stats()
+
+        self.assertEqual(stats['hits'] + stats['misses'], 8 * 500 + 2)
+        self.assertEqual(stats['size'], stats['records'] * CacheEntry(
+            record=dict(record, uid='0-00')).size)
+        self.assertEqual(stats['records'],
+                         sum(len(shard._buffer) for shard in cache._shards))
+        self.assertTrue(all(shard._buffer_size <= shard._size_limit
+                            for shard in cache._shards))
+        self.assertTrue(stats['evictions'] > 0)
+
+        # check an unlimited and a disabled cache
+
+        unlimited = ShardedMemoryCache(shards=4)
+        self.assertTrue(unlimited.put(record=dict(record, value='x' * 10000)))
+
+        disabled = ShardedMemoryCache(size_limit=0, shards=4)
+        self.assertFalse(disabled.is_enabled())
+        self.assertIsNone(disabled.put(record=record))
+
+    def test_negative_cache_class(self):
+        """Unit testing cases for NegativeCache class
+        """
+        missing = NegativeCache(size_limit=2, ttl=10)
+        now = time.time()
+
+        missing.add(uid='1', now=now)
+        self.assertTrue(missing.contains(uid='1', now=now + 5))
+        self.assertFalse(missing.contains(uid='1', now=now + 10))
+        self.assertFalse(missing.contains(uid='1', now=now))
+
+        # check the oldest uids are dropped and a forgotten uid is missing
+
+        for uid in ('1', '2', '3'):
+            missing.add(uid=uid, now=now)
+
+        self.assertFalse(missing.contains(uid='1', now=now))
+        self.assertTrue(missing.contains(uid='2', now=now))
+
+        missing.forget(uid='2')
+        self.assertFalse(missing.contains(uid='2', now=now))
+        self.assertEqual(missing.stats(), {'uids': 1,
+                                           'size_limit': 2,
+                                           'hits': 2,
+                                           'misses': 4})
+
+    def test_single_flight_class(self):
+        """Unit testing cases for SingleFlight class
+        """
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(None)
+            time.sleep(0.5)
+
+            if len(calls) > 1:
+                raise RecordMissing()
+
+            return {'uid': '1'}
+
+        def call():
+            try:
+                results.append(flights.do(key='1', function=fetch))
+
+            except RecordMissing, exc:
+                results.append(exc)
+
+        # check the concurrent callers share a single call and its result
+
+        threads = [Thread(target=call) for thread in xrange(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'uid': '1'}] * 8)
+
+        # check a later call runs again, and its error reaches all callers
+
+        del results[:]
+        threads = [Thread(target=call) for thread in xrange(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(isinstance(result, RecordMissing)
+                            for result in results))
+        self.assertEqual(flights._flights, {})
+
+    def test_cache_ttl(self):
+        """Unit testing cases for the time to live of the cached records and
+        their refresh
+        """
+        cache = MemoryCache(ttl=10, stale_while_revalidate=5,
+                            stale_if_error=20)
+        record = {'uid': '1', 'value': 'text', 'check_sum': 1}
+        now = time.time()
+
+        # check the states of a record along its windows
+
+        self.assertTrue(cache.put(record=record))
+
+        for delay, state in ((0, FRESH), (12, STALE), (20, STALE_IF_ERROR)):
+            entry, entry_state = cache.lookup(uid='1', now=now + delay)
+            self.assertEqual(entry.record, record)
+            self.assertEqual(entry_state, state)
+
+        self.assertRaises(RecordMissing, cache.lookup, uid='1', now=now + 40)
+        self.assertRaises(RecordMissing, cache.get, uid='1')
+
+        # check a record put again is fresh again, a ttl per record and a
+        # record expired by its own ttl
+
+        cache.put(record=record, ttl=1)
+        self.assertEqual(cache.lookup(uid='1', now=now + 2)[1], STALE)
+        self.assertFalse(cache.put(record=record))
+        self.assertEqual(cache.lookup(uid='1', now=now + 2)[1], FRESH)
+
+        cache.put(record=dict(record, uid='2', expires_at=now + 1))
+        self.assertRaises(RecordMissing, cache.lookup, uid='2', now=now + 2)
+
+        # check failed refreshes keep the stale record
+
+        config_path = tempfile.mkstemp()[1]
+
+        with open(config_path, 'wb') as config:
+            config.write('http://127.0.0.1:1\n')
+
+        try:
+            strategy = Spread(config_path=config_path, route='text')
+
+        finally:
+            os.remove(config_path)
+
+        strategy.cache = cache
+
+        self.assertRaises(IOError, strategy.refresh, uid='1')
+        self.assertEqual(cache.get(uid='1'), record)
+
+        strategy.revalidate(uid='1')
+        strategy.revalidate(uid='1')
+        time.sleep(1)
+
+        self.assertEqual(strategy._revalidating, set())
+        self.assertEqual(cache.get(uid='1'), record)
+
+        # check a refresh missing on all the dependants is remembered
+
+        strategy.missing = NegativeCache(size_limit=10, ttl=10)
+        strategy._servers = []
+
+        self.assertRaises(RecordMissing, strategy.refresh, uid='1')
+        self.assertRaises(RecordMissing, cache.get, uid='1')
+        self.assertTrue(strategy.missing.contains(uid='1'))
+
+    def test_cache_snapshot_class(self):
+        """Unit testing cases for CacheSnapshot class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            size = CacheEntry(record={'uid': '00', 'check_sum': 1}).size
+            now = time.time()
+
+            for policy in (LruPolicy, LfuPolicy, ArcPolicy, TinyLfuPolicy):
+                cache = MemoryCache(size_limit=size * 10, policy=policy(),
+                                    ttl=10)
+
+                for index in xrange(10):
+                    cache.put(record={'uid': '{:02d}'.format(index),
+                                      'check_sum': 1})
+
+                for index in xrange(5):
+                    cache.get(uid='{:02d}'.format(index))
+
+                self.assertEqual(sorted(cache._policy.keys()),
+                                 sorted(cache._buffer))
+
+                snapshot = CacheSnapshot(cache=cache, base_path=base_path,
+                                         name='test', interval=0)
+                self.assertEqual(snapshot.save(), 10)
+
+                # check the hottest entries are loaded within the size limit,
+                # with their freshness
+
+                restored = MemoryCache(size_limit=size * 5, policy=policy(),
+                                       ttl=10)
+                snapshot = CacheSnapshot(cache=restored, base_path=base_path,
+                                         name='test', interval=0)
+
+                self.assertEqual(snapshot.load(), 5)
+                self.assertEqual(restored._buffer_size, size * 5)
+
+                if policy is LruPolicy:
+                    self.assertEqual(sorted(restored._buffer),
+                                     ['00', '01', '02', '03', '04'])
+
+                self.assertEqual(restored.lookup(uid='00')[1], FRESH)
+                self.assertRaises(RecordMissing, restored.lookup, uid='00',
+                                  now=now + 20)
+
+            # check the entries past their windows are not loaded, nor the
+            # uids cached meanwhile
+
+            cache = MemoryCache(ttl=10)
+            cache.put(record={'uid': '1', 'check_sum': 1})
+            cache.put(record={'uid': '2', 'check_sum': 1,
+                              'expires_at': now - 1})
+            cache.put(record={'uid': '3', 'check_sum': 1})
+            CacheSnapshot(cache=cache, base_path=base_path, name='test',
+                          interval=0).save()
+
+            restored = ShardedMemoryCache(shards=4, ttl=10)
+            restored.put(record={'uid': '3', 'check_sum': 2})
+            snapshot = CacheSnapshot(cache=restored, base_path=base_path,
+                                     name='test', interval=0)
+
+            self.assertEqual(snapshot.load(now=now + 5), 1)
+            self.assertEqual(restored.get(uid='1'), {'uid': '1',
+                                                     'check_sum': 1})
+            self.assertEqual(restored.get(uid='3')['check_sum'], 2)
+            self.assertEqual(snapshot.load(now=now + 20), 0)
+
+            self.assertTrue(CacheSnapshot.exists(base_path=base_path,
+                                                 name='test'))
+            self.assertFalse(CacheSnapshot.exists(base_path=base_path,
+                                                  name='missing'))
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_cached_text_model(self):
+        """Unit testing cases for TextModel with a cache of the records
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            storage = FileStorage(base_path=base_path)
+            cache = MemoryCache()
+            model = TextModel(storage=storage, processes=[], cache=cache)
+
+            # check the writes and the reads fill the cache
+
+            record = model.insert(uid='1', values={'value': 'first'})
+            self.assertEqual(cache.get(uid='1'), record)
+
+            cache.forget(uid='1')
+            self.assertEqual(model.get(uid='1'), record)
+            self.assertEqual(cache.get(uid='1'), record)
+            self.assertEqual(cache.stats()['misses'], 1)
+
+            # check a cached record is read without the storage
+
+            storage.delete(uid='1')
+            self.assertEqual(model.get(uid='1'), record)
+            storage.insert(record=record)
+
+            # check the updates, the copies and the deletes refresh the cache
+
+            record = model.update(uid='1', values={'value': 'second'})
+            self.assertEqual(model.get(uid='1')['value'], 'second')
+
+            copied = dict(record, value='third',
+                          check_sum=Helpers.sign('third'))
+            model.copy(record=copied)
+            self.assertEqual(model.get(uid='1')['value'], 'third')
+
+            model.copy(record={'uid': '2', 'value': 'copied',
+                               'check_sum': Helpers.sign('copied')})
+            self.assertEqual(cache.get(uid='2')['value'], 'copied')
+
+            model.delete(uid='1')
+            self.assertRaises(RecordMissing, cache.get, uid='1')
+            self.assertRaises(RecordMissing, model.get, uid='1')
+
+            # check an expired record is missing
+
+            model.insert(uid='3', values={'value': 'short', 'ttl': 0.1})
+            time.sleep(0.2)
+            self.assertRaises(RecordMissing, model.get, uid='3')
+
+            # check a delete while reading a record is not hidden by the cache
+
+            model.insert(uid='4', values={'value': 'deleted while read'})
+            cache.forget(uid='4')
+            deleter = Thread(target=model.delete, kwargs={'uid': '4'})
+
+            def select(uid):
+                deleter.start()
+                time.sleep(0.1)
+
+                return FileStorage.select(storage, uid=uid)
+
+            storage.select = select
+            model.get(uid='4')
+            deleter.join()
+            del storage.select
+
+            self.assertRaises(RecordMissing, cache.get, uid='4')
+            self.assertRaises(RecordMissing, model.get, uid='4')
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_conditional_text_model(self):
+        """Unit testing cases for TextModel with a map of the check sums
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            storage = FileStorage(base_path=base_path)
+            check_sums = ChecksumMap(size_limit=2)
+            model = TextModel(storage=storage, processes=[],
+                              check_sums=check_sums)
+
+            # check the writes fill the map, read without the storage
+
+            record = model.insert(uid='1', values={'value': 'first'})
+            self.assertEqual(check_sums.get(uid='1'),
+                             (record['check_sum'], None))
+
+            storage.delete(uid='1')
+            self.assertEqual(model.find_check_sum(uid='1'),
+                             record['check_sum'])
+            storage.insert(record=record)
+
+            # check the map is bounded, and the storage answers the others
+
+            model.insert(uid='2', values={'value': 'second'})
+            model.insert(uid='3', values={'value': 'third'})
+            self.assertRaises(KeyError, check_sums.get, uid='1')
+            self.assertEqual(model.find_check_sum(uid='1'),
+                             record['check_sum'])
+            self.assertIsNone(model.find_check_sum(uid='4'))
+
+            # check a read does not replace the check sum of a write
+
+            check_sums.put(record={'uid': '1', 'check_sum': 0},
+                           replace=False)
+            self.assertEqual(check_sums.get(uid='1')[0], record['check_sum'])
+
+            # check the compare and swap of the updates and the deletes
+
+            self.assertRaises(RecordChanged, model.update, uid='1',
+                              values={'value': 'changed'},
+                              expected=record['check_sum'] + 1)
+            self.assertEqual(model.get(uid='1')['value'], 'first')
+
+            updated = model.update(uid='1', values={'value': 'changed'},
+                                   expected=record['check_sum'])
+            self.assertEqual(model.find_check_sum(uid='1'),
+                             updated['check_sum'])
+
+            self.assertRaises(RecordChanged, model.delete, uid='1',
+                              expected=record['check_sum'])
+            model.delete(uid='1', expected=updated['check_sum'])
+            self.assertIsNone(model.find_check_sum(uid='1'))
+
+            # check an expired record has no check sum
+
+            model.insert(uid='5', values={'value': 'short', 'ttl': 0.1})
+            time.sleep(0.2)
+            self.assertIsNone(model.find_check_sum(uid='5'))
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_log_storage_class(self):
+        """Unit testing cases for LogStorage class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            storage = LogStorage(base_path=base_path, compaction_interval=0)
+
+            record1 = {'uid': '1', 'value': 'first', 'check_sum': 1}
+            record2 = {'uid': '2', 'value': 'second', 'check_sum': 2}
+
+            storage.insert(record=record1)
+            storage.insert(record=record2)
+
+            self.assertEqual(storage.select(uid='1'), record1)
+            self.assertEqual(storage.select(uid='2'), record2)
+
+            record1['value'] = 'first updated'
+            storage.update(record=record1)
+            storage.delete(uid='2')
+
+            self.assertEqual(storage.select(uid='1'), record1)
+            self.assertFalse(storage.exists(uid='2'))
+            self.assertRaises(RecordMissing, storage.select, uid='2')
+            self.assertRaises(RecordMissing, storage.delete, uid='2')
+            self.assertRaises(RecordExists, storage.insert, record=record1)
+
+            # check the index is rebuilt from the segments
+
+            storage.close()
+            storage = LogStorage(base_path=base_path, compaction_interval=0)
+
+            self.assertEqual(storage.select(uid='1'), record1)
+            self.assertFalse(storage.exists(uid='2'))
+
+            # check compaction keeps only the live records
+
+            storage.compact()
+            storage.close()
+
+            segments = os.listdir(base_path)
+            self.assertEqual(len(segments), 2)
+
+            storage = LogStorage(base_path=base_path, compaction_interval=0)
+            self.assertEqual(storage.select(uid='1'), record1)
+            self.assertFalse(storage.exists(uid='2'))
+            storage.close()
+
+            # check the synced durabilities cover every append
+
+            for durability in (FSYNC_DURABILITY, GROUP_DURABILITY):
+                storage = LogStorage(base_path=base_path,
+                                     compaction_interval=0,
+                                     durability=durability,
+                                     segment_size=64)
+
+                threads = [Thread(target=storage.update,
+                                  kwargs={'record': {'uid': str(index),
+                                                     'value': durability,
+                                                     'check_sum': index}})
+                           for index in range(5)]
+
+                for thread in threads:
+                    thread.start()
+
+                for thread in threads:
+                    thread.join()
+
+                storage.delete_many(uids=['3', '4'])
+                self.assertEqual(storage._synced, storage._written)
+                storage.close()
+
+                storage = LogStorage(base_path=base_path,
+                                     compaction_interval=0)
+                self.assertEqual(storage.select(uid='2')['value'], durability)
+                self.assertFalse(storage.exists(uid='3'))
+                storage.close()
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_sharded_file_storage_class(self):
+        """Unit testing cases for the sharded layout of FileStorage class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            flat = FileStorage(base_path=base_path)
+            sharded = FileStorage(base_path=base_path, shard_levels=2)
+
+            record1 = {'uid': '1', 'value': 'flat record', 'check_sum': 1}
+            record2 = {'uid': '2', 'value': 'sharded record', 'check_sum': 2}
+
+            flat.insert(record=record1)
+            sharded.insert(record=record2)
+
+            self.assertTrue(Helpers.path_exists(base_path + '/1'))
+            self.assertFalse(Helpers.path_exists(base_path + '/2'))
+
+            # check both layouts are readable while migrating
+
+            self.assertTrue(sharded.exists(uid='1'))
+            self.assertEqual(sharded.select(uid='1'), record1)
+            self.assertEqual(sharded.select(uid='2'), record2)
+
+            self.assertEqual(sharded.migrate(), 1)
+            self.assertFalse(Helpers.path_exists(base_path + '/1'))
+            self.assertEqual(sharded.select(uid='1'), record1)
+
+            sharded.delete(uid='1')
+            self.assertFalse(sharded.exists(uid='1'))
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_file_storage_class(self):
+        """Unit testing cases for the single I/O calls of FileStorage class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            storage = FileStorage(base_path=base_path)
+
+            record = {
+                'uid': '1',
+                'value': 'the value is not decoded by a header select',
+                'check_sum': 1,
+                'timestamp': 1.0,
+                'size': 10
+            }
+
+            self.assertRaises(RecordMissing, storage.select, uid='1')
+            self.assertRaises(RecordMissing, storage.select_header, uid='1')
+            self.assertRaises(RecordMissing, storage.delete, uid='1')
+
+            storage.insert(record=record)
+
+            self.assertRaises(RecordExists, storage.insert, record=record)
+            self.assertEqual(storage.select(uid='1'), record)
+
+            header = storage.select_header(uid='1')
+            self.assertNotIn('value', header)
+            self.assertEqual(header['check_sum'], record['check_sum'])
+            self.assertEqual(header['size'], record['size'])
+
+            storage.delete(uid='1')
+            self.assertFalse(storage.exists(uid='1'))
+
+            # check rewrite keeps a record written while rewriting it
+
+            storage.insert(record=record)
+            self.assertEqual(storage.rewrite(), 1)
+
+            newer = dict(record, value='newer value')
+            writer = FileStorage(base_path=base_path)
+
+            def read(source):
+                writer.update(record=newer)
+
+                return FileStorage._read(storage, source=source)
+
+            storage._read = read
+
+            self.assertEqual(storage.rewrite(), 0)
+            self.assertEqual(writer.select(uid='1'), newer)
+
+            # check the writes wait for a rewrite holding the directory
+
+            with Helpers.lock_dir(dir_path=base_path, exclusive=True):
+                thread = Thread(target=writer.update,
+                                kwargs={'record': record})
+                thread.start()
+                time.sleep(0.1)
+
+                self.assertTrue(thread.is_alive())
+                self.assertEqual(writer.select(uid='1'), newer)
+
+            thread.join()
+            self.assertEqual(writer.select(uid='1'), record)
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_binary_serializer_class(self):
+        """Unit testing cases for BinarySerializer class
+        """
+        serializer = BinarySerializer()
+
+        record = {
+            'uid': u'1',
+            'value': u'Binary format v\xe0lue',
+            'check_sum': -1234567890123,
+            'timestamp': 1500000000.25,
+            'size': 120,
+            'lang': u'ct',
+            'marked': True
+        }
+
+        content = serializer.dumps(record=record)
+
+        self.assertEqual(serializer.loads(content=content), record)
+
+        header = serializer.load_header(source=StringIO(content))
+        self.assertNotIn('value', header)
+        self.assertEqual(header['check_sum'], record['check_sum'])
+        self.assertEqual(header['marked'], record['marked'])
+
+        # check the JSON records are read transparently
+
+        content = JsonSerializer().dumps(record=record)
+
+        self.assertEqual(serializer.loads(content=content), record)
+        self.assertEqual(serializer.load_header(source=StringIO(content)),
+                         header)
+
+        self.assertIsNone(serializer.loads(content='http://127.0.0.1:8002'))
+
+    def test_compressed_binary_serializer(self):
+        """Unit testing cases for the compression of BinarySerializer class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            value = self.sample_normal['value']
+            record = {
+                'uid': u'1',
+                'value': value,
+                'check_sum': 1,
+                'timestamp': 1.0,
+                'size': 10
+            }
+
+            compressor = Compressor(base_path=base_path, threshold=64)
+            serializer = BinarySerializer(compressor=compressor)
+
+            zlib_content = serializer.dumps(record=record)
+            self.assertLess(len(zlib_content), len(value))
+            self.assertEqual(serializer.loads(content=zlib_content), record)
+
+            # check the values compressed with a dictionary are smaller
+
+            dictionary = DictionaryStore.train(samples=[value, value])
+            DictionaryStore(base_path=base_path).save(dictionary)
+
+            compressor = Compressor(base_path=base_path, threshold=64)
+            serializer = BinarySerializer(compressor=compressor)
+
+            content = serializer.dumps(record=record)
+            self.assertLess(len(content), len(zlib_content))
+            self.assertEqual(serializer.loads(content=content), record)
+
+            # check the plain and compressed records coexist
+
+            record['value'] = u'short'
+            content = serializer.dumps(record=record)
+            self.assertEqual(serializer.loads(content=content), record)
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_group_commit_file_storage(self):
+        """Unit testing cases for the group durability of FileStorage class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            storage = FileStorage(base_path=base_path,
+                                  durability=GROUP_DURABILITY)
+
+            writers = list()
+
+            for index in range(20):
+                record = {'uid': str(index), 'value': 'concurrent write'}
+                writers.append(Thread(target=storage.insert, args=[record]))
+
+            for writer in writers:
+                writer.start()
+
+            for writer in writers:
+                writer.join()
+
+            for index in range(20):
+                record = storage.select(uid=str(index))
+                self.assertEqual(record['value'], 'concurrent write')
+
+            # check no temporary file is left
+
+            self.assertEqual(len(os.listdir(base_path)), 20)
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_sqlite_storage_class(self):
+        """Unit testing cases for SqliteStorage class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            storage = SqliteStorage(base_path=base_path)
+
+            record1 = {'uid': '1', 'value': 'first', 'check_sum': 1}
+            record2 = {'uid': '2', 'value': 'second', 'check_sum': 2}
+
+            storage.insert(record=record1)
+
+            self.assertRaises(RecordExists, storage.insert, record=record1)
+            self.assertEqual(storage.select(uid='1'), record1)
+            self.assertEqual(storage.select_header(uid='1'),
+                             {'uid': '1', 'check_sum': 1})
+
+            # check a failed transaction leaves no change
+
+            def failed_transaction():
+                with storage.transaction():
+                    storage.insert(record=record2)
+                    storage.delete(uid='1')
+                    storage.delete(uid='1')
+
+            self.assertRaises(RecordMissing, failed_transaction)
+            self.assertTrue(storage.exists(uid='1'))
+            self.assertFalse(storage.exists(uid='2'))
+
+            with storage.transaction():
+                storage.insert(record=record2)
+                storage.delete(uid='1')
+
+            self.assertRaises(RecordMissing, storage.select, uid='1')
+            self.assertEqual(storage.select(uid='2'), record2)
+
+            # check the concurrent writers
+
+            writers = list()
+
+            for index in range(10, 30):
+                record = {'uid': str(index), 'value': 'concurrent write'}
+                writers.append(Thread(target=storage.update, args=[record]))
+
+            for writer in writers:
+                writer.start()
+
+            for writer in writers:
+                writer.join()
+
+            for index in range(10, 30):
+                self.assertTrue(storage.exists(uid=str(index)))
+
+            storage.close()
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_batch_storage_methods(self):
+        """Unit testing cases for the batch methods of storages and model
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            paths = [os.path.join(base_path, name)
+                     for name in ['file', 'log', 'db']]
+
+            for path in paths:
+                os.mkdir(path)
+
+            storages = [FileStorage(base_path=paths[0], shard_levels=1),
+                        LogStorage(base_path=paths[1]),
+                        SqliteStorage(base_path=paths[2])]
+
+            for storage in storages:
+                model = TextModel(storage=storage, processes=[MarkProcess])
+
+                model.insert(uid='1', values={'value': 'first'})
+
+                results = model.insert_many(items={'1': {'value': 'again'},
+                                                   '2': {'value': 'second'},
+                                                   '3': {'value': 'third'}})
+
+                self.assertEqual(results['1'][0], EXISTS)
+                self.assertEqual(results['2'][0], CREATED)
+                self.assertEqual(results['3'][0], CREATED)
+                self.assertEqual(results['2'][1]['value'], 'second (Marked).')
+
+                records = model.get_many(uids=['1', '2', '4'])
+
+                self.assertEqual(records['1']['value'], 'first (Marked).')
+                self.assertEqual(records['2'], results['2'][1])
+                self.assertIsNone(records['4'])
+
+                self.assertEqual(model.delete_many(uids=['2', '4']),
+                                 {'2': DELETED, '4': MISSING})
+                self.assertFalse(storage.exists(uid='2'))
+                self.assertTrue(storage.exists(uid='3'))
+
+                storage.close()
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_scan_storage_methods(self):
+        """Unit testing cases for the scan of the storages
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            paths = [os.path.join(base_path, name)
+                     for name in ['file', 'log', 'db']]
+
+            for path in paths:
+                os.mkdir(path)
+
+            # not a record, as the servers list
+            with open(os.path.join(paths[0], 'b-list'), 'w') as list_file:
+                list_file.write('http://127.0.0.1:8001')
+
+            storages = [FileStorage(base_path=paths[0], shard_levels=1),
+                        LogStorage(base_path=paths[1]),
+                        SqliteStorage(base_path=paths[2])]
+
+            uids = ['a1', 'b1', 'b2', 'b3', 'c1']
+
+            for storage in storages:
+                for uid in reversed(uids):
+                    storage.insert(record={'uid': uid, 'value': uid})
+
+                scanned = [record['uid'] for record in storage.scan()]
+                self.assertEqual(scanned, uids)
+
+                scanned = [record['uid'] for record
+                           in storage.scan(prefix='b', start_after='b1')]
+                self.assertEqual(scanned, ['b2', 'b3'])
+
+                cursor = Helpers.encode_cursor(uid='a1')
+                scanned = [record['uid'] for record in storage.scan(
+                    start_after=Helpers.decode_cursor(cursor=cursor),
+                    limit=2)]
+                self.assertEqual(scanned, ['b1', 'b2'])
+
+                storage.close()
+
+            # check the listed files follow the writes, across the batches
+
+            storage = FileStorage(base_path=paths[0], shard_levels=1)
+            self.assertEqual(list(storage.iter_uids(prefix='b')),
+                             ['b-list', 'b1', 'b2', 'b3'])
+
+            storage.delete(uid='b2')
+            storage.insert(record={'uid': u'b0', 'value': 'b0'})
+            storage.insert_many(records=[{'uid': 'd{:04d}'.format(index),
+                                          'value': 'd'}
+                                         for index in xrange(1500)])
+
+            self.assertEqual(list(storage.iter_uids(prefix='b')),
+                             ['b-list', 'b0', 'b1', 'b3'])
+            self.assertEqual(len(list(storage.scan(prefix='d'))), 1500)
+            self.assertEqual(len(list(storage.scan(start_after='d0999'))),
+                             500)
+
+            self.assertRaises(ValueError, Helpers.decode_cursor, cursor='a')
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_index_set_class(self):
+        """Unit testing cases for IndexSet class and the model indexing
+        """
+        base_path = tempfile.mkdtemp()
+
+        def index_set():
+            return IndexSet(base_path=base_path,
+                            indexes=[HashIndex(field='lang'),
+                                     SortedIndex(field='timestamp')],
+                            snapshot_interval=3)
+
+        try:
+            storage = FileStorage(base_path=base_path)
+            indexes = index_set()
+            model = TextModel(storage=storage, processes=[], indexes=indexes)
+
+            self.assertTrue(indexes.created)
+
+            for uid, lang, timestamp in [('1', 'en', 10), ('2', 'fr', 20),
+                                         ('3', 'en', 30), ('4', 'fr', 40)]:
+                model.copy(record={'uid': uid, 'value': uid, 'lang': lang,
+                                   'timestamp': timestamp})
+
+            model.copy(record={'uid': '3', 'value': '3', 'lang': 'fr',
+                               'timestamp': 50})
+            model.delete(uid='4')
+
+            self.assertEqual(indexes.find(field='lang', value='en'), ['1'])
+            self.assertEqual(indexes.find(field='lang', value='fr'),
+                             ['2', '3'])
+            self.assertEqual(indexes.range(field='timestamp', low=15),
+                             ['2', '3'])
+            self.assertEqual(indexes.range(field='timestamp', high=20,
+                                           limit=1), ['1'])
+
+            # check a reload of the snapshot and the journal, with a partial
+            # last entry
+
+            indexes.close()
+
+            with open(os.path.join(base_path, '.index', 'journal.log'),
+                      'ab') as journal:
+                journal.write('["5", {"lang"')
+
+            indexes = index_set()
+
+            self.assertFalse(indexes.created)
+            self.assertFalse(indexes.outdated)
+            self.assertEqual(indexes.find(field='lang', value='fr'),
+                             ['2', '3'])
+            self.assertEqual(indexes.range(field='timestamp'), ['1', '2', '3'])
+
+            indexes.close()
+
+            # check an added index outdates the snapshot until a rebuild
+
+            def added_index_set():
+                return IndexSet(base_path=base_path,
+                                indexes=[HashIndex(field='lang'),
+                                         HashIndex(field='value'),
+                                         SortedIndex(field='timestamp')])
+
+            indexes = added_index_set()
+            self.assertTrue(indexes.outdated)
+
+            indexes.rebuild(records=storage.scan())
+            self.assertEqual(indexes.find(field='value', value='2'), ['2'])
+            indexes.close()
+
+            indexes = added_index_set()
+            self.assertFalse(indexes.outdated)
+            indexes.close()
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_search_index_class(self):
+        """Unit testing cases for SearchIndex class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            search = SearchIndex(base_path=base_path,
+                                 delta_limit=2,
+                                 max_segments=2)
+
+            self.assertEqual(Tokenizer.tokenize(text='The red-car, a car.'),
+                             [u'the', u'red', u'car', u'car'])
+            self.assertEqual(Tokenizer.parse_query(query='red car OR bike'),
+                             [[u'car', u'red'], [u'bike']])
+
+            texts = [('1', 'the red car'), ('2', 'a blue car'),
+                     ('3', 'red bike, red'), ('4', 'blue bike'),
+                     ('5', 'green tree')]
+
+            for uid, text in texts:
+                search.put(uid=uid, value=text)
+
+            uids = lambda results: [uid for uid, score in results]
+
+            self.assertEqual(uids(search.search(query='red car')), ['1'])
+            self.assertEqual(uids(search.search(query='red')), ['3', '1'])
+            self.assertEqual(
+                sorted(uids(search.search(query='tree OR bike'))),
+                ['3', '4', '5'])
+            self.assertEqual(len(search.search(query='car OR bike',
+                                               limit=2)), 2)
+
+            search.put(uid='1', value='yellow car')
+            search.remove(uid='4')
+
+            self.assertEqual(uids(search.search(query='red')), ['3'])
+            self.assertEqual(uids(search.search(query='bike')), ['3'])
+
+            # check a reload of the segments and the journal
+
+            search.close()
+            search = SearchIndex(base_path=base_path,
+                                 delta_limit=2,
+                                 max_segments=2)
+
+            self.assertFalse(search.created)
+            self.assertEqual(uids(search.search(query='yellow')), ['1'])
+            self.assertEqual(uids(search.search(query='blue')), ['2'])
+
+            # check the updates do not grow the documents, renumbered when
+            # the tombstones outnumber them
+
+            for round in xrange(20):
+                search.put(uid='2', value='blue car {:d}'.format(round))
+
+            search.flush()
+            self.assertLessEqual(len(search._uids),
+                                 2 * len(search._doc_ids) + 2)
+            self.assertEqual(uids(search.search(query='blue')), ['2'])
+            self.assertEqual(uids(search.search(query='19')), ['2'])
+
+            search.remove(uid='5')
+            search.flush()
+            search.close()
+            search = SearchIndex(base_path=base_path,
+                                 delta_limit=2,
+                                 max_segments=2)
+
+            self.assertEqual(sorted(search._doc_ids), [u'1', u'2', u'3'])
+            self.assertEqual(uids(search.search(query='tree OR yellow')),
+                             ['1'])
+            self.assertEqual(uids(search.search(query='19')), ['2'])
+
+            with open(os.path.join(base_path, '.search',
+                                   'manifest.json')) as manifest:
+                self.assertNotIn('uids', json.load(manifest))
+
+            search.close()
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_dedup_storage_class(self):
+        """Unit testing cases for DedupStorage and BlobStore classes
+        """
+        base_path = tempfile.mkdtemp()
+
+        def dedup_storage():
+            return DedupStorage(storage=FileStorage(base_path=base_path),
+                                blobs=BlobStore(base_path=base_path))
+
+        def blob_files():
+            return sum(len(filenames) for dir_path, dir_names, filenames
+                       in os.walk(os.path.join(base_path, '.blobs'))
+                       if dir_path != os.path.join(base_path, '.blobs'))
+
+        try:
+            storage = dedup_storage()
+            model = TextModel(storage=storage, processes=[])
+            shared = 'shared text ' * 100
+            digest = BlobStore.digest(value=shared)
+
+            storage.insert(record={'uid': '1', 'value': shared})
+            storage.insert(record={'uid': '2', 'value': shared})
+            storage.update(record={'uid': '3', 'value': 'single'})
+
+            self.assertRaises(RecordExists, storage.insert,
+                              record={'uid': '1', 'value': 'other'})
+            self.assertEqual(storage.select(uid='1'),
+                             {'uid': '1', 'value': shared})
+            self.assertEqual(storage.select_header(uid='2'), {'uid': '2'})
+            self.assertEqual(blob_files(), 2)
+
+            with open(os.path.join(base_path, '1')) as record_file:
+                self.assertNotIn(shared, record_file.read())
+
+            # check a copy by digest takes the stored value, and fails
+            # without it
+
+            record = model.copy(record={'uid': '4', 'digest': digest})
+            self.assertEqual(record['value'], shared)
+            self.assertRaises(BlobMissing, model.copy,
+                              record={'uid': '5', 'digest': '0' * 40})
+            self.assertRaises(BlobMissing, FileStorage(
+                base_path=base_path).update_by_digest,
+                record={'uid': '5', 'digest': digest})
+
+            # check the values are removed with their last reference
+
+            storage.update(record={'uid': '3', 'value': shared})
+            self.assertEqual(blob_files(), 1)
+
+            for uid in ['1', '2', '3']:
+                storage.delete(uid=uid)
+
+            self.assertEqual(storage.select(uid='4')['value'], shared)
+
+            # check the counts survive a reload and a recount frees a leak
+
+            storage.close()
+            storage = dedup_storage()
+
+            storage._blobs.acquire(value='leaked')
+            self.assertEqual(blob_files(), 2)
+            self.assertEqual(storage.recount(), 1)
+            self.assertEqual(blob_files(), 1)
+
+            storage.delete(uid='4')
+            self.assertEqual(blob_files(), 0)
+
+            storage.close()
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_chunked_storage_class(self):
+        """Unit testing cases for ChunkedStorage and ChunkStore classes
+        """
+        base_path = tempfile.mkdtemp()
+
+        def chunk_dirs():
+            return sum(len(dir_names) for dir_path, dir_names, filenames
+                       in os.walk(os.path.join(base_path, '.chunks'))
+                       if dir_path != os.path.join(base_path, '.chunks'))
+
+        try:
+            storage = ChunkedStorage(storage=FileStorage(base_path=base_path),
+                                     chunks=ChunkStore(base_path=base_path,
+                                                       chunk_size=4),
+                                     threshold=8)
+            model = TextModel(storage=storage,
+                              processes=[DetectLangProcess, MarkProcess])
+            large = u'\xe9 large text'
+            content = large.encode('utf-8')
+
+            # check the large values are streamed into chunks, skipping the
+            # processes changing the value
+
+            header = model.insert_stream(uid='1',
+                                         stream=StringIO(content),
+                                         length=len(content))
+
+            self.assertNotIn('value', header)
+            self.assertIn('lang', header)
+            self.assertEqual(storage.select(uid='1')['value'], large)
+            self.assertEqual(chunk_dirs(), 1)
+
+            with open(os.path.join(base_path, '1')) as record_file:
+                self.assertNotIn('large', record_file.read())
+
+            record, length, read = model.get_stream(uid='1')
+            self.assertEqual(length, len(content))
+            self.assertEqual(''.join(read()), content)
+            self.assertEqual(''.join(read(3, 9)), content[3:9])
+            self.assertEqual(''.join(read(9)), content[9:])
+
+            # check the short values are stored plain
+
+            storage.insert(record={'uid': '2', 'value': u'short'})
+            self.assertEqual(storage.select_header(uid='2'), {'uid': '2'})
+            self.assertEqual(''.join(storage.select_stream(uid='2')[2](1, 3)),
+                             'ho')
+
+            # check the chunks are removed with their record
+
+            storage.update(record={'uid': '1', 'value': u'short'})
+            self.assertEqual(chunk_dirs(), 0)
+
+            storage.update(record={'uid': '2', 'value': large})
+            self.assertEqual(chunk_dirs(), 1)
+            storage.delete(uid='2')
+            self.assertEqual(chunk_dirs(), 0)
+
+            # check the short or invalid streams leave no chunks
+
+            self.assertRaises(ValueError, model.insert_stream, uid='3',
+                              stream=StringIO(content), length=100)
+            self.assertRaises(ValueError, model.insert_stream, uid='3',
+                              stream=StringIO('\xff' * 10), length=10)
+            self.assertRaises(RecordMissing, model.update_stream, uid='3',
+                              stream=StringIO(content), length=len(content))
+            self.assertEqual(chunk_dirs(), 0)
+            self.assertFalse(storage.exists(uid='3'))
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_write_behind_storage_class(self):
+        """Unit testing cases for WriteBehindStorage class
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            stored = FileStorage(base_path=base_path)
+            storage = WriteBehindStorage(storage=stored,
+                                         max_records=3,
+                                         flush_records=10,
+                                         max_age=60)
+
+            # check the pending writes are coalesced and read from the buffer
+
+            storage.insert(record={'uid': '1', 'value': u'first'})
+            storage.update(record={'uid': '1', 'value': u'second'})
+            storage.update(record={'uid': '2', 'value': u'other'})
+            storage.delete(uid='2')
+
+            self.assertRaises(RecordExists, storage.insert,
+                              record={'uid': '1', 'value': u'third'})
+            self.assertRaises(RecordMissing, storage.delete, uid='2')
+            self.assertRaises(RecordMissing, storage.select, uid='2')
+            self.assertEqual(storage.select(uid='1')['value'], u'second')
+            self.assertEqual(storage.select_header(uid='1'), {'uid': '1'})
+            self.assertEqual(storage.select_many(uids=['1', '2']),
+                             {'1': {'uid': '1', 'value': u'second'},
+                              '2': None})
+            self.assertFalse(stored.exists(uid='1'))
+
+            storage.flush()
+            self.assertEqual(stored.select(uid='1')['value'], u'second')
+            self.assertFalse(stored.exists(uid='2'))
+
+            # check a write over the limit flushes the buffer, and the close
+            # drains it
+
+            for uid in ['3', '4', '5']:
+                storage.update(record={'uid': uid, 'value': u'bounded'})
+
+            self.assertFalse(stored.exists(uid='3'))
+            storage.update(record={'uid': '6', 'value': u'bounded'})
+            self.assertTrue(stored.exists(uid='3'))
+            self.assertTrue(stored.exists(uid='6'))
+
+            storage.delete(uid='1')
+            self.assertEqual([record['uid'] for record in storage.scan()],
+                             ['3', '4', '5', '6'])
+
+            storage.update(record={'uid': '7', 'value': u'last'})
+            storage.close()
+            self.assertEqual(stored.select(uid='7')['value'], u'last')
+
+            # check the background thread flushes by age
+
+            storage = WriteBehindStorage(storage=stored, max_age=0.01)
+            storage.update(record={'uid': '8', 'value': u'aged'})
+            time.sleep(0.5)
+            self.assertTrue(stored.exists(uid='8'))
+            storage.close()
+
+            # check a failed flush is pending again ahead of the newer writes
+
+            storage = WriteBehindStorage(storage=stored, max_age=3600)
+            storage.update(record={'uid': 'a', 'value': u'failed'})
+            storage.update(record={'uid': 'b', 'value': u'not flushed'})
+
+            def fail(record):
+                storage.update(record={'uid': 'a', 'value': u'newer'})
+                storage.update(record={'uid': 'c', 'value': u'later'})
+                raise IOError('Disk failure')
+
+            stored.update = fail
+            self.assertRaises(IOError, storage.flush)
+            self.assertEqual(storage._pending.keys(), ['a', 'b', 'c'])
+            self.assertEqual(storage.select(uid='a')['value'], u'newer')
+
+            del stored.update
+
+            # check an insert reads the wrapped storage out of the lock
+
+            free = list()
+
+            def exists(uid):
+                def probe():
+                    free.append(storage._lock.acquire(False))
+
+                    if free[-1]:
+                        storage._lock.release()
+
+                prober = Thread(target=probe)
+                prober.start()
+                prober.join()
+
+                return FileStorage.exists(stored, uid=uid)
+
+            stored.exists = exists
+            storage.insert(record={'uid': 'd', 'value': u'unlocked'})
+            del stored.exists
+            self.assertEqual(free, [True])
+
+            storage.close()
+            self.assertEqual(stored.select(uid='a')['value'], u'newer')
+            self.assertEqual(stored.select(uid='c')['value'], u'later')
+
+        finally:
+            shutil.rmtree(base_path)
+
+    def test_expiry_schedule_class(self):
+        """Unit testing cases for TimerWheel, ExpirySchedule and
+        ExpirySweeper classes
+        """
+        base_path = tempfile.mkdtemp()
+
+        try:
+            # check a small wheel returns every uid once at its deadline,
+            # past its span too
+
+            wheel = TimerWheel(now=1000, slots=4, levels=2)
+
+            for uid, deadline in [('a', 1001), ('b', 1005.5), ('c', 1030),
+                                  ('d', 1030), ('e', 999)]:
+                wheel.schedule(uid=uid, deadline=deadline)
+
+            wheel.cancel(uid='d')
+            self.assertEqual(wheel.advance(now=1000), ['e'])
+            self.assertEqual(wheel.advance(now=1005.9), ['a'])
+            self.assertEqual(wheel.advance(now=1006), ['b'])
+            self.assertEqual(wheel.advance(now=1029), [])
+            self.assertEqual(wheel.advance(now=1100), ['c'])
+            self.assertEqual(len(wheel), 0)
+
+            # check the model hides and deletes the expired records
+
+            now = time.time()
+            storage = FileStorage(base_path=base_path)
+            schedule = ExpirySchedule(base_path=base_path)
+            model = TextModel(storage=storage, processes=[], expiry=schedule)
+
+            model.insert(uid='1', values={'value': 'short', 'ttl': 60})
+            model.insert(uid='2', values={'value': 'long', 'ttl': 3600})
+            model.insert(uid='3', values={'value': 'forever'})
+            storage.update(record={'uid': '4', 'value': 'expired',
+                                   'expires_at': now - 1})
+
+            self.assertIsNone(schedule.get(uid='3'))
+            self.assertRaises(RecordMissing, model.get, uid='4')
+            self.assertEqual(model.get_many(uids=['3', '4'])['4'], None)
+
+            # check the schedule survives a reload
+
+            schedule.close()
+            schedule = ExpirySchedule(base_path=base_path)
+            self.assertFalse(schedule.created)
+            self.assertAlmostEqual(schedule.get(uid='1'), now + 60, places=0)
+
+            schedule.rebuild(records=storage.scan())
+            model = TextModel(storage=storage, processes=[], expiry=schedule)
+
+            # check the sweeper deletes the expired records in batches
+
+            expired = list()
+
+            def expire(uids):
+                expired.append(sorted(uids))
+                model.expire_many(uids=uids, now=now + 120)
+
+            sweeper = ExpirySweeper(schedule=schedule,
+                                    expire=expire,
+                                    interval=0,
+                                    batch=1)
+
+            self.assertEqual(sweeper.sweep(now=now), 1)
+            self.assertEqual(sweeper.sweep(now=now + 120), 1)
+            self.assertEqual(expired, [['4'], ['1']])
+            self.assertFalse(storage.exists(uid='1'))
+            self.assertFalse(storage.exists(uid='4'))
+            self.assertTrue(storage.exists(uid='2'))
+            self.assertIsNone(schedule.get(uid='1'))
+
+            # check a failing batch is swept again after the retry delay
+
+            model.insert(uid='5', values={'value': 'failing', 'ttl': 60})
+
+            def fail(uids):
+                raise IOError('Disk failure')
+
+            failing = ExpirySweeper(schedule=schedule,
+                                    expire=fail,
+                                    interval=0,
+                                    retry_delay=30)
+
+            self.assertEqual(failing.sweep(now=now + 120), 1)
+            self.assertEqual(failing.sweep(now=now + 140), 0)
+            self.assertEqual(sweeper.sweep(now=now + 151), 1)
+            self.assertFalse(storage.exists(uid='5'))
+
+            schedule.close()
+
+        finally:
+            shutil.rmtree(base_path)
+
     def test_cache(self):
         route_key = 'cache'
         self.start_triple_server(key=route_key)
@@ -369,12 +1880,37 @@ class TestCases(unittest2.TestCase):
 
     def test_get_not_exists_error(self):
         self.start_simple_server()
+        uid = self.new_uid()
         response = Helpers.request_get(
             url=URL,
-            dirs=['text', self.new_uid()])
+            dirs=['text', uid])
+
+        self.assertEqual(response.status_code, 404)
 
+        # check the second miss is answered by the negative cache, and a
+        # write of the uid forgets it
+
+        response = Helpers.request_get(url=URL, dirs=['text', uid])
         self.assertEqual(response.status_code, 404)
 
+        response = Helpers.request_get(url=URL, dirs=['text', '_stats'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['missing']['hits'], 1)
+
+        response = Helpers.request_post(
+            url=URL,
+            dirs=['text', uid],
+            data={'value': self.sample_normal['value']})
+        self.assertEqual(response.status_code, 200)
+
+        response = Helpers.request_get(url=URL, dirs=['text', '_stats'])
+        self.assertEqual(json.loads(response.content)['missing']['uids'], 0)
+
+        response = Helpers.request_get(url=URL, dirs=['text', uid])
+        self.assertEqual(response.status_code, 200)
+
+        Helpers.request_delete(url=URL, dirs=['text', uid])
+
     def test_delete_not_exists_error(self):
         self.start_simple_server()
         response = Helpers.request_delete(
@@ -406,6 +1942,186 @@ class TestCases(unittest2.TestCase):
 
         self.assertEqual(response.status_code, 200, 'Delete failed')
 
+    def test_list_texts(self):
+        self.start_simple_server()
+        prefix = self.new_uid()
+        uids = ['{!s}-{:d}'.format(prefix, index) for index in range(3)]
+
+        for uid in uids:
+            response = Helpers.request_post(
+                url=URL,
+                dirs=['text', uid],
+                data={'value': self.sample_fixed['value']})
+
+            self.assertEqual(response.status_code, 200, 'Post failed')
+
+        listed = list()
+        params = {'prefix': prefix, 'limit': 2}
+
+        while True:
+            response = Helpers.request_get(url=URL, dirs=['text', ''],
+                                           params=params)
+
+            self.assertEqual(response.status_code, 200, 'List failed')
+
+            page = response.json()
+            listed += [record['uid'] for record in page['records']]
+
+            if not page['next']:
+                break
+
+            params['after'] = page['next']
+
+        self.assertEqual(listed, uids)
+
+        response = Helpers.request_get(url=URL, dirs=['text', ''],
+                                       params={'after': '!'})
+
+        self.assertEqual(response.status_code, 400)
+
+        for uid in uids:
+            Helpers.request_delete(url=URL, dirs=['text', uid])
+
+    def test_query_indexes(self):
+        self.start_simple_server()
+        uid = self.new_uid()
+        response = Helpers.request_post(
+            url=URL,
+            dirs=['text', uid],
+            data={'value': self.sample_fixed['value']})
+
+        self.assertEqual(response.status_code, 200, 'Post failed')
+
+        record = response.json()
+
+        response = Helpers.request_get(
+            url=URL,
+            dirs=['text', '_index', 'lang'],
+            params={'value': record['lang'], 'limit': 1000})
+
+        self.assertEqual(response.status_code, 200, 'Lang query failed')
+        self.assertIn(uid, response.json()['uids'])
+
+        response = Helpers.request_get(
+            url=URL,
+            dirs=['text', '_index', 'timestamp'],
+            params={'low': repr(record['timestamp']),
+                    'high': repr(record['timestamp'])})
+
+        self.assertEqual(response.json()['uids'], [uid])
+
+        response = Helpers.request_get(
+            url=URL,
+            dirs=['text', '_index', 'check_sum'],
+            params={'value': record['check_sum']})
+
+        self.assertEqual(response.status_code, 404)
+
+        Helpers.request_delete(url=URL, dirs=['text', uid])
+
+        response = Helpers.request_get(
+            url=URL,
+            dirs=['text', '_index', 'timestamp'],
+            params={'low': repr(record['timestamp']),
+                    'high': repr(record['timestamp'])})
+
+        self.assertEqual(response.json()['uids'], [])
+
+    def test_search_texts(self):
+        self.start_simple_server()
+        uid = self.new_uid()
+        term = uid.split('-')[0]
+        response = Helpers.request_post(
+            url=URL,
+            dirs=['text', uid],
+            data={'value': 'searchable {!s} text'.format(term)})
+
+        self.assertEqual(response.status_code, 200, 'Post failed')
+
+        response = Helpers.request_get(
+            url=URL,
+            dirs=['text', '_search'],
+            params={'q': 'searchable {!s}'.format(term)})
+
+        self.assertEqual(response.status_code, 200, 'Search failed')
+        self.assertEqual([result['uid'] for result
+                          in response.json()['results']], [uid])
+
+        Helpers.request_delete(url=URL, dirs=['text', uid])
+
+        response = Helpers.request_get(
+            url=URL,
+            dirs=['text', '_search'],
+            params={'q': term})
+
+        self.assertEqual(response.json()['results'], [])
+
+    def test_raw_texts(self):
+        self.start_simple_server()
+        uid = self.new_uid()
+        url = '{!s}/text/{!s}'.format(URL, uid)
+        response = requests.post(
+            url,
+            data='0123456789',
+            params={RAW_MODE: 1},
+            headers={'Content-Type': 'application/octet-stream'})
+
+        self.assertEqual(response.status_code, 200, 'Post failed')
+
+        response = requests.get(url, params={RAW_MODE: 1})
+
+        self.assertEqual(response.status_code, 200, 'Get failed')
+        self.assertEqual(response.content, '0123456789')
+
+        response = requests.get(url,
+                                params={RAW_MODE: 1},
+                                headers={'Range': 'bytes=2-4'})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, '234')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 2-4/10')
+
+        response = requests.get(url,
+                                params={RAW_MODE: 1},
+                                headers={'Range': 'bytes=20-'})
+
+        self.assertEqual(response.status_code, 416)
+
+        response = Helpers.request_put_stream(
+            url=URL,
+            dirs=['text', uid],
+            stream=StreamReader(iter(['ab', 'c']), 3),
+            headers={},
+            params={RAW_MODE: 1})
+
+        self.assertEqual(response.status_code, 200, 'Put failed')
+        self.assertEqual(requests.get(url, params={RAW_MODE: 1}).content,
+                         'abc')
+
+        Helpers.request_delete(url=URL, dirs=['text', uid])
+
+    def test_expire_texts(self):
+        self.start_simple_server()
+        uid = self.new_uid()
+        response = Helpers.request_post(
+            url=URL,
+            dirs=['text', uid],
+            data={'value': 'expiring text'},
+            params={'ttl': 1})
+
+        self.assertEqual(response.status_code, 200, 'Post failed')
+        self.assertEqual(Helpers.request_get(url=URL,
+                                             dirs=['text', uid]).status_code,
+                         200)
+
+        time.sleep(3)
+
+        response = Helpers.request_get(url=URL, dirs=['text', uid])
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(os.path.exists(
+            os.path.join('test-sandbox', 'simple', uid)))
+
     def test_put_not_exists_error(self):
         self.start_simple_server()
         response = Helpers.request_put(
@@ -432,6 +2148,16 @@ class TestCases(unittest2.TestCase):
         self.assertEqual(response.status_code, 200, 'Get failed')
         self.assertEqual(len(response.content), expected_len)
 
+        # check a cached text is served with the same body and headers
+
+        cached = Helpers.request_get(url=URL, dirs=['text', uid])
+
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached.headers['Content-MD5'],
+                         hashlib.md5(response.content).hexdigest())
+        self.assertEqual(cached.headers['Content-Type'],
+                         response.headers['Content-Type'])
+
         response = Helpers.request_delete(
             url=URL,
             dirs=['text', uid])
@@ -504,6 +2230,58 @@ class TestCases(unittest2.TestCase):
 
         self.assertEqual(response.status_code, 200, 'Delete failed')
 
+    def test_conditional_requests(self):
+        self.start_simple_server()
+        uid = self.new_uid()
+        response = Helpers.request_post(
+            url=URL,
+            dirs=['text', uid],
+            data={'value': self.sample_normal['value']})
+        self.assertEqual(response.status_code, 200, 'Post failed')
+
+        response = Helpers.request_get(url=URL, dirs=['text', uid])
+        etag = response.headers['ETag']
+
+        # check an unchanged text is not sent again
+
+        response = Helpers.request_get(url=URL,
+                                       dirs=['text', uid],
+                                       headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        # check the writes of a text changed meanwhile are refused
+
+        response = Helpers.request_put(url=URL,
+                                       dirs=['text', uid],
+                                       data={'value': 'New content.'},
+                                       headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 200, 'Put failed')
+
+        response = Helpers.request_put(url=URL,
+                                       dirs=['text', uid],
+                                       data={'value': 'Lost content.'},
+                                       headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+
+        response = Helpers.request_delete(url=URL,
+                                          dirs=['text', uid],
+                                          headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+
+        response = Helpers.request_get(url=URL,
+                                       dirs=['text', uid],
+                                       headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200, 'Get failed')
+        self.assertIn('New content.', response.json()['value'])
+
+        response = Helpers.request_delete(
+            url=URL,
+            dirs=['text', uid],
+            headers={'If-Match': response.headers['ETag']})
+
+        self.assertEqual(response.status_code, 200, 'Delete failed')
+
     # test helpers
 
     def stop_all_apis(self):
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""Maintenance tools for the storage
+"""
+import os
+import random
+
+import sys
+sys.path.append('..')
+
+from minstore.about import AboutHelper
+from minstore.blobs import BlobStore
+from minstore.compression import Compressor, DictionaryStore
+from minstore.constants import *
+from minstore.helpers import Helpers
+from minstore.serializers import BinarySerializer, JsonSerializer
+from minstore.storage import DedupStorage, FileStorage
+
+
+class StorageTools(object):
+    """Maintenance jobs over a base path
+    """
+
+    @classmethod
+    def rehash(cls, base_path, shard_levels, shard_width=FILE_SHARD_WIDTH):
+        """
+        Moves the records of a flat base path to the sharded layout in place.
+        Returns the number of moved records.
+        :param base_path: str
+        :param shard_levels: int
+        :param shard_width: int
+        :return: int
+        """
+        storage = FileStorage(base_path=base_path,
+                              shard_levels=shard_levels,
+                              shard_width=shard_width,
+                              serializer=cls.serializer(base_path=base_path))
+
+        return storage.migrate()
+
+    @classmethod
+    def retrain(cls, base_path, samples=DICTIONARY_SAMPLES):
+        """
+        Trains a compression dictionary with a random sample of the record
+        values and makes it the current dictionary. Returns the id of the
+        dictionary or None if there are no repeated phrases to train with.
+        :param base_path: str
+        :param samples: int number of sample records
+        :return: int|None
+        """
+        storage = FileStorage(base_path=base_path,
+                              serializer=cls.serializer(base_path=base_path))
+
+        # Reservoir sampling keeps memory bounded by the number of samples
+        values = list()
+
+        for position, (file_path, record) in enumerate(storage.iter_records()):
+            value = record['value'].encode('utf-8')
+
+            if position < samples:
+                values.append(value)
+                continue
+
+            replaced = random.randint(0, position)
+
+            if replaced < samples:
+                values[replaced] = value
+
+        dictionary = DictionaryStore.train(samples=values)
+
+        if not dictionary:
+            return None
+
+        return DictionaryStore(base_path=base_path).save(dictionary)
+
+    @classmethod
+    def recompress(cls, base_path, pause=0):
+        """
+        Rewrites all the records of a base path with the configured format
+        and the current compression dictionary. Lowers the priority of the
+        process to run in the background of a serving node. Returns the
+        number of rewritten records.
+        :param base_path: str
+        :param pause: float seconds to sleep between two records
+        :return: int
+        """
+        os.nice(RECOMPRESS_NICENESS)
+
+        storage = FileStorage(base_path=base_path,
+                              serializer=cls.serializer(base_path=base_path))
+
+        return storage.rewrite(pause=pause)
+
+    @classmethod
+    def recount(cls, base_path):
+        """
+        Counts again the references to the deduplicated values from the
+        records, and removes the values without references. Run it with the
+        server stopped. Returns the number of removed values.
+        :param base_path: str
+        :return: int
+        """
+        storage = DedupStorage(
+            storage=FileStorage(base_path=base_path,
+                                serializer=cls.serializer(base_path=base_path)),
+            blobs=BlobStore(base_path=base_path))
+
+        try:
+            return storage.recount()
+
+        finally:
+            storage.close()
+
+    @classmethod
+    def serializer(cls, base_path):
+        """
+        Returns the configured serializer of the records of a base path
+        :param base_path: str
+        :return: Serializer
+        """
+        if COMPRESSION:
+            compressor = Compressor(base_path=base_path,
+                                    threshold=COMPRESSION_THRESHOLD,
+                                    level=COMPRESSION_LEVEL,
+                                    dictionary=COMPRESSION_DICTIONARY)
+
+            return BinarySerializer(compressor=compressor)
+
+        if RECORD_FORMAT == BINARY_FORMAT:
+            return BinarySerializer()
+
+        return JsonSerializer()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print AboutHelper.tools_help_info(
+            default_samples=DICTIONARY_SAMPLES)
+        exit(1)
+
+    command = sys.argv[1]
+
+    if command == 'rehash':
+        if len(sys.argv) < 4:
+            print AboutHelper.tools_help_info(
+                default_samples=DICTIONARY_SAMPLES)
+            exit(1)
+
+        base_path = sys.argv[2]
+
+        if not Helpers.path_exists(base_path):
+            print "Error: provided BASE_PATH is not a valid path.\n"
+            exit(1)
+
+        levels = int(sys.argv[3])
+
+        try:
+            width = int(sys.argv[4])
+
+        except IndexError:
+            width = FILE_SHARD_WIDTH
+
+        moved = StorageTools.rehash(base_path=base_path,
+                                    shard_levels=levels,
+                                    shard_width=width)
+
+        print "Moved {:d} records".format(moved)
+
+    elif command == 'retrain' or command == 'recompress':
+        if len(sys.argv) < 3:
+            print AboutHelper.tools_help_info(
+                default_samples=DICTIONARY_SAMPLES)
+            exit(1)
+
+        base_path = sys.argv[2]
+
+        if not Helpers.path_exists(base_path):
+            print "Error: provided BASE_PATH is not a valid path.\n"
+            exit(1)
+
+        if command == 'retrain':
+            try:
+                samples = int(sys.argv[3])
+
+            except IndexError:
+                samples = DICTIONARY_SAMPLES
+
+            dictionary_id = StorageTools.retrain(base_path=base_path,
+                                                 samples=samples)
+
+            if dictionary_id is None:
+                print "Error: not enough records to train a dictionary.\n"
+                exit(1)
+
+            print "Trained dictionary {:08x}".format(dictionary_id)
+
+        else:
+            try:
+                pause = float(sys.argv[3])
+
+            except IndexError:
+                pause = 0
+
+            rewritten = StorageTools.recompress(base_path=base_path,
+                                                pause=pause)
+
+            print "Rewritten {:d} records".format(rewritten)
+
+    elif command == 'recount':
+        if len(sys.argv) < 3:
+            print AboutHelper.tools_help_info(
+                default_samples=DICTIONARY_SAMPLES)
+            exit(1)
+
+        base_path = sys.argv[2]
+
+        if not Helpers.path_exists(base_path):
+            print "Error: provided BASE_PATH is not a valid path.\n"
+            exit(1)
+
+        removed = StorageTools.recount(base_path=base_path)
+
+        print "Removed {:d} values".format(removed)
+
+    else:
+        print "Error: unknown command {!s}.\n".format(command)
+        print "See --help for more information.\n"
+        exit(1)